@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Benchmark single-user server startup, cold vs. from the preloaded zygote
+
+Starts jupyterhub-singleuser as the current user N times each way,
+and times how long it takes until the server responds to HTTP.
+
+Usage:
+
+    python benchmarks/spawn_latency.py [--spawns 10]
+"""
+
+import argparse
+import os
+import signal
+from subprocess import Popen
+import sys
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from jupyterhub.utils import random_port, wait_for_http_server
+from jupyterhub.zygote import ZygoteLauncher
+
+
+def server_argv(port):
+    argv = ['jupyterhub-singleuser', '--ip=127.0.0.1', '--port=%i' % port]
+    if os.getuid() == 0:
+        argv.append('--allow-root')
+    return argv
+
+
+def server_env():
+    env = dict(os.environ)
+    env.update({
+        'JUPYTERHUB_API_TOKEN': 'benchmark',
+        'JUPYTERHUB_CLIENT_ID': 'user-benchmark',
+        'JUPYTERHUB_USER': 'benchmark',
+        'JUPYTERHUB_SERVICE_PREFIX': '/user/benchmark/',
+    })
+    return env
+
+
+@gen.coroutine
+def cold(argv, env):
+    p = Popen([sys.executable, '-m', 'jupyterhub.singleuser'] + argv[1:],
+        env=env, start_new_session=True)
+    return p.pid
+
+
+@gen.coroutine
+def zygote(argv, env):
+    pid = yield ZygoteLauncher.instance().launch(
+        argv, env, os.getuid(), os.getgid(), os.getgroups(), os.getcwd())
+    return pid
+
+
+@gen.coroutine
+def bench(launch, spawns):
+    times = []
+    for i in range(spawns):
+        port = random_port()
+        argv = server_argv(port)
+        tic = time.perf_counter()
+        pid = yield launch(argv, server_env())
+        yield wait_for_http_server('http://127.0.0.1:%i/user/benchmark/' % port, timeout=60)
+        times.append(time.perf_counter() - tic)
+        os.kill(pid, signal.SIGTERM)
+    return times
+
+
+@gen.coroutine
+def run(spawns):
+    print("{:>8} {:>10} {:>10} {:>10}".format("mode", "min (s)", "mean (s)", "max (s)"))
+    # start the zygote first, which is a one-time cost
+    yield ZygoteLauncher.instance().start()
+    try:
+        for label, launch in [('cold', cold), ('zygote', zygote)]:
+            times = yield bench(launch, spawns)
+            print("{:>8} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                label, min(times), sum(times) / len(times), max(times),
+            ))
+    finally:
+        ZygoteLauncher.instance().stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--spawns', type=int, default=10,
+        help="Number of servers to start each way")
+    args = parser.parse_args()
+    IOLoop.current().run_sync(lambda: run(args.spawns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Benchmark finding API tokens with legacy salted hashes vs. indexed digests
+
+Fills an in-memory sqlite database with N tokens stored with each scheme
+and times APIToken lookups of valid and invalid tokens.
+
+Usage:
+
+    python benchmarks/token_lookup.py [--sizes 10000 100000] [--lookups 100]
+"""
+
+import argparse
+import time
+
+from jupyterhub import orm
+from jupyterhub.utils import new_token, hash_token, digest_token
+
+
+def fill(db, n, legacy, lookups):
+    """Add n tokens for one user, returning `lookups` of them
+
+    Only the tokens that are returned are hashed with the full number of rounds,
+    so that filling the database doesn't take forever.
+    Candidates with a colliding prefix still use the legacy format,
+    so checking them costs a (cheaper) hash each, as before.
+    """
+    user = orm.User(name='bench')
+    db.add(user)
+    db.commit()
+    found = []
+    rows = []
+    for i in range(n):
+        token = new_token()
+        row = {
+            'user_id': user.id,
+            'prefix': token[:orm.APIToken.prefix_length],
+        }
+        if legacy:
+            rounds = orm.APIToken.rounds if i < lookups else 1
+            row['hashed'] = hash_token(token, rounds=rounds,
+                salt=orm.APIToken.salt_bytes, algorithm=orm.APIToken.algorithm)
+        else:
+            row['digest'] = digest_token(token)
+        rows.append(row)
+        if i < lookups:
+            found.append(token)
+    db.bulk_insert_mappings(orm.APIToken, rows)
+    db.commit()
+    return found
+
+
+def legacy_find(db, token):
+    """The lookup before digests: prefix scan and compare each hash"""
+    for orm_token in orm.APIToken.find_prefix(db, token):
+        if orm_token.match(token):
+            return orm_token
+
+
+def bench(n, lookups, legacy):
+    db = orm.new_session_factory('sqlite:///:memory:')()
+    tokens = fill(db, n, legacy, lookups)
+    find = legacy_find if legacy else orm.APIToken.find
+    tic = time.perf_counter()
+    for token in tokens:
+        assert find(db, token) is not None
+    found = (time.perf_counter() - tic) / len(tokens)
+    tic = time.perf_counter()
+    for i in range(lookups):
+        assert find(db, new_token()) is None
+    missing = (time.perf_counter() - tic) / lookups
+    db.close()
+    return found, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+        help="Numbers of tokens in the database")
+    parser.add_argument('--lookups', type=int, default=100,
+        help="Number of lookups to time for each case")
+    args = parser.parse_args()
+
+    print("{:>8} {:>8} {:>14} {:>14}".format("tokens", "scheme", "found (ms)", "missing (ms)"))
+    for n in args.sizes:
+        for legacy in (True, False):
+            found, missing = bench(n, args.lookups, legacy)
+            print("{:>8} {:>8} {:>14.3f} {:>14.3f}".format(
+                n, 'sha512' if legacy else 'digest', found * 1e3, missing * 1e3,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Benchmark UserDict lookups as the number of users grows
+
+Fills an in-memory sqlite database with N users, loads them all into a UserDict,
+and times lookups by name, id, and orm.User, which should not depend on N.
+
+Usage:
+
+    python benchmarks/user_lookup.py [--sizes 1000 10000 100000] [--lookups 10000]
+"""
+
+import argparse
+import random
+import time
+
+from jupyterhub import orm
+from jupyterhub.user import UserDict
+from jupyterhub.spawner import Spawner
+
+
+def bench(n, lookups):
+    db = orm.new_session_factory('sqlite:///:memory:')()
+    db.bulk_insert_mappings(orm.User, [
+        {'name': 'user-%i' % i, 'cookie_id': 'cookie-%i' % i}
+        for i in range(n)
+    ])
+    db.commit()
+    # the base Spawner is cheaper to construct than LocalProcessSpawner
+    users = UserDict(db_factory=lambda: db, settings={'spawner_class': Spawner})
+    for orm_user in db.query(orm.User):
+        users[orm_user]
+    db.commit()
+
+    sample = random.sample(list(users.values()), min(lookups, n))
+    names = [ user.name for user in sample ]
+    ids = [ user.id for user in sample ]
+    orm_users = [ user.orm_user for user in sample ]
+    cookie_ids = [ user.cookie_id for user in sample ]
+
+    results = []
+    for label, keys, lookup in [
+        ('name', names, users.__getitem__),
+        ('id', ids, users.__getitem__),
+        ('orm.User', orm_users, users.__getitem__),
+        ('cookie_id', cookie_ids, users.find_by_cookie_id),
+    ]:
+        tic = time.perf_counter()
+        for key in keys:
+            lookup(key)
+        results.append((label, (time.perf_counter() - tic) / len(keys)))
+    db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+        help="Numbers of users")
+    parser.add_argument('--lookups', type=int, default=10000,
+        help="Number of lookups to time for each case")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>12}".format("users", "key", "lookup (us)"))
+    for n in args.sizes:
+        for label, t in bench(n, args.lookups):
+            print("{:>8} {:>10} {:>12.2f}".format(n, label, t * 1e6))
+
+
+if __name__ == '__main__':
+    main()
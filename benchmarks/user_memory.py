@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Measure the memory used by each User and Spawner in the Hub
+
+Fills an in-memory sqlite database with N users, each with a server,
+loads the orm.Users, and then measures with tracemalloc the bytes retained by:
+
+- wrapping each orm.User in a User
+- creating each User's Spawner
+- reading user.server and user.running on every user,
+  which should not retain anything after the first time
+
+and the time per user taken by each.
+
+Usage:
+
+    python benchmarks/user_memory.py [--sizes 1000 10000] [--spawner-class jupyterhub.spawner.Spawner]
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from traitlets import import_item
+
+from jupyterhub import orm
+from jupyterhub.user import UserDict
+
+
+def retained(f):
+    """Return the bytes allocated by f() that are still allocated after it returns,
+    and the time f() took
+    """
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    tic = time.perf_counter()
+    f()
+    t = time.perf_counter() - tic
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0] - before, t
+
+
+def bench(n, spawner_class):
+    db = orm.new_session_factory('sqlite:///:memory:')()
+    db.bulk_insert_mappings(orm.User, [
+        {'name': 'user-%i' % i, 'cookie_id': 'cookie-%i' % i}
+        for i in range(n)
+    ])
+    db.commit()
+    orm_users = db.query(orm.User).all()
+    for orm_user in orm_users:
+        orm_user.servers.append(orm.Server())
+    db.commit()
+    # load the orm objects before measuring, they are not part of the User
+    for orm_user in orm_users:
+        orm_user.servers[0].port
+
+    users = UserDict(db_factory=lambda: db, settings={'spawner_class': spawner_class})
+
+    def load_users():
+        for orm_user in orm_users:
+            users[orm_user]
+
+    def load_spawners():
+        for user in users.values():
+            user.spawner
+
+    def read_servers():
+        for user in users.values():
+            user.server
+            user.running
+
+    results = []
+    for label, f in [
+        ('User', load_users),
+        ('Spawner', load_spawners),
+        ('server', read_servers),
+        ('server again', read_servers),
+    ]:
+        size, t = retained(f)
+        results.append((label, size / n, t / n))
+    db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+        help="Numbers of users")
+    parser.add_argument('--spawner-class', default='jupyterhub.spawner.LocalProcessSpawner',
+        help="The Spawner class to measure")
+    args = parser.parse_args()
+    spawner_class = import_item(args.spawner_class)
+
+    tracemalloc.start()
+    print("{:>8} {:>14} {:>12} {:>10}".format("users", "", "bytes/user", "us/user"))
+    for n in args.sizes:
+        for label, size, t in bench(n, spawner_class):
+            print("{:>8} {:>14} {:>12.0f} {:>10.1f}".format(n, label, size, t * 1e6))
+
+
+if __name__ == '__main__':
+    main()
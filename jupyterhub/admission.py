@@ -0,0 +1,261 @@
+"""Admission control for spawning single-user servers
+
+When many users start their servers at once (e.g. at the start of a lecture),
+starting them all at the same time can exhaust the host.
+Spawns are admitted only while there is room for them:
+
+- at most `max_pending_spawns` spawns are in progress at a time
+- groups in `group_limits` have at most that many servers running
+- the host has at least `min_free_memory` bytes of memory available
+
+Spawns that are not admitted wait in a queue, and are admitted in the order they arrived.
+A spawn blocked only by its own groups' limits does not hold up the spawns behind it.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from collections import OrderedDict
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from traitlets.config import LoggingConfigurable
+from traitlets import Any, Dict, Float, Integer, Unicode, default
+
+from . import orm
+from .emptyclass import EmptyClass
+
+
+def read_available_memory(path='/proc/meminfo'):
+    """Return the memory available for new processes, in bytes, from /proc/meminfo
+
+    Returns None if it cannot be read, e.g. on systems without /proc.
+    """
+    info = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                # values are in kB
+                info[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    # kernels before 3.14 don't report MemAvailable
+    try:
+        return info['MemFree'] + info.get('Buffers', 0) + info.get('Cached', 0)
+    except KeyError:
+        return None
+
+
+class SpawnAdmission(LoggingConfigurable):
+    """Decide when spawns may start, queueing the rest
+
+    A spawn is admitted with `admit(user)`, or waits its turn with `yield wait(user)`.
+    Admitted spawns count as pending until `release(user)`,
+    called when the spawn finishes, successfully or not.
+
+    Metrics, sent to statsd:
+
+    - spawns.admitted: spawns admitted and not yet finished (gauge)
+    - spawns.queued: spawns waiting to be admitted (gauge)
+    """
+
+    max_pending_spawns = Integer(0,
+        help="""
+        Maximum number of spawns in progress at the same time.
+
+        Further spawns wait in a queue until earlier spawns finish.
+        0 means no limit.
+        """
+    ).tag(config=True)
+
+    group_limits = Dict(
+        help="""
+        Maximum number of running servers, by group name.
+
+        Servers that are starting count as running.
+        Users in several limited groups are limited by each of them.
+        Groups that are not listed here are not limited.
+        """
+    ).tag(config=True)
+
+    min_free_memory = Integer(0,
+        help="""
+        Minimum memory available on the host, in bytes, for a spawn to be admitted.
+
+        Read from MemAvailable in /proc/meminfo.
+        0 means no limit.
+        """
+    ).tag(config=True)
+
+    meminfo_path = Unicode('/proc/meminfo',
+        help="Where to read available memory from, for `min_free_memory`."
+    ).tag(config=True)
+
+    retry_after = Integer(10,
+        help="""
+        Seconds REST API clients are told to wait (with Retry-After)
+        before retrying a spawn that was not admitted.
+        """
+    ).tag(config=True)
+
+    recheck_interval = Float(1,
+        help="""
+        Interval, in seconds, at which queued spawns are checked again
+        while they are waiting.
+
+        Running servers stopping and memory being freed are only noticed on these checks.
+        """
+    ).tag(config=True)
+
+    db_factory = Any(help="Callable returning the database session")
+
+    statsd = Any(allow_none=False, help="The statsd client, if any.")
+
+    @default('statsd')
+    def _statsd_default(self):
+        return EmptyClass()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # name: names of the user's limited groups, for admitted spawns
+        self._admitted = {}
+        # name: (user, Future, names of the user's limited groups) for queued spawns,
+        # in order of arrival
+        self._queue = OrderedDict()
+        self._recheck = None
+
+    @property
+    def db(self):
+        return self.db_factory()
+
+    @property
+    def enabled(self):
+        return bool(self.max_pending_spawns or self.group_limits or self.min_free_memory)
+
+    def _limited_groups(self, user):
+        if not self.group_limits:
+            return set()
+        return { group.name for group in user.groups if group.name in self.group_limits }
+
+    def _global_block(self):
+        """Return why no spawn can be admitted now, or None"""
+        if self.max_pending_spawns and len(self._admitted) >= self.max_pending_spawns:
+            return "%i servers are already starting" % len(self._admitted)
+        if self.min_free_memory:
+            available = read_available_memory(self.meminfo_path)
+            if available is not None and available < self.min_free_memory:
+                return "only %i MB of memory is available" % (available // 2**20)
+
+    def _running(self):
+        """Return the names of members with running or admitted servers, by limited group
+
+        Found with one query, for a whole pass over the queue.
+        """
+        running = { group: set() for group in self.group_limits }
+        query = (self.db.query(orm.Group.name, orm.User.name)
+            .select_from(orm.Group)
+            .join(orm.Group.users)
+            .filter(orm.Group.name.in_(list(self.group_limits)))
+            .filter(orm.User.user_to_servers.any())
+        )
+        for group, name in query:
+            running[group].add(name)
+        for name, user_groups in self._admitted.items():
+            for group in user_groups:
+                running[group].add(name)
+        return running
+
+    def _group_block(self, groups, running):
+        """Return why a spawn for a member of groups cannot be admitted now, or None
+
+        running is the result of `_running()`.
+        """
+        for group in sorted(groups):
+            if len(running[group]) >= self.group_limits[group]:
+                return "group %s already has %i running servers" % (group, len(running[group]))
+
+    def _gauge(self):
+        self.statsd.gauge('spawns.admitted', len(self._admitted))
+        self.statsd.gauge('spawns.queued', len(self._queue))
+
+    def _admit(self, name, groups, running=None):
+        self._admitted[name] = groups
+        if running is not None:
+            for group in groups:
+                running[group].add(name)
+        self._gauge()
+
+    def _process(self):
+        """Admit queued spawns, in order, while there is room"""
+        if self._recheck is not None:
+            IOLoop.current().remove_timeout(self._recheck)
+            self._recheck = None
+        running = None
+        for name, (user, f, groups) in list(self._queue.items()):
+            if self._global_block():
+                break
+            if groups:
+                if running is None:
+                    running = self._running()
+                if self._group_block(groups, running):
+                    continue
+            del self._queue[name]
+            self._admit(name, groups, running)
+            self.log.info("Admitting queued spawn for %s", name)
+            f.set_result(None)
+        self._gauge()
+        if self._queue:
+            self._recheck = IOLoop.current().call_later(self.recheck_interval, self._process)
+
+    def admit(self, user):
+        """Admit a spawn for user now, if there is room, returning whether it was admitted
+
+        Spawns already admitted stay admitted.
+        Queued spawns are admitted first, so that a new spawn cannot jump the queue.
+        """
+        if user.name in self._admitted:
+            return True
+        if not self.enabled:
+            return True
+        self._process()
+        if user.name in self._queue:
+            return False
+        groups = self._limited_groups(user)
+        reason = self._global_block()
+        if not reason and groups:
+            reason = self._group_block(groups, self._running())
+        if reason:
+            self.log.info("Not admitting spawn for %s: %s", user.name, reason)
+            return False
+        self._admit(user.name, groups)
+        return True
+
+    def wait(self, user):
+        """Wait in the queue for a spawn for user to be admitted
+
+        Returns a Future, resolved when the spawn is admitted.
+        """
+        if self.admit(user):
+            f = Future()
+            f.set_result(None)
+            return f
+        if user.name not in self._queue:
+            self._queue[user.name] = (user, Future(), self._limited_groups(user))
+            self.log.info("Queued spawn for %s at position %i", user.name, len(self._queue))
+            self._process()
+        return self._queue[user.name][1]
+
+    def position(self, user):
+        """Return user's position in the queue, starting at 1, or None if not queued"""
+        for i, name in enumerate(self._queue, 1):
+            if name == user.name:
+                return i
+
+    def release(self, user):
+        """Record that an admitted spawn has finished, making room for the next"""
+        self._admitted.pop(user.name, None)
+        self._process()
@@ -0,0 +1,35 @@
+"""job results
+
+Adds per-task results to jobs, for jobs such as spawning many servers.
+
+Revision ID: 0a7d3e1c5b2f
+Revises: 5f1e4b1ad1d0
+Create Date: 2017-08-30 11:20:03.118462
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0a7d3e1c5b2f'
+down_revision = '5f1e4b1ad1d0'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def _has_results():
+    inspector = sa.inspect(op.get_bind())
+    return any(c['name'] == 'results' for c in inspector.get_columns('jobs'))
+
+
+def upgrade():
+    # tables created since the column was added already have it
+    if not _has_results():
+        op.add_column('jobs', sa.Column('results', sa.Text))
+
+
+def downgrade():
+    # sqlite cannot downgrade because of limited ALTER TABLE support (no DROP COLUMN)
+    if _has_results():
+        op.drop_column('jobs', 'results')
@@ -0,0 +1,55 @@
+"""token digest
+
+Adds an indexed, unique digest column to token tables,
+so tokens can be found with a single indexed lookup.
+
+Existing rows keep their salted hash and are upgraded to a digest
+the first time their token is used.
+
+Revision ID: 3ec6993fe20c
+Revises: af4cbdb2d13c
+Create Date: 2017-08-21 12:04:26.159721
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3ec6993fe20c'
+down_revision = 'af4cbdb2d13c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+# oauth_access_tokens is not in databases created before 0.8,
+# in which case the table is created with the digest column at startup.
+token_tables = ['api_tokens', 'oauth_access_tokens']
+
+
+def _has_digest(table):
+    """Does table exist, and does it have a digest column?"""
+    inspector = sa.inspect(op.get_bind())
+    if table not in inspector.get_table_names():
+        return None
+    return any(c['name'] == 'digest' for c in inspector.get_columns(table))
+
+
+def upgrade():
+    for table in token_tables:
+        if _has_digest(table) is not False:
+            continue
+        op.add_column(table, sa.Column('digest', sa.Unicode(64)))
+        op.create_index('ix_%s_digest' % table, table, ['digest'], unique=True)
+        op.create_index('ix_%s_prefix' % table, table, ['prefix'])
+
+
+def downgrade():
+    # sqlite cannot downgrade because of limited ALTER TABLE support (no DROP COLUMN)
+    # tokens created after the upgrade have no salted hash, and are lost on downgrade
+    for table in token_tables:
+        if not _has_digest(table):
+            continue
+        op.drop_index('ix_%s_prefix' % table, table_name=table)
+        op.drop_index('ix_%s_digest' % table, table_name=table)
+        op.execute(sa.text("DELETE FROM %s WHERE hashed IS NULL" % table))
+        op.drop_column(table, 'digest')
@@ -0,0 +1,46 @@
+"""jobs table
+
+Adds the jobs table, for background jobs such as creating user directories.
+
+Revision ID: 5f1e4b1ad1d0
+Revises: d68c98b66cd4
+Create Date: 2017-08-28 15:12:44.519820
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5f1e4b1ad1d0'
+down_revision = 'd68c98b66cd4'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def _has_table():
+    return 'jobs' in sa.inspect(op.get_bind()).get_table_names()
+
+
+def upgrade():
+    # the table is created at startup, before upgrading, if it doesn't exist
+    if _has_table():
+        return
+    op.create_table('jobs',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('action', sa.Unicode(255)),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('users.id', ondelete='SET NULL'), nullable=True),
+        sa.Column('state', sa.Unicode(16), index=True),
+        sa.Column('spec', sa.Text),
+        sa.Column('progress', sa.Integer),
+        sa.Column('total', sa.Integer),
+        sa.Column('message', sa.Text),
+        sa.Column('created', sa.DateTime),
+        sa.Column('started', sa.DateTime),
+        sa.Column('finished', sa.DateTime),
+    )
+
+
+def downgrade():
+    if _has_table():
+        op.drop_table('jobs')
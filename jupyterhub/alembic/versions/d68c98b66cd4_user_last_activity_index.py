@@ -0,0 +1,34 @@
+"""user last_activity index
+
+Indexes users.last_activity, for listing users inactive since a given time.
+
+Revision ID: d68c98b66cd4
+Revises: 3ec6993fe20c
+Create Date: 2017-08-24 10:41:07.304852
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd68c98b66cd4'
+down_revision = '3ec6993fe20c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def _has_index():
+    inspector = sa.inspect(op.get_bind())
+    return any(ix['name'] == 'ix_users_last_activity' for ix in inspector.get_indexes('users'))
+
+
+def upgrade():
+    # tables created since the index was added already have it
+    if not _has_index():
+        op.create_index('ix_users_last_activity', 'users', ['last_activity'])
+
+
+def downgrade():
+    if _has_index():
+        op.drop_index('ix_users_last_activity', table_name='users')
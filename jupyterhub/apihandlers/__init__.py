@@ -1,6 +1,6 @@
 from .base import *
-from . import auth, hub, proxy, users, groups, services
+from . import auth, hub, proxy, users, groups, services, jobs
 
 default_handlers = []
-for mod in (auth, hub, proxy, users, groups, services):
+for mod in (auth, hub, proxy, users, groups, services, jobs):
     default_handlers.extend(mod.default_handlers)
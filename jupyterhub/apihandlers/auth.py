@@ -17,9 +17,9 @@ from .base import BaseHandler, APIHandler
 class TokenAPIHandler(APIHandler):
     @token_authenticated
     def get(self, token):
-        orm_token = orm.APIToken.find(self.db, token)
+        orm_token = orm.APIToken.find(self.db, token, cache=self.token_cache)
         if orm_token is None:
-            orm_token = orm.OAuthAccessToken.find(self.db, token)
+            orm_token = orm.OAuthAccessToken.find(self.db, token, cache=self.token_cache)
         if orm_token is None:
             raise web.HTTPError(404)
         if orm_token.user:
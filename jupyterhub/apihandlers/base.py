@@ -13,6 +13,10 @@ from ..utils import url_path_join
 
 class APIHandler(BaseHandler):
 
+    # API clients are told to retry spawns that are not admitted right away,
+    # rather than being queued
+    queue_spawns = False
+
     def check_referer(self):
         """Check Origin for cross-site API requests.
         
@@ -80,12 +84,43 @@ class APIHandler(BaseHandler):
             reason = getattr(exception, 'reason', '')
             if reason:
                 status_message = reason
+        retry_after = getattr(exc_info[1], 'retry_after', None) if exc_info else None
+        if retry_after:
+            self.set_header('Retry-After', str(retry_after))
         self.set_header('Content-Type', 'application/json')
         self.write(json.dumps({
             'status': status_code,
             'message': message or status_message,
         }))
 
+    def check_model_etag(self, kind, key=None):
+        """Set the ETag for a model (or collection, if key is None) from the model cache
+
+        If the request's If-None-Match matches, finish with 304 Not Modified
+        and return True, in which case there is nothing left to do.
+        """
+        if self.model_cache is None:
+            return False
+        self.set_header('Etag', self.model_cache.etag(kind, key))
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
+    def cached_model_json(self, kind, key, get_model):
+        """Get a model serialized as JSON, from the model cache if it is current
+
+        get_model is called to build the model if it is not.
+        """
+        if self.model_cache is None:
+            return json.dumps(get_model())
+        serialized = self.model_cache.get(kind, key)
+        if serialized is None:
+            serialized = json.dumps(get_model())
+            self.model_cache.set(kind, key, serialized)
+        return serialized
+
     def user_model(self, user):
         """Get the JSON model for a User object"""
         model = {
@@ -103,14 +138,43 @@ class APIHandler(BaseHandler):
             model['pending'] = 'stop'
         return model
 
-    def group_model(self, group):
-        """Get the JSON model for a Group object"""
+    def group_model(self, group, offset=0, limit=None):
+        """Get the JSON model for a Group object
+
+        Members are listed by name, sorted, from offset up to limit.
+        `user_count` is the total number of members.
+        """
         return {
             'kind': 'group',
             'name': group.name,
-            'users': [ u.name for u in group.users ],
+            'users': group.member_names(offset=offset, limit=limit),
+            'user_count': group.member_count(),
         }
 
+    def job_model(self, job):
+        """Get the JSON model for a Job object"""
+        def isoformat(dt):
+            return dt.isoformat() if dt else None
+        return {
+            'kind': 'job',
+            'id': job.id,
+            'action': job.action,
+            'user': job.user.name if job.user else None,
+            'state': job.state,
+            'progress': job.progress,
+            'total': job.total,
+            'message': job.message,
+            'created': isoformat(job.created),
+            'started': isoformat(job.started),
+            'finished': isoformat(job.finished),
+            'results': job.results,
+        }
+
+    def accept_job(self, job_id):
+        """Respond 202 Accepted, with the location of a submitted job"""
+        self.set_status(202)
+        self.set_header('Location', url_path_join(self.hub.base_url, 'api/jobs', str(job_id)))
+
     def service_model(self, service):
         """Get the JSON model for a Service object"""
         return {
@@ -13,16 +13,29 @@ from .base import APIHandler
 
 
 class _GroupAPIHandler(APIHandler):
-    def _usernames_to_users(self, usernames):
-        """Turn a list of usernames into user objects"""
-        users = []
+
+    # number of names per IN clause, below sqlite's limit of 999 parameters
+    _in_chunk_size = 500
+
+    def _usernames_to_ids(self, usernames):
+        """Turn a list of usernames into user ids, in one query per 500 users
+
+        Raise 400 if any user doesn't exist.
+        """
+        names = []
         for username in usernames:
             username = self.authenticator.normalize_username(username)
-            user = self.find_user(username)
-            if user is None:
+            if username not in names:
+                names.append(username)
+        ids = {}
+        for i in range(0, len(names), self._in_chunk_size):
+            chunk = names[i:i + self._in_chunk_size]
+            ids.update((name, user_id) for user_id, name in
+                self.db.query(orm.User.id, orm.User.name).filter(orm.User.name.in_(chunk)))
+        for username in names:
+            if username not in ids:
                 raise web.HTTPError(400, "No such user: %s" % username)
-            users.append(user.orm_user)
-        return users
+        return [ ids[username] for username in names ]
 
     def find_group(self, name):
         """Find and return a group by name.
@@ -34,12 +47,47 @@ class _GroupAPIHandler(APIHandler):
             raise web.HTTPError(404, "No such group: %s", name)
         return group
 
+    def _get_int_argument(self, name, default=None):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        if not value.isdigit():
+            raise web.HTTPError(400, "%s must be a non-negative integer, not %r" % (name, value))
+        return int(value)
+
+    def _bump_models(self, name, user_ids):
+        """Record changes to the models of a group and of its added or removed users"""
+        if self.model_cache is None:
+            return
+        self.model_cache.bump('group', name)
+        for user_id in user_ids:
+            self.model_cache.bump('user', user_id)
+
+    def group_model_json(self, group, **kwargs):
+        """Get the JSON model of a group
+
+        The model with all members is cached.
+        """
+        if kwargs:
+            return json.dumps(self.group_model(group, **kwargs))
+        return self.cached_model_json('group', group.name, lambda: self.group_model(group))
+
 class GroupListAPIHandler(_GroupAPIHandler):
     @admin_only
     def get(self):
-        """List groups"""
-        data = [ self.group_model(g) for g in self.db.query(orm.Group) ]
-        self.write(json.dumps(data))
+        """List groups
+
+        `?limit=N` lists at most N members of each group (0 for counts only).
+        """
+        if self.check_model_etag('group'):
+            return
+        kwargs = {}
+        limit = self._get_int_argument('limit')
+        if limit is not None:
+            kwargs['limit'] = limit
+        self.write('[%s]' % ', '.join(
+            self.group_model_json(g, **kwargs) for g in self.db.query(orm.Group)
+        ))
 
 
 class GroupAPIHandler(_GroupAPIHandler):
@@ -47,8 +95,27 @@ class GroupAPIHandler(_GroupAPIHandler):
 
     @admin_only
     def get(self, name):
-        group = self.find_group(name)
-        self.write(json.dumps(self.group_model(group)))
+        """Get a group
+
+        `?offset=M&limit=N` lists N members, sorted by name, starting at M.
+        """
+        # a group with a current cached model exists, otherwise look it up first,
+        # so that a missing group is 404, not 304 for the ETag of an unused name
+        group = None
+        if self.model_cache is None or self.model_cache.get('group', name) is None:
+            group = self.find_group(name)
+        if self.check_model_etag('group', name):
+            return
+        if group is None:
+            group = self.find_group(name)
+        kwargs = {}
+        offset = self._get_int_argument('offset', 0)
+        limit = self._get_int_argument('limit')
+        if offset:
+            kwargs['offset'] = offset
+        if limit is not None:
+            kwargs['limit'] = limit
+        self.write(self.group_model_json(group, **kwargs))
 
     @admin_only
     @gen.coroutine
@@ -66,16 +133,18 @@ class GroupAPIHandler(_GroupAPIHandler):
 
         usernames = model.get('users', [])
         # check that users exist
-        users = self._usernames_to_users(usernames)
+        user_ids = self._usernames_to_ids(usernames)
 
         # create the group
         self.log.info("Creating new group %s with %i users",
-            name, len(users),
+            name, len(user_ids),
         )
         self.log.debug("Users: %s", usernames)
-        group = orm.Group(name=name, users=users)
+        group = orm.Group(name=name)
         self.db.add(group)
+        group.add_users(user_ids)
         self.db.commit()
+        self._bump_models(name, user_ids)
         self.write(json.dumps(self.group_model(group)))
         self.set_status(201)
 
@@ -84,8 +153,11 @@ class GroupAPIHandler(_GroupAPIHandler):
         """Delete a group by name"""
         group = self.find_group(name)
         self.log.info("Deleting group %s", name)
+        # remove members in bulk, instead of loading them to delete the group
+        user_ids = group.remove_users(group.member_ids())
         self.db.delete(group)
         self.db.commit()
+        self._bump_models(name, user_ids)
         self.set_status(204)
 
 
@@ -101,12 +173,12 @@ class GroupUsersAPIHandler(_GroupAPIHandler):
             raise web.HTTPError(400, "Must specify users to add")
         self.log.info("Adding %i users to group %s", len(data['users']), name)
         self.log.debug("Adding: %s", data['users'])
-        for user in self._usernames_to_users(data['users']):
-            if user not in group.users:
-                group.users.append(user)
-            else:
-                self.log.warning("User %s already in group %s", user.name, name)
+        user_ids = self._usernames_to_ids(data['users'])
+        added = group.add_users(user_ids)
+        if len(added) < len(user_ids):
+            self.log.warning("%i users already in group %s", len(user_ids) - len(added), name)
         self.db.commit()
+        self._bump_models(name, added)
         self.write(json.dumps(self.group_model(group)))
 
     @gen.coroutine
@@ -120,12 +192,12 @@ class GroupUsersAPIHandler(_GroupAPIHandler):
             raise web.HTTPError(400, "Must specify users to delete")
         self.log.info("Removing %i users from group %s", len(data['users']), name)
         self.log.debug("Removing: %s", data['users'])
-        for user in self._usernames_to_users(data['users']):
-            if user in group.users:
-                group.users.remove(user)
-            else:
-                self.log.warning("User %s already not in group %s", user.name, name)
+        user_ids = self._usernames_to_ids(data['users'])
+        removed = group.remove_users(user_ids)
+        if len(removed) < len(user_ids):
+            self.log.warning("%i users already not in group %s", len(user_ids) - len(removed), name)
         self.db.commit()
+        self._bump_models(name, removed)
         self.write(json.dumps(self.group_model(group)))
 
 
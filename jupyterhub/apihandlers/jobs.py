@@ -0,0 +1,28 @@
+"""Background job handlers"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import json
+
+from tornado import web
+
+from .. import orm
+from ..utils import admin_only
+from .base import APIHandler
+
+
+class JobAPIHandler(APIHandler):
+    """Report the progress of a background job"""
+
+    @admin_only
+    def get(self, job_id):
+        job = self.db.query(orm.Job).filter(orm.Job.id == int(job_id)).first()
+        if job is None:
+            raise web.HTTPError(404, "No such job: %s", job_id)
+        self.write(json.dumps(self.job_model(job)))
+
+
+default_handlers = [
+    (r"/api/jobs/(\d+)", JobAPIHandler),
+]
@@ -3,16 +3,23 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+from hmac import compare_digest
 import json
-import pwd
 import crypt
 import os
 from subprocess import Popen, PIPE
 
+from sqlalchemy import and_, or_
 from tornado import gen, web
+from tornado.httputil import url_concat
+from tornado.locks import Semaphore
 
-from .. import orm
-from ..utils import admin_only
+from .. import nss, orm
+from ..user import User, _user_id
+from ..utils import admin_only, ISO8601_ms, ISO8601_s
 from .base import APIHandler
 from os.path import exists
 from os.path import isfile
@@ -32,32 +39,409 @@ class SelfAPIHandler(APIHandler):
             raise web.HTTPError(403)
         self.write(json.dumps(self.user_model(user)))
 
-class UserListAPIHandler(APIHandler):
+class _BulkUserAPIHandler(APIHandler):
+    """Create and delete users in bulk
+
+    Database rows for all users are written in one transaction,
+    and authenticator hooks run concurrently,
+    limited by `JupyterHub.bulk_user_concurrency`.
+    Data directories of new users are created by a background job.
+    Each user gets its own result.
+    """
+
+    # number of names per IN clause, below sqlite's limit of 999 parameters
+    _in_chunk_size = 500
+
+    @property
+    def bulk_user_concurrency(self):
+        return self.settings.get('bulk_user_concurrency', 10)
+
+    @gen.coroutine
+    def _run_limited(self, action, users, f):
+        """Call coroutine f(user) for each user, at most bulk_user_concurrency at a time
+
+        action describes f in log messages.
+
+        Returns {user: exception} for the calls that failed.
+        """
+        semaphore = Semaphore(self.bulk_user_concurrency)
+        errors = {}
+
+        @gen.coroutine
+        def run(user):
+            with (yield semaphore.acquire()):
+                try:
+                    yield gen.maybe_future(f(user))
+                except Exception as e:
+                    self.log.error("Failed to %s %s", action, user.name, exc_info=True)
+                    errors[user] = e
+
+        yield [ run(user) for user in users ]
+        return errors
+
+    def _existing_names(self, names):
+        """Return the subset of names that are already users, in as few queries as possible"""
+        existing = set()
+        for i in range(0, len(names), self._in_chunk_size):
+            chunk = names[i:i + self._in_chunk_size]
+            existing.update(name for (name,) in
+                self.db.query(orm.User.name).filter(orm.User.name.in_(chunk)))
+        return existing
+
+    def _normalize_usernames(self, usernames, results):
+        """Normalize and validate usernames
+
+        Every name gets an entry in results, in order,
+        which is None for valid names until their result is known.
+        Returns the list of valid names, without duplicates.
+        """
+        names = []
+        for name in usernames:
+            name = self.authenticator.normalize_username(name)
+            if name in results:
+                continue
+            if not name or not self.authenticator.validate_username(name):
+                results[name] = {'status': 'invalid', 'message': "Invalid username: %s" % name}
+            else:
+                results[name] = None
+                names.append(name)
+        return names
+
+    @gen.coroutine
+    def _add_user(self, user):
+        yield gen.maybe_future(self.authenticator.add_user(user))
+
+    @gen.coroutine
+    def create_users(self, usernames, admin=False):
+        """Create users by name
+
+        Returns an ordered dict of {name: result}.
+        Users that could not be added by the Authenticator are removed again.
+        The results of created users include the id of the job creating their data directories.
+        """
+        results = OrderedDict()
+        names = self._normalize_usernames(usernames, results)
+        existing = self._existing_names(names)
+        for name in names:
+            if name in existing:
+                results[name] = {'status': 'exists'}
+        to_create = [ name for name in names if name not in existing ]
+        if not to_create:
+            return results
+
+        self.log.info("Creating %i users", len(to_create))
+        orm_users = [ orm.User(name=name, admin=admin) for name in to_create ]
+        try:
+            self.db.add_all(orm_users)
+            # flush to get user ids for user_info
+            self.db.flush()
+            self.db.add_all([
+                orm.User_info(user_id=orm_user.id, **orm.User_info.defaults(orm_user.name))
+                for orm_user in orm_users
+            ])
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            self.log.error("Failed to create %i users", len(to_create), exc_info=True)
+            for name in to_create:
+                results[name] = {'status': 'failed', 'message': str(e)}
+            return results
+
+        users = [ self._user_from_orm(orm_user) for orm_user in orm_users ]
+        for user in users:
+            user._bump_model()
+        errors = yield self._run_limited('add user', users, self._add_user)
+        if errors:
+            self.users.delete_users(list(errors))
+        created = [ user for user in users if user not in errors ]
+        job_id = None
+        if created:
+            job = self.job_queue.submit('create_data_dirs', [
+                ['mkdir', '-p', '-m', '777', orm.User_info.defaults(user.name)['data_dir']]
+                for user in created
+            ])
+            job_id = job.id
+        for user in users:
+            if user in errors:
+                results[user.name] = {'status': 'failed', 'message': str(errors[user])}
+            else:
+                results[user.name] = {'status': 'created', 'user': self.user_model(user), 'job': job_id}
+        return results
+
+    @gen.coroutine
+    def _stop_user(self, user):
+        yield self.stop_single_user(user)
+        if user.stop_pending:
+            raise RuntimeError("%s's server is in the process of stopping, please wait." % user.name)
+
+    @gen.coroutine
+    def _delete_user(self, user):
+        yield gen.maybe_future(self.authenticator.delete_user(user))
+
+    @gen.coroutine
+    def delete_users(self, usernames):
+        """Delete users by name, stopping their servers first
+
+        Returns an ordered dict of {name: result}.
+        """
+        results = OrderedDict()
+        current_user = self.get_current_user()
+        to_delete = []
+        for name in self._normalize_usernames(usernames, results):
+            user = self.find_user(name)
+            if user is None:
+                results[name] = {'status': 'not found'}
+            elif user.name == current_user.name:
+                results[name] = {'status': 'failed', 'message': "Cannot delete yourself!"}
+            elif user.stop_pending:
+                results[name] = {'status': 'failed',
+                    'message': "%s's server is in the process of stopping, please wait." % name}
+            else:
+                to_delete.append(user)
+
+        self.log.info("Deleting %i users", len(to_delete))
+        errors = yield self._run_limited('stop server for',
+            [ user for user in to_delete if user.running ], self._stop_user)
+        to_delete = [ user for user in to_delete if user not in errors ]
+        errors.update((yield self._run_limited('delete user', to_delete, self._delete_user)))
+        self.users.delete_users([ user for user in to_delete if user not in errors ])
+        for user, error in errors.items():
+            results[user.name] = {'status': 'failed', 'message': str(error)}
+        for name, result in results.items():
+            if result is None:
+                results[name] = {'status': 'deleted'}
+        return results
+
+
+class UserListAPIHandler(_BulkUserAPIHandler):
+    """List and create users
+
+    GET accepts optional query arguments, all applied in the database:
+
+    - state: 'running', 'pending', or 'inactive'
+    - inactive_since: ISO8601 timestamp, only users with no activity since then
+    - group: only members of this group
+    - admin: 'true' or 'false'
+    - sort: 'id' (default), 'name', or 'last_activity'
+    - limit: maximum number of users to return.
+      If there are more, a `Link: <url>; rel="next"` header
+      gives the url of the next page.
+    - cursor: opaque position of a page, from a previous `next` link
+
+    With `Accept: application/x-ndjson`, all matching users (after cursor, if given)
+    are streamed as one JSON user model per line, including all of their servers.
+    """
+    # number of users to load at a time for NDJSON export
+    export_chunk_size = 1000
+
+    _sort_columns = {
+        'id': orm.User.id,
+        'name': orm.User.name,
+        'last_activity': orm.User.last_activity,
+    }
+
+    def _pending_user_ids(self):
+        """Ids of users with a pending spawn or stop
+
+        Pending is only tracked in memory, on the registered users.
+        """
+        return [ user_id for user_id, user in self.users.items()
+                 if user.spawn_pending or user.stop_pending ]
+
+    def _get_bool_argument(self, name):
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        value = value.lower()
+        if value in {'1', 'true', 'yes'}:
+            return True
+        if value in {'0', 'false', 'no'}:
+            return False
+        raise web.HTTPError(400, "%s must be true or false, not %r" % (name, value))
+
+    def _get_timestamp_argument(self, name):
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        if not value.endswith('Z'):
+            value += 'Z'
+        for fmt in (ISO8601_ms, ISO8601_s):
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise web.HTTPError(400, "%s must be an ISO8601 timestamp, not %r" % (name, value))
+
+    def _encode_cursor(self, sort, user):
+        value = getattr(user, sort)
+        if isinstance(value, datetime):
+            value = value.strftime(ISO8601_ms)
+        cursor = json.dumps([value, user.id]).encode('utf8')
+        return urlsafe_b64encode(cursor).decode('ascii')
+
+    def _decode_cursor(self, sort, cursor):
+        try:
+            value, user_id = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+            if sort == 'last_activity':
+                value = datetime.strptime(value, ISO8601_ms)
+        except Exception:
+            raise web.HTTPError(400, "Invalid cursor: %r" % cursor)
+        return value, user_id
+
+    def user_list_query(self):
+        """Build the filtered query for GET from the request's arguments
+
+        Returns (query, sort). The query is not ordered or paginated.
+        """
+        query = orm.User.listing_query(self.db)
+
+        state = self.get_argument('state', None)
+        if state is not None:
+            pending = self._pending_user_ids()
+            has_server = orm.User.user_to_servers.any()
+            if state == 'pending':
+                query = query.filter(orm.User.id.in_(pending))
+            elif state == 'running':
+                query = query.filter(has_server)
+                if pending:
+                    query = query.filter(~orm.User.id.in_(pending))
+            elif state == 'inactive':
+                query = query.filter(~has_server)
+                if pending:
+                    query = query.filter(~orm.User.id.in_(pending))
+            else:
+                raise web.HTTPError(400, "state must be running, pending, or inactive, not %r" % state)
+
+        inactive_since = self._get_timestamp_argument('inactive_since')
+        if inactive_since is not None:
+            query = query.filter(orm.User.last_activity < inactive_since)
+
+        group = self.get_argument('group', None)
+        if group is not None:
+            query = query.join(orm.User.groups).filter(orm.Group.name == group)
+
+        admin = self._get_bool_argument('admin')
+        if admin is not None:
+            query = query.filter(orm.User.admin == admin)
+
+        sort = self.get_argument('sort', 'id')
+        if sort not in self._sort_columns:
+            raise web.HTTPError(400, "sort must be one of %s, not %r" % (
+                ', '.join(sorted(self._sort_columns)), sort))
+        return query, sort
+
+    def _keyset(self, query, sort, after=None):
+        """Order a user query by `sort`, starting after `(value, user id)`"""
+        column = self._sort_columns[sort]
+        if after is not None:
+            value, user_id = after
+            if sort == 'id':
+                query = query.filter(orm.User.id > user_id)
+            else:
+                query = query.filter(or_(
+                    column > value,
+                    and_(column == value, orm.User.id > user_id),
+                ))
+        if sort == 'id':
+            return query.order_by(orm.User.id)
+        else:
+            return query.order_by(column, orm.User.id)
+
+    def _export_model(self, user):
+        """The user model for NDJSON export, with all of the user's servers"""
+        model = self.user_model(user)
+        model['servers'] = [
+            {
+                'url': server.base_url,
+                'last_activity': server.last_activity.isoformat() if server.last_activity else None,
+            }
+            for server in user.servers
+        ]
+        return model
+
+    @gen.coroutine
+    def _export(self, query, sort, after=None):
+        """Stream users as newline-delimited JSON
+
+        Users are loaded in chunks of `export_chunk_size`,
+        each of which is flushed before loading the next one,
+        so the whole list is never held in memory,
+        and other requests are handled while the response is written.
+
+        Users that aren't loaded are not loaded by the export:
+        their models come from User wrappers that are not registered in `self.users`.
+        """
+        self.set_header('Content-Type', 'application/x-ndjson')
+        while True:
+            orm_users = self._keyset(query, sort, after).limit(self.export_chunk_size).all()
+            for orm_user in orm_users:
+                user_id = _user_id(orm_user)
+                if user_id in self.users:
+                    # loaded users know about pending spawns and stops
+                    user = self.users[user_id]
+                else:
+                    user = User(orm_user, self.settings)
+                self.write(json.dumps(self._export_model(user)) + '\n')
+            if len(orm_users) < self.export_chunk_size:
+                break
+            last = orm_users[-1]
+            after = (getattr(last, sort), last.id)
+            yield self.flush()
+
     @admin_only
+    @gen.coroutine
     def get(self):
-        users = [ self._user_from_orm(u) for u in self.db.query(orm.User) ]
-        data = [ self.user_model(u) for u in users ]
-        self.write(json.dumps(data))
+        export = 'application/x-ndjson' in self.request.headers.get('Accept', '')
+        if not export and self.check_model_etag('user'):
+            return
+        query, sort = self.user_list_query()
+        cursor = self.get_argument('cursor', None)
+        after = None
+        if cursor is not None:
+            after = self._decode_cursor(sort, cursor)
+        if export:
+            yield self._export(query, sort, after)
+            return
+        query = self._keyset(query, sort, after)
+        limit = self.get_argument('limit', None)
+        if limit is not None:
+            if not limit.isdigit() or int(limit) == 0:
+                raise web.HTTPError(400, "limit must be a positive integer, not %r" % limit)
+            limit = int(limit)
+            # get one extra to know if there is a next page
+            orm_users = query.limit(limit + 1).all()
+            if len(orm_users) > limit:
+                orm_users = orm_users[:limit]
+                args = { key: self.get_argument(key) for key in self.request.arguments }
+                args['cursor'] = self._encode_cursor(sort, orm_users[-1])
+                next_url = url_concat(self.request.path, args)
+                self.set_header('Link', '<%s>; rel="next"' % next_url)
+        else:
+            orm_users = query
+        users = [ self._user_from_orm(u) for u in orm_users ]
+        self.write('[%s]' % ', '.join(
+            self.cached_model_json('user', _user_id(u.orm_user), lambda u=u: self.user_model(u))
+            for u in users
+        ))
     
     @admin_only
     @gen.coroutine
     def post(self):
         data = self.get_json_body()
-        self.log.info('add user data', data.get('usernames'))
         if not data or not isinstance(data, dict) or not data.get('usernames'):
             raise web.HTTPError(400, "Must specify at least one user to create")
-        
+
         usernames = data.pop('usernames')
         self._check_user_model(data)
         # admin is set for all users
         # to create admin and non-admin users requires at least two API requests
         admin = data.get('admin', False)
-        
+
         to_create = []
         invalid_names = []
         for name in usernames:
             try:
-                info = pwd.getpwnam(name)
+                info = nss.getpwnam(name)
                 if info is not None:
                     continue
             except KeyError:
@@ -66,56 +450,72 @@ class UserListAPIHandler(APIHandler):
             if not self.authenticator.validate_username(name):
                 invalid_names.append(name)
                 continue
-            user = self.find_user(name)
-            self.log.info(name)
-            if user is not None:
-                self.log.warning("User %s already exists" % name)
-            else:
-                to_create.append(name)
-        
+            to_create.append(name)
+
         if invalid_names:
             if len(invalid_names) == 1:
                 msg = "Invalid username: %s" % invalid_names[0]
             else:
                 msg = "Invalid usernames: %s" % ', '.join(invalid_names)
             raise web.HTTPError(400, msg)
-        
-        if not to_create:
-            raise web.HTTPError(400, "All %i users already exist" % len(usernames))
-        
+
+        results = yield self.create_users(to_create, admin=admin)
         created = []
-        for name in to_create:
-            user = self.user_from_username(name)
-            self.log.info('create: %s', name)
-            if admin:
-                user.admin = True
-                self.db.commit()
-                info = orm.User_info.create(self.db, name)
-                if info is None:
-                    raise web.HTTPError(400, "Failed to create user %s" % (name))
-            try:
-                yield gen.maybe_future(self.authenticator.add_user(user))
+        job_id = None
+        for name, result in results.items():
+            if result['status'] == 'exists':
+                self.log.warning("User %s already exists" % name)
+            elif result['status'] == 'created':
+                created.append(result['user'])
+                job_id = result['job']
+            else:
+                raise web.HTTPError(400, "Failed to create user %s: %s" % (name, result['message']))
 
+        if not created:
+            raise web.HTTPError(400, "All %i users already exist" % len(usernames))
 
-            except Exception as e:
-                self.log.error("Failed to create user: %s" % name, exc_info=True)
-                del self.users[user]
-                raise web.HTTPError(400, "Failed to create user %s: %s" % (name, str(e)))
-            else:
-                info = orm.User_info.create(self.db, name)
-                if info is None:
-                    raise web.HTTPError(400, "Failed to create user %s" % (name))
-                else:
-                    created.append(user)
-            data_dir = info.data_dir
-            if data_dir is None or data_dir == '':
-                self.log.warning('data_dir is empty.')
-            else:
-                cmd = 'mkdir -p -m 777 ' + data_dir
-                if os.system(cmd) != 0 :
-                    raise web.HTTPError(400, "Failed to create data dir %s." % (data_dir))
-        self.write(json.dumps([ self.user_model(u) for u in created ]))
-        self.set_status(201)
+        self.write(json.dumps(created))
+        if job_id is None:
+            self.set_status(201)
+        else:
+            # data directories are still being created
+            self.accept_job(job_id)
+
+
+class BulkUserAPIHandler(_BulkUserAPIHandler):
+    """Create and delete many users at once
+
+    Request bodies are `{"usernames": [...]}`, plus `"admin": bool` to create admins.
+
+    Responses map each (normalized) username to its own result,
+    so that one bad user does not fail the whole request:
+    `{"status": "created"|"deleted"|"exists"|"not found"|"invalid"|"failed"}`,
+    with `"message"` explaining failures and `"user"` the model of created users.
+    """
+
+    def _get_usernames(self, model_types):
+        data = self.get_json_body()
+        if not data or not isinstance(data, dict) or not data.get('usernames'):
+            raise web.HTTPError(400, "Must specify at least one user")
+        usernames = data.pop('usernames')
+        if not isinstance(usernames, list) or not all(isinstance(name, str) for name in usernames):
+            raise web.HTTPError(400, "usernames must be a list of str")
+        self._check_model(data, model_types, 'users')
+        return usernames, data
+
+    @admin_only
+    @gen.coroutine
+    def post(self):
+        usernames, data = self._get_usernames({'admin': bool})
+        results = yield self.create_users(usernames, admin=data.get('admin', False))
+        self.write(json.dumps(results))
+
+    @admin_only
+    @gen.coroutine
+    def delete(self):
+        usernames, data = self._get_usernames({})
+        results = yield self.delete_users(usernames)
+        self.write(json.dumps(results))
 
 
 def admin_or_self(method):
@@ -138,7 +538,10 @@ class UserAPIHandler(APIHandler):
     @admin_or_self
     def get(self, name):
         user = self.find_user(name)
-        self.write(json.dumps(self.user_model(user)))
+        user_id = _user_id(user.orm_user)
+        if self.check_model_etag('user', user_id):
+            return
+        self.write(self.cached_model_json('user', user_id, lambda: self.user_model(user)))
     
     @admin_only
     @gen.coroutine
@@ -205,56 +608,44 @@ class UserAPIHandler(APIHandler):
             # check if the new name is already taken inside db
             if self.find_user(data['name']):
                 raise web.HTTPError(400, "User %s already exists, username must be unique" % data['name'])
-        # for key, value in data.items():
-        #     setattr(user, key, value)
-        setattr(user, 'admin', data['admin'])
-        setattr(user, 'name', data['name'])
+        # look up user_info before renaming, which changes User_info.find
         info = orm.User_info.find(self.db, name)
-        if info is None:
+        if info is None and {'home', 'data', 'shell'}.intersection(data):
             raise web.HTTPError(400, "user: %s not exist in db." % name)
-        self.log.info(info)
-        o_home  = info.home
-        o_data  = info.data_dir
-        o_shell = info.shell
+        # filesystem changes are made by a background job,
+        # which updates user_info when they are done
         cmd = []
-        if o_home != data['home']:
+        user_info = {}
+        if 'home' in data and data['home'] != info.home:
             if exists(data['home']):
                 raise web.HTTPError(500, " %s dir exist, please pich others." % data['home'])
-            else:
-                cmd.append('usermod -md ' + data['home'] + ' ' + name)
-                # self.log.info(cmd)
-                # if os.system(cmd) != 0 :
-                #     raise web.HTTPError(500, " changing home dir to %s failed." % data['home'])
-        self.log.info('%s; %s', o_data, data['data'])
-        if o_data != data['data']:
+            cmd.append(['usermod', '-md', data['home'], name])
+            user_info['home'] = data['home']
+        if 'data' in data and data['data'] != info.data_dir:
             if exists(data['data']):
                 raise web.HTTPError(500, " %s dir exist, please pich others." % data['data'])
-            else :
-                if exists(o_data) == False:
-                    cmd.append('mkdir -p -m 777 ' + data['data'])
-                    # self.log.info('%s', cmd)
-                    # if os.system(cmd) != 0:
-                    #     raise web.HTTPError(500, " create dir %s failed." % data['data'])
-                else:
-                    cmd.append('mv ' + o_data + ' ' + data['data'])
-                    # self.log.info('%s', cmd)
-                    # if os.system(cmd) != 0 :
-                    #     raise web.HTTPError(500, " changing dir %s to %s failed." % o_data, data['data'])
-        if o_shell != data['shell']:
-            if isfile(data['shell']) == False:
-                raise web.HTTPError(500, " %s is not exist, please repick someone." % data['shell'])
+            if not exists(info.data_dir):
+                cmd.append(['mkdir', '-p', '-m', '777', data['data']])
             else:
-                cmd.append('usermod -s ' + data['shell'] + ' ' + name)
-                # self.log.info(cmd)
-                # if os.system(cmd) != 0 :
-                #     raise web.HTTPError(500, " changing shell to %s failed." % data['shell'])
-        for tmp in cmd:
-            if os.system(tmp) != 0 :
-                raise web.HTTPError(500, " exec command %s failed." % tmp)
-        setattr(info, 'home', data['home'])
-        setattr(info, 'data_dir', data['data'])
-        setattr(info, 'shell', data['shell'])
+                cmd.append(['mv', info.data_dir, data['data']])
+            user_info['data_dir'] = data['data']
+        if 'shell' in data and data['shell'] != info.shell:
+            if not isfile(data['shell']):
+                raise web.HTTPError(500, " %s is not exist, please repick someone." % data['shell'])
+            cmd.append(['usermod', '-s', data['shell'], name])
+            user_info['shell'] = data['shell']
+        if 'admin' in data:
+            user.admin = data['admin']
+        if 'name' in data:
+            user.name = data['name']
         self.db.commit()
+        if user.name != name and self.model_cache is not None:
+            # group models list their members by name
+            for group in user.groups:
+                self.model_cache.bump('group', group.name)
+        if cmd:
+            job = self.job_queue.submit('update_user', cmd, user=user.orm_user, user_info=user_info)
+            self.accept_job(job.id)
         self.write(json.dumps(self.user_model(user)))
         
 
@@ -268,8 +659,9 @@ class UserServerAPIHandler(APIHandler):
     def post(self, name):
         user = self.find_user(name)
         if user.running:
-            # include notify, so that a server that died is noticed immediately
-            state = yield user.spawner.poll_and_notify()
+            # include notify, so that a server that died is noticed
+            # (a recent poll finding it running is trusted, see Spawner.poll_cache_ttl)
+            state = yield user.spawner.poll_and_notify(cached=True)
             if state is None:
                 raise web.HTTPError(400, "%s's server is already running" % name)
 
@@ -287,8 +679,9 @@ class UserServerAPIHandler(APIHandler):
             return
         if not user.running:
             raise web.HTTPError(400, "%s's server is not running" % name)
-        # include notify, so that a server that died is noticed immediately
-        status = yield user.spawner.poll_and_notify()
+        # include notify, so that a server that died is noticed
+        # (a recent poll finding it running is trusted, see Spawner.poll_cache_ttl)
+        status = yield user.spawner.poll_and_notify(cached=True)
         if status is not None:
             raise web.HTTPError(400, "%s's server is not running" % name)
         yield self.stop_single_user(user)
@@ -296,6 +689,117 @@ class UserServerAPIHandler(APIHandler):
         self.set_status(status)
 
 
+class UserServerReadyAPIHandler(APIHandler):
+    """Notification from a single-user server that it is up
+
+    Sent by the server once it is listening, with its API token,
+    so that the spawn finishes without waiting for the Hub to check.
+    Only the API token issued to the server for this spawn is accepted,
+    not cookies, the user's other tokens, or admins.
+    """
+    def post(self, name):
+        user = self.find_user(name)
+        token = self.get_auth_token()
+        if (user is None or not token or not user.spawner_loaded
+                or not user.spawner.api_token
+                or not compare_digest(token, user.spawner.api_token)):
+            raise web.HTTPError(403)
+        if user.server_ready():
+            self.log.debug("%s's server says it is ready", name)
+        self.set_status(204)
+
+
+class BulkServerAPIHandler(APIHandler):
+    """Start and stop the servers of many users at once
+
+    Request bodies are `{"users": [...]}` or `{"group": "name"}`.
+
+    Servers are started or stopped in the background,
+    at most `JupyterHub.bulk_server_concurrency` at a time,
+    each counting until its spawn or stop has finished.
+    Spawns wait for admission (see SpawnAdmission) instead of being rejected.
+    Responses are 202 Accepted, with the job tracking progress,
+    whose results map each username to
+    `{"state": "pending"|"done"|"skipped"|"failed"}`,
+    with `"message"` explaining skips and failures.
+    Results are pending until the spawn or stop has finished.
+    """
+
+    @property
+    def bulk_server_concurrency(self):
+        return self.settings.get('bulk_server_concurrency', 10)
+
+    def _get_users(self):
+        data = self.get_json_body()
+        if not data or not isinstance(data, dict):
+            raise web.HTTPError(400, "Must specify users or a group")
+        if 'group' in data:
+            self._check_model(data, {'group': str}, 'servers')
+            group = orm.Group.find(self.db, data['group'])
+            if group is None:
+                raise web.HTTPError(400, "No such group: %s" % data['group'])
+            usernames = group.member_names()
+        else:
+            self._check_model(data, {'users': list}, 'servers')
+            usernames = data.get('users')
+            if not usernames or not all(isinstance(name, str) for name in usernames):
+                raise web.HTTPError(400, "users must be a non-empty list of str")
+        users = []
+        for name in OrderedDict.fromkeys(usernames):
+            user = self.find_user(name)
+            if user is None:
+                raise web.HTTPError(400, "No such user: %s" % name)
+            users.append(user)
+        return users
+
+    @gen.coroutine
+    def _start(self, user):
+        if user.spawn_pending:
+            return {'state': 'skipped', 'message': "Spawn already pending"}
+        if user.running:
+            state = yield user.spawner.poll_and_notify(cached=True)
+            if state is None:
+                return {'state': 'skipped', 'message': "Already running"}
+        if self.spawn_admission is not None:
+            # background spawns wait their turn
+            yield self.spawn_admission.wait(user)
+        spawn = yield self.spawn_single_user(user)
+        if spawn is not None:
+            # keep the concurrency slot until the server is up
+            yield spawn
+
+    @gen.coroutine
+    def _stop(self, user):
+        if user.stop_pending:
+            return {'state': 'skipped', 'message': "Stop already pending"}
+        if not user.running:
+            return {'state': 'skipped', 'message': "Not running"}
+        status = yield user.spawner.poll_and_notify(cached=True)
+        if status is not None:
+            return {'state': 'skipped', 'message': "Not running"}
+        stop = yield self.stop_single_user(user)
+        # keep the concurrency slot until the server has stopped
+        yield stop
+
+    def _run(self, action, f):
+        users = self._get_users()
+        job = self.job_queue.run_tasks(action,
+            [ (user.name, lambda user=user: f(user)) for user in users ],
+            concurrency=self.bulk_server_concurrency,
+            user=self.get_current_user().orm_user,
+        )
+        self.accept_job(job.id)
+        self.write(json.dumps(self.job_model(job)))
+
+    @admin_only
+    def post(self):
+        self._run('start_servers', self._start)
+
+    @admin_only
+    def delete(self):
+        self._run('stop_servers', self._stop)
+
+
 class UserCreateNamedServerAPIHandler(APIHandler):
     """Create a named single-user server
     
@@ -308,8 +812,9 @@ class UserCreateNamedServerAPIHandler(APIHandler):
         if user is None:
             raise web.HTTPError(404, "No such user %r" % name)
         if user.running:
-            # include notify, so that a server that died is noticed immediately
-            state = yield user.spawner.poll_and_notify()
+            # include notify, so that a server that died is noticed
+            # (a recent poll finding it running is trusted, see Spawner.poll_cache_ttl)
+            state = yield user.spawner.poll_and_notify(cached=True)
             if state is None:
                 raise web.HTTPError(400, "%s's server is already running" % name)
 
@@ -335,8 +840,9 @@ class UserDeleteNamedServerAPIHandler(APIHandler):
             return
         if not user.running:
             raise web.HTTPError(400, "%s's server is not running" % name)
-        # include notify, so that a server that died is noticed immediately
-        status = yield user.spawner.poll_and_notify()
+        # include notify, so that a server that died is noticed
+        # (a recent poll finding it running is trusted, see Spawner.poll_cache_ttl)
+        status = yield user.spawner.poll_and_notify(cached=True)
         if status is not None:
             raise web.HTTPError(400, "%s's server is not running" % name)
         yield self.stop_single_user(user)
@@ -395,7 +901,10 @@ default_handlers = [
     (r"/api/user", SelfAPIHandler),
     (r"/api/users", UserListAPIHandler),
     (r"/api/users/([^/]+)", UserAPIHandler),
+    (r"/api/bulk/users", BulkUserAPIHandler),
+    (r"/api/bulk/servers", BulkServerAPIHandler),
     (r"/api/users/([^/]+)/server", UserServerAPIHandler),
+    (r"/api/users/([^/]+)/server/ready", UserServerReadyAPIHandler),
     (r"/api/users/([^/]+)/servers", UserCreateNamedServerAPIHandler),
     (r"/api/users/([^/]+)/servers/([^/]+)", UserDeleteNamedServerAPIHandler),
     (r"/api/users/([^/]+)/admin-access", UserAdminAccessAPIHandler),
@@ -18,6 +18,7 @@ from subprocess import Popen
 import sys
 from textwrap import dedent
 import threading
+import time
 from urllib.parse import urlparse
 
 if sys.version_info[:2] < (3, 3):
@@ -33,6 +34,7 @@ import tornado.options
 from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import app_log, access_log, gen_log
 from tornado import gen, web
+from tornado.locks import Semaphore
 
 from traitlets import (
     Unicode, Integer, Dict, TraitError, List, Bool, Any,
@@ -48,7 +50,7 @@ from . import handlers, apihandlers
 from .handlers.static import CacheControlStaticFilesHandler, LogoHandler
 from .services.service import Service
 
-from . import dbutil, orm
+from . import dbutil, nss, orm
 from .user import User, UserDict
 from .oauth.store import make_provider
 from ._data import DATA_FILES_PATH
@@ -56,7 +58,7 @@ from .log import CoroutineLogFormatter, log_request
 from .proxy import Proxy, ConfigurableHTTPProxy
 from .traitlets import URLPrefix, Command
 from .utils import (
-    url_path_join,
+    url_path_join, digest_token, TokenCache, ModelCache,
     ISO8601_ms, ISO8601_s,
 )
 # classes for config
@@ -66,6 +68,13 @@ from .objects import Hub
 
 # For faking stats
 from .emptyclass import EmptyClass
+from .executor import BlockingExecutor
+from .jobs import JobQueue
+from .admission import SpawnAdmission
+from .zygote import ZygoteLauncher
+from .procwatch import ProcessWatcher
+from .poller import SpawnerPoller
+from .ports import PortAllocator
 
 
 common_aliases = {
@@ -229,6 +238,13 @@ class JupyterHub(Application):
         LocalProcessSpawner,
         Authenticator,
         PAMAuthenticator,
+        BlockingExecutor,
+        JobQueue,
+        SpawnAdmission,
+        ZygoteLauncher,
+        ProcessWatcher,
+        SpawnerPoller,
+        PortAllocator,
     ])
 
     load_groups = Dict(List(Unicode()),
@@ -270,6 +286,15 @@ class JupyterHub(Application):
     service_check_interval = Integer(60,
         help="Interval (in seconds) at which to check connectivity of services with web endpoints."
     ).tag(config=True)
+    idle_user_unload_time = Integer(600,
+        help="""
+        Time (in seconds) after which users without servers, that have not been accessed,
+        are unloaded from memory.
+
+        They are loaded again from the database when they are next accessed.
+        Set to 0 to keep users in memory once they are loaded.
+        """
+    ).tag(config=True)
 
     data_files_path = Unicode(DATA_FILES_PATH,
         help="The location of jupyterhub data files (e.g. /usr/local/share/jupyter/hub)"
@@ -556,6 +581,17 @@ class JupyterHub(Application):
         help="log all database transactions. This has A LOT of output"
     ).tag(config=True)
     session_factory = Any()
+    query_counter = Instance(orm.QueryCounter, allow_none=True)
+
+    executor = Instance(BlockingExecutor, allow_none=True)
+
+    job_queue = Instance(JobQueue, allow_none=True)
+
+    spawn_admission = Instance(SpawnAdmission, allow_none=True)
+
+    spawner_poller = Instance(SpawnerPoller, allow_none=True)
+
+    port_allocator = Instance(PortAllocator, allow_none=True)
 
     users = Instance(UserDict)
 
@@ -564,6 +600,86 @@ class JupyterHub(Application):
         assert self.tornado_settings
         return UserDict(db_factory=lambda: self.db, settings=self.tornado_settings)
 
+    token_cache_size = Integer(10000,
+        help="""Maximum number of verified API and OAuth tokens to keep in memory.
+
+        Tokens are hashed in the database, so checking a token is expensive.
+        Recently verified tokens are remembered (by a keyed digest, never in the clear)
+        to avoid repeating that work on every request.
+
+        Set to 0 to disable the token cache.
+        """
+    ).tag(config=True)
+
+    token_cache_max_age = Integer(300,
+        help="""Time (in seconds) after which a cached verified token must be checked again.
+
+        0 means entries only leave the cache when it is full.
+        """
+    ).tag(config=True)
+
+    token_cache = Instance(TokenCache, allow_none=True)
+
+    @default('token_cache')
+    def _token_cache_default(self):
+        if self.token_cache_size <= 0:
+            return None
+        return TokenCache(
+            max_size=self.token_cache_size,
+            max_age=self.token_cache_max_age,
+            statsd=self.statsd,
+        )
+
+    nss_cache_ttl = Integer(60,
+        help="""Time (in seconds) for which system user and group lookups are cached.
+
+        With users and groups from a directory service (e.g. LDAP via NSS),
+        each lookup can be a network round trip.
+        Group memberships are looked up from one snapshot of all groups,
+        refreshed after this time.
+
+        Set to 0 to disable the cache.
+        """
+    ).tag(config=True)
+
+    nss_cache_negative_ttl = Integer(10,
+        help="""Time (in seconds) for which a user or group that doesn't exist is remembered.
+        """
+    ).tag(config=True)
+
+    model_cache = Instance(ModelCache,
+        help="Versions and serialized REST API models of users and groups, for ETags"
+    )
+
+    @default('model_cache')
+    def _model_cache_default(self):
+        return ModelCache()
+
+    bulk_user_concurrency = Integer(10,
+        help="""Maximum number of users to add or remove concurrently in bulk API requests.
+
+        Limits concurrent calls to `Authenticator.add_user` and `.delete_user`,
+        which may create or remove system users,
+        and concurrent server stops when deleting users.
+        """
+    ).tag(config=True)
+
+    startup_concurrency = Integer(20,
+        help="""Maximum number of users to check concurrently when the Hub starts.
+
+        Limits concurrent calls to `Authenticator.add_user` for users in the database,
+        and the number of servers polled at once to see if they are still running.
+        """
+    ).tag(config=True)
+
+    bulk_server_concurrency = Integer(10,
+        help="""Maximum number of servers to start or stop concurrently in bulk API requests.
+
+        Servers are started and stopped in the background,
+        with progress available from the job API.
+        """
+    ).tag(config=True)
+
     admin_access = Bool(False,
         help="""Grant admin users permission to access single-user servers.
 
@@ -744,6 +860,36 @@ class JupyterHub(Application):
         if os.path.exists(path) and not os.access(path, os.W_OK):
             self.log.error("%s cannot edit %s", user, path)
 
+    def init_executor(self):
+        """Create the shared executor for blocking calls"""
+        # replace any instance created before config was loaded
+        BlockingExecutor.clear_instance()
+        self.executor = BlockingExecutor.instance(parent=self, statsd=self.statsd)
+
+    def init_nss_cache(self):
+        """Configure the cache of system user and group lookups"""
+        nss.cache.ttl = self.nss_cache_ttl
+        nss.cache.negative_ttl = self.nss_cache_negative_ttl
+        nss.cache.statsd = self.statsd
+        nss.cache.clear()
+
+    def init_jobs(self):
+        """Create the queue of background jobs"""
+        self.job_queue = JobQueue(parent=self, db_factory=lambda: self.db, statsd=self.statsd)
+
+    def init_spawner_poller(self):
+        """Create the poller for running spawners"""
+        self.spawner_poller = SpawnerPoller(parent=self, statsd=self.statsd)
+
+    def init_port_allocator(self):
+        """Create the allocator for single-user server ports"""
+        self.port_allocator = PortAllocator(parent=self, statsd=self.statsd)
+
+    def init_spawn_admission(self):
+        """Create the admission control for spawns"""
+        self.spawn_admission = SpawnAdmission(parent=self,
+            db_factory=lambda: self.db, statsd=self.statsd)
+
     def init_secrets(self):
         trait_name = 'cookie_secret'
         trait = self.traits()[trait_name]
@@ -831,6 +977,7 @@ class JupyterHub(Application):
             )
             # trigger constructing thread local db property
             _ = self.db
+            self.query_counter = orm.QueryCounter(self.db.get_bind())
         except OperationalError as e:
             self.log.error("Failed to connect to db: %s", self.db_url)
             self.log.debug("Database error was:", exc_info=True)
@@ -879,14 +1026,14 @@ class JupyterHub(Application):
             self.log.warning("No admin users, admin interface will be unavailable.")
             self.log.warning("Add any administrative users to `c.Authenticator.admin_users` in config.")
 
-        new_users = []
+        # name: User, for users in the db or added to it
+        users = self._find_by_names(orm.User, admin_users)
 
         for name in admin_users:
             # ensure anyone specified as admin in config is admin in db
-            user = orm.User.find(db, name)
+            user = users.get(name)
             if user is None:
-                user = orm.User(name=name, admin=True)
-                new_users.append(user)
+                user = users[name] = orm.User(name=name, admin=True)
                 db.add(user)
             else:
                 user.admin = True
@@ -907,12 +1054,12 @@ class JupyterHub(Application):
             self.log.info("Not using whitelist. Any authenticated user will be allowed.")
 
         # add whitelisted users to the db
+        users.update(self._find_by_names(orm.User,
+            [ name for name in whitelist if name not in users ]))
         for name in whitelist:
-            user = orm.User.find(db, name)
-            if user is None:
-                user = orm.User(name=name)
-                new_users.append(user)
-                db.add(user)
+            if name not in users:
+                users[name] = orm.User(name=name)
+                db.add(users[name])
 
         db.commit()
 
@@ -921,23 +1068,33 @@ class JupyterHub(Application):
         # This lets whitelist be used to set up initial list,
         # but changes to the whitelist can occur in the database,
         # and persist across sessions.
-        for user in db.query(orm.User):
-            try:
-                yield gen.maybe_future(self.authenticator.add_user(user))
-            except Exception:
-                self.log.exception("Error adding user %r already in db", user.name)
-                if self.authenticator.delete_invalid_users:
+        semaphore = Semaphore(self.startup_concurrency)
+        invalid_users = []
+
+        @gen.coroutine
+        def add_user(user):
+            with (yield semaphore.acquire()):
+                try:
+                    yield gen.maybe_future(self.authenticator.add_user(user))
+                except Exception:
+                    self.log.exception("Error adding user %r already in db", user.name)
+                    invalid_users.append(user)
+
+        yield [ add_user(user) for user in db.query(orm.User) ]
+        if invalid_users:
+            if self.authenticator.delete_invalid_users:
+                for user in invalid_users:
                     self.log.warning("Deleting invalid user %r from the Hub database", user.name)
                     db.delete(user)
-                else:
-                    self.log.warning(dedent("""
-                    You can set
-                        c.Authenticator.delete_invalid_users = True
-                    to automatically delete users from the Hub database that no longer pass
-                    Authenticator validation,
-                    such as when user accounts are deleted from the external system
-                    without notifying JupyterHub.
-                    """))
+            else:
+                self.log.warning(dedent("""
+                You can set
+                    c.Authenticator.delete_invalid_users = True
+                to automatically delete users from the Hub database that no longer pass
+                Authenticator validation,
+                such as when user accounts are deleted from the external system
+                without notifying JupyterHub.
+                """))
         db.commit()
 
         # The whitelist set and the users in the db are now the same.
@@ -948,22 +1105,28 @@ class JupyterHub(Application):
     def init_groups(self):
         """Load predefined groups into the database"""
         db = self.db
+        groups = self._find_by_names(orm.Group, list(self.load_groups))
         for name, usernames in self.load_groups.items():
-            group = orm.Group.find(db, name)
+            group = groups.get(name)
             if group is None:
                 group = orm.Group(name=name)
                 db.add(group)
+            names = []
             for username in usernames:
                 username = self.authenticator.normalize_username(username)
                 if not (yield gen.maybe_future(self.authenticator.check_whitelist(username))):
                     raise ValueError("Username %r is not in whitelist" % username)
-                user = orm.User.find(db, name=username)
-                if user is None:
+                if username not in names:
+                    names.append(username)
+            users = self._find_by_names(orm.User, names)
+            for username in names:
+                if username not in users:
                     if not self.authenticator.validate_username(username):
                         raise ValueError("Group username %r is not valid" % username)
-                    user = orm.User(name=username)
-                    db.add(user)
-                group.users.append(user)
+                    users[username] = orm.User(name=username)
+                    db.add(users[username])
+            db.flush()
+            group.add_users(user.id for user in users.values())
         db.commit()
 
     @gen.coroutine
@@ -977,6 +1140,8 @@ class JupyterHub(Application):
             raise ValueError("kind must be user or service, not %r" % kind)
 
         db = self.db
+        # token: owner name
+        owner_names = {}
         for token, name in token_dict.items():
             if kind == 'user':
                 name = self.authenticator.normalize_username(name)
@@ -984,29 +1149,68 @@ class JupyterHub(Application):
                     raise ValueError("Token name %r is not in whitelist" % name)
                 if not self.authenticator.validate_username(name):
                     raise ValueError("Token name %r is not valid" % name)
-            orm_token = orm.APIToken.find(db, token)
-            if orm_token is None:
-                obj = Class.find(db, name)
-                created = False
-                if obj is None:
-                    created = True
-                    self.log.debug("Adding %s %r to database", kind, name)
-                    obj = Class(name=name)
-                    db.add(obj)
-                    db.commit()
-                self.log.info("Adding API token for %s: %s", kind, name)
-                try:
-                    obj.new_api_token(token)
-                except Exception:
-                    if created:
-                        # don't allow bad tokens to create users
-                        db.delete(obj)
-                        db.commit()
-                        raise
+            # check before creating owners, so bad tokens don't create users
+            if len(token) < orm.APIToken.min_length:
+                raise ValueError("Tokens must be at least %i characters, got %r" % (
+                    orm.APIToken.min_length, token)
+                )
+            owner_names[token] = name
+
+        # find tokens already in the db by digest, in one query per 500 tokens
+        digests = { digest_token(token): token for token in owner_names }
+        digest_list = list(digests)
+        existing = set()
+        for i in range(0, len(digest_list), self._in_chunk_size):
+            chunk = digest_list[i:i + self._in_chunk_size]
+            existing.update(digests[digest] for (digest,) in
+                db.query(orm.APIToken.digest).filter(orm.APIToken.digest.in_(chunk)))
+        # rows from before digests can only be checked by hashing,
+        # so only check tokens with a prefix that has such rows
+        legacy_prefixes = { prefix for (prefix,) in
+            db.query(orm.APIToken.prefix).filter(orm.APIToken.digest == None) }
+        for token in owner_names:
+            if token not in existing and token[:orm.APIToken.prefix_length] in legacy_prefixes:
+                if orm.APIToken.find(db, token) is not None:
+                    existing.add(token)
+
+        new_tokens = [ token for token in owner_names if token not in existing ]
+        owners = self._find_by_names(Class, [ owner_names[token] for token in new_tokens ])
+        for token in new_tokens:
+            name = owner_names[token]
+            if name not in owners:
+                self.log.debug("Adding %s %r to database", kind, name)
+                owners[name] = Class(name=name)
+                db.add(owners[name])
+        db.flush()
+        for token in new_tokens:
+            name = owner_names[token]
+            self.log.info("Adding API token for %s: %s", kind, name)
+            orm_token = orm.APIToken(token=token)
+            if kind == 'user':
+                orm_token.user_id = owners[name].id
             else:
-                self.log.debug("Not duplicating token %s", orm_token)
+                orm_token.service_id = owners[name].id
+            db.add(orm_token)
+        if existing:
+            self.log.debug("Not duplicating %i %s tokens already in the database", len(existing), kind)
         db.commit()
 
+    # names per IN clause, below sqlite's limit of 999 parameters
+    _in_chunk_size = 500
+
+    def _find_by_names(self, Class, names):
+        """Return {name: row} for rows of Class (User, Group, Service) with the given names
+
+        in one query per 500 names.
+        """
+        names = list(set(names))
+        found = {}
+        for i in range(0, len(names), self._in_chunk_size):
+            chunk = names[i:i + self._in_chunk_size]
+            found.update((row.name, row) for row in
+                self.db.query(Class).filter(Class.name.in_(chunk)))
+        return found
+
     @gen.coroutine
     def init_api_tokens(self):
         """Load predefined API tokens (for services) into database"""
@@ -1126,16 +1330,30 @@ class JupyterHub(Application):
             yield self.proxy.delete_user(user)
             yield user.stop()
 
-        for orm_user in db.query(orm.User):
+        # only users with servers are loaded,
+        # other users are loaded on first access
+        users = []
+        for orm_user in db.query(orm.User).filter(orm.User.user_to_servers.any()):
             self.users[orm_user.id] = user = User(orm_user, self.tornado_settings)
             self.log.debug("Loading state for %s from db", user.name)
+            users.append(user)
+
+        # poll servers that may still be running, in batches,
+        # with one Spawner.poll_batch call per spawner class per batch
+        spawners = [ user.spawner for user in users if user.server ]
+        statuses = {}
+        for i in range(0, len(spawners), self.startup_concurrency):
+            statuses.update((yield self.spawner_poller.poll(spawners[i:i + self.startup_concurrency])))
+
+        for user in users:
             spawner = user.spawner
             status = 0
             if user.server:
-                try:
-                    status = yield spawner.poll()
-                except Exception:
-                    self.log.exception("Failed to poll spawner for %s, assuming the spawner is not running.", user.name)
+                if spawner in statuses:
+                    status = statuses[spawner]
+                else:
+                    # the error was logged by the poller
+                    self.log.error("Failed to poll spawner for %s, assuming the spawner is not running.", user.name)
                     status = -1
 
             if status is None:
@@ -1157,6 +1375,8 @@ class JupyterHub(Application):
 
         self.log.debug("Loaded users: %s", '\n'.join(user_summaries))
         db.commit()
+        # servers that are still running keep their ports
+        self.port_allocator.load(db)
 
     def init_oauth(self):
         base_url = self.hub.server.base_url
@@ -1237,6 +1457,15 @@ class JupyterHub(Application):
             statsd=self.statsd,
             allow_multiple_servers=self.allow_multiple_servers,
             oauth_provider=self.oauth_provider,
+            token_cache=self.token_cache,
+            query_counter=self.query_counter,
+            model_cache=self.model_cache,
+            job_queue=self.job_queue,
+            spawn_admission=self.spawn_admission,
+            spawner_poller=self.spawner_poller,
+            port_allocator=self.port_allocator,
+            bulk_user_concurrency=self.bulk_user_concurrency,
+            bulk_server_concurrency=self.bulk_server_concurrency,
         )
         # allow configured settings to have priority
         settings.update(self.tornado_settings)
@@ -1274,20 +1503,40 @@ class JupyterHub(Application):
             cfg.JupyterHub.merge(cfg.JupyterHubApp)
             self.update_config(cfg)
         self.write_pid_file()
-        self.init_ports()
-        self.init_secrets()
-        self.init_db()
-        self.init_hub()
-        self.init_proxy()
-        self.init_oauth()
-        yield self.init_users()
-        yield self.init_groups()
-        self.init_services()
-        yield self.init_api_tokens()
-        self.init_tornado_settings()
-        yield self.init_spawners()
-        self.init_handlers()
-        self.init_tornado_application()
+        tic = time.perf_counter()
+        for init in [
+            self.init_executor,
+            self.init_nss_cache,
+            self.init_ports,
+            self.init_secrets,
+            self.init_db,
+            self.init_jobs,
+            self.init_spawn_admission,
+            self.init_spawner_poller,
+            self.init_port_allocator,
+            self.init_hub,
+            self.init_proxy,
+            self.init_oauth,
+            self.init_users,
+            self.init_groups,
+            self.init_services,
+            self.init_api_tokens,
+            self.init_tornado_settings,
+            self.init_spawners,
+            self.init_handlers,
+            self.init_tornado_application,
+        ]:
+            yield self._timed_init(init)
+        self.log.info("Initialized in %.3fs", time.perf_counter() - tic)
+
+    @gen.coroutine
+    def _timed_init(self, init):
+        """Run one phase of initialize, logging and reporting how long it took"""
+        tic = time.perf_counter()
+        yield gen.maybe_future(init())
+        elapsed = time.perf_counter() - tic
+        self.log.debug("%s took %.3fs", init.__name__, elapsed)
+        self.statsd.timing('init.%s' % init.__name__, elapsed * 1000)
 
     @gen.coroutine
     def cleanup(self):
@@ -1305,7 +1554,7 @@ class JupyterHub(Application):
             self.log.info("Cleaning up single-user servers...")
             # request (async) process termination
             for uid, user in self.users.items():
-                if user.spawner is not None:
+                if user.spawner_loaded:
                     futures.append(user.stop())
         else:
             self.log.info("Leaving single-user servers running")
@@ -1328,6 +1577,24 @@ class JupyterHub(Application):
 
         self.db.commit()
 
+        if self.job_queue is not None:
+            self.job_queue.stop()
+
+        if self.spawner_poller is not None:
+            self.spawner_poller.stop()
+
+        # don't wait for blocking calls that may never return
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            BlockingExecutor.clear_instance()
+
+        if ZygoteLauncher.initialized():
+            ZygoteLauncher.instance().stop()
+            ZygoteLauncher.clear_instance()
+        if ProcessWatcher.initialized():
+            ProcessWatcher.instance().stop()
+            ProcessWatcher.clear_instance()
+
         if self.pid_file and os.path.exists(self.pid_file):
             self.log.info("Cleaning up PID file %s", self.pid_file)
             os.remove(self.pid_file)
@@ -1399,6 +1666,13 @@ class JupyterHub(Application):
         self.db.commit()
         yield self.proxy.check_routes(self.users, self._service_map, routes)
 
+    def unload_idle_users(self):
+        """Unload users without servers that have not been accessed recently"""
+        evicted = self.users.evict_idle(self.idle_user_unload_time)
+        if evicted:
+            self.log.debug("Unloaded %i idle users", evicted)
+        self.statsd.gauge('users.loaded', len(self.users))
+
     @gen.coroutine
     def start(self):
         """Start the whole thing"""
@@ -1475,6 +1749,14 @@ class JupyterHub(Application):
             pc = PeriodicCallback(self.update_last_activity, 1e3 * self.last_activity_interval)
             pc.start()
 
+        if self.idle_user_unload_time:
+            interval = min(60, self.idle_user_unload_time)
+            pc = PeriodicCallback(self.unload_idle_users, 1e3 * interval)
+            pc.start()
+
+        self.job_queue.start()
+        self.spawner_poller.start()
+
         self.log.info("JupyterHub is now running at %s", self.proxy.public_url)
         # register cleanup on both TERM and INT
         atexit.register(self.atexit)
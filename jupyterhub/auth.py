@@ -3,9 +3,7 @@
 # Copyright (c) IPython Development Team.
 # Distributed under the terms of the Modified BSD License.
 
-from grp import getgrnam
 import pipes
-import pwd
 import re
 from shutil import which
 import sys
@@ -23,6 +21,9 @@ except Exception as e:
 from traitlets.config import LoggingConfigurable
 from traitlets import Bool, Set, Unicode, Dict, Any, default, observe
 
+from . import nss
+from .executor import BlockingExecutor
+from .nss import getgrnam, getpwnam
 from .handlers.login import LoginHandler
 from .utils import url_path_join
 from .traitlets import Command
@@ -447,16 +448,19 @@ class LocalAuthenticator(Authenticator):
     def system_user_exists(user):
         """Check if the user exists on the system"""
         try:
-            pwd.getpwnam(user.name)
+            getpwnam(user.name)
         except KeyError:
             return False
         else:
             return True
 
+    @gen.coroutine
     def add_system_user(self, user):
         """Create a new local UNIX user on the system.
 
         Tested to work on FreeBSD and Linux, at least.
+
+        The command is waited for on the shared BlockingExecutor.
         """
         name = user.name
         pwd = crypt.crypt('deeplearn', 'jion')
@@ -464,7 +468,9 @@ class LocalAuthenticator(Authenticator):
         self.log.info("Creating user: %s", ' '.join(map(pipes.quote, cmd)))
         print("Creating user: ".join(cmd))
         p = Popen(cmd, stdout=PIPE, stderr=STDOUT)
-        p.wait()
+        yield BlockingExecutor.instance().run('system', p.wait)
+        # don't remember that the user didn't exist
+        nss.cache.forget_user(name)
         if p.returncode:
             err = p.stdout.read().decode('utf8', 'replace')
             raise RuntimeError("Failed to create system user %s: %s" % (name, err))
@@ -511,7 +517,9 @@ class PAMAuthenticator(LocalAuthenticator):
         """
         username = data['username']
         try:
-            pamela.authenticate(username, data['password'], service=self.service)
+            yield BlockingExecutor.instance().run('pam',
+                pamela.authenticate, username, data['password'], service=self.service,
+            )
         except pamela.PAMError as e:
             if handler is not None:
                 self.log.warning("PAM Authentication failed (%s@%s): %s", username, handler.request.remote_ip, e)
@@ -520,23 +528,29 @@ class PAMAuthenticator(LocalAuthenticator):
         else:
             return username
 
+    @gen.coroutine
     def pre_spawn_start(self, user, spawner):
         """Open PAM session for user if so configured"""
         if not self.open_sessions:
             return
         try:
-            pamela.open_session(user.name, service=self.service)
+            yield BlockingExecutor.instance().run('pam',
+                pamela.open_session, user.name, service=self.service,
+            )
         except pamela.PAMError as e:
             self.log.warning("Failed to open PAM session for %s: %s", user.name, e)
             self.log.warning("Disabling PAM sessions from now on.")
             self.open_sessions = False
 
+    @gen.coroutine
     def post_spawn_stop(self, user, spawner):
         """Close PAM session for user if we were configured to opened one"""
         if not self.open_sessions:
             return
         try:
-            pamela.close_session(user.name, service=self.service)
+            yield BlockingExecutor.instance().run('pam',
+                pamela.close_session, user.name, service=self.service,
+            )
         except pamela.PAMError as e:
             self.log.warning("Failed to close PAM session for %s: %s", user.name, e)
             self.log.warning("Disabling PAM sessions from now on.")
@@ -0,0 +1,145 @@
+"""A shared, bounded executor for blocking calls
+
+Some calls the Hub makes can block for a long time
+(PAM conversations, creating system users).
+Running them on the IOLoop thread stalls every other request,
+so they are run on a shared thread pool instead.
+
+Each call has a *kind* (e.g. 'pam'), and each kind has its own concurrency limit,
+so one slow backend can only occupy a bounded number of threads.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from tornado import gen
+from tornado.locks import Semaphore
+
+from traitlets.config import SingletonConfigurable
+from traitlets import Any, Dict, Instance, Integer, default
+
+from .emptyclass import EmptyClass
+
+
+class BlockingExecutor(SingletonConfigurable):
+    """Run blocking functions on a thread pool, with per-kind concurrency limits
+
+    Use the shared instance::
+
+        result = yield BlockingExecutor.instance().run('pam', f, *args)
+
+    Calls beyond the limit for their kind wait in a queue,
+    without holding a thread.
+
+    Metrics, sent to statsd as `executor.<kind>.*` and available in `.stats`:
+
+    - queued: calls waiting for their kind's limit (gauge)
+    - running: calls running on the pool (gauge)
+    - wait: time spent waiting in the queue (timer, ms)
+    - duration: time spent running (timer, ms)
+    """
+
+    max_workers = Integer(16,
+        help="""
+        Maximum number of threads for running blocking calls.
+
+        Shared by all kinds of calls, each of which is limited
+        by `concurrency_limits`.
+        """
+    ).tag(config=True)
+
+    concurrency_limits = Dict(
+        {
+            'pam': 4,
+            'system': 2,
+        },
+        help="""
+        Maximum number of concurrent calls, by kind.
+
+        Kinds used by JupyterHub:
+
+        - pam: PAM authentication and sessions
+        - system: creating system users
+
+        Kinds that are not listed here are limited by `default_concurrency_limit`.
+        Keep limits below `max_workers`, so that no single kind can occupy the whole pool.
+        """
+    ).tag(config=True)
+
+    default_concurrency_limit = Integer(4,
+        help="""
+        Maximum number of concurrent calls for kinds not in `concurrency_limits`.
+        """
+    ).tag(config=True)
+
+    statsd = Any(allow_none=False, help="The statsd client, if any.")
+
+    @default('statsd')
+    def _statsd_default(self):
+        return EmptyClass()
+
+    executor = Instance(ThreadPoolExecutor)
+
+    @default('executor')
+    def _executor_default(self):
+        return ThreadPoolExecutor(self.max_workers)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._semaphores = {}
+        self.stats = {}
+
+    def limit(self, kind):
+        """Return the concurrency limit for a kind of call"""
+        return self.concurrency_limits.get(kind, self.default_concurrency_limit)
+
+    def _kind_stats(self, kind):
+        if kind not in self.stats:
+            self.stats[kind] = {
+                'queued': 0,
+                'running': 0,
+                'completed': 0,
+            }
+            self._semaphores[kind] = Semaphore(self.limit(kind))
+        return self.stats[kind]
+
+    def _gauge(self, kind, stats):
+        self.statsd.gauge('executor.%s.queued' % kind, stats['queued'])
+        self.statsd.gauge('executor.%s.running' % kind, stats['running'])
+
+    @gen.coroutine
+    def run(self, kind, f, *args, **kwargs):
+        """Run f(*args, **kwargs) on the pool, limited by kind.
+
+        Returns a Future, resolved with the result of the call.
+        """
+        stats = self._kind_stats(kind)
+        semaphore = self._semaphores[kind]
+        stats['queued'] += 1
+        self._gauge(kind, stats)
+        tic = time.perf_counter()
+        try:
+            yield semaphore.acquire()
+        finally:
+            stats['queued'] -= 1
+        try:
+            toc = time.perf_counter()
+            self.statsd.timing('executor.%s.wait' % kind, (toc - tic) * 1000)
+            stats['running'] += 1
+            self._gauge(kind, stats)
+            result = yield self.executor.submit(f, *args, **kwargs)
+        finally:
+            stats['running'] -= 1
+            stats['completed'] += 1
+            semaphore.release()
+            self._gauge(kind, stats)
+            self.statsd.timing('executor.%s.duration' % kind,
+                (time.perf_counter() - toc) * 1000)
+        return result
+
+    def shutdown(self, wait=True):
+        """Shutdown the thread pool"""
+        self.executor.shutdown(wait=wait)
@@ -92,6 +92,42 @@ class BaseHandler(RequestHandler):
     def oauth_provider(self):
         return self.settings['oauth_provider']
 
+    @property
+    def token_cache(self):
+        return self.settings.get('token_cache')
+
+    @property
+    def query_counter(self):
+        return self.settings.get('query_counter')
+
+    @property
+    def model_cache(self):
+        return self.settings.get('model_cache')
+
+    @property
+    def job_queue(self):
+        return self.settings.get('job_queue')
+
+    @property
+    def spawn_admission(self):
+        return self.settings.get('spawn_admission')
+
+    _request_stats = None
+
+    @property
+    def request_stats(self):
+        """Counters of the work done for this request
+
+        - auth: number of times the current user was resolved
+        - auth_queries: number of db queries made while resolving the current user
+        """
+        if self._request_stats is None:
+            self._request_stats = {
+                'auth': 0,
+                'auth_queries': 0,
+            }
+        return self._request_stats
+
     def finish(self, *args, **kwargs):
         """Roll back any uncommitted transactions from the handler."""
         self.db.rollback()
@@ -161,7 +197,7 @@ class BaseHandler(RequestHandler):
         token = self.get_auth_token()
         if token is None:
             return None
-        orm_token = orm.OAuthAccessToken.find(self.db, token)
+        orm_token = orm.OAuthAccessToken.find(self.db, token, cache=self.token_cache)
         if orm_token is None:
             return None
         else:
@@ -173,7 +209,7 @@ class BaseHandler(RequestHandler):
         self.log.info("token: %s."%(token))
         if token is None:
             return None
-        orm_token = orm.APIToken.find(self.db, token)
+        orm_token = orm.APIToken.find(self.db, token, cache=self.token_cache)
         if orm_token is None:
             return None
         else:
@@ -195,8 +231,7 @@ class BaseHandler(RequestHandler):
                 clear()
             return
         cookie_id = cookie_id.decode('utf8', 'replace')
-        u = self.db.query(orm.User).filter(orm.User.cookie_id==cookie_id).first()
-        user = self._user_from_orm(u)
+        user = self.users.find_by_cookie_id(cookie_id)
         if user is None:
             self.log.warning("Invalid cookie token")
             # have cookie, but it's not valid. Clear it and start over.
@@ -207,10 +242,6 @@ class BaseHandler(RequestHandler):
         """return User wrapper from orm.User object"""
         if orm_user is None:
             return
-        # self.log.error('orm_user:', orm_user)
-        # for key in self.users:
-        #     self.log.info("users: %s", self.users[key])
-        self.log.info("user:%s; value: %s.", orm_user, self.users[orm_user])
         return self.users[orm_user]
 
     def get_current_user_cookie(self):
@@ -218,19 +249,34 @@ class BaseHandler(RequestHandler):
         return self._user_for_cookie(self.hub.cookie_name)
 
     def get_current_user(self):
-        """get current username"""
-        user = self.get_current_user_token()
-        if user is not None:
-            return user
-        return self.get_current_user_cookie()
+        """get current user
+
+        The user is resolved once per request,
+        and shared by the handler, templates, and the request log.
+        """
+        # _current_user is also where tornado's current_user property stores it
+        if hasattr(self, '_current_user'):
+            return self._current_user
+        counter = self.query_counter
+        if counter is not None:
+            queries_before = counter.count
+        self.request_stats['auth'] += 1
+        try:
+            user = self.get_current_user_token()
+            if user is None:
+                user = self.get_current_user_cookie()
+        finally:
+            if counter is not None:
+                self.request_stats['auth_queries'] += counter.count - queries_before
+        self._current_user = user
+        return user
 
     def find_user(self, name):
         """Get a user by name
 
         return None if no such user
         """
-        orm_user = orm.User.find(db=self.db, name=name)
-        return self._user_from_orm(orm_user)
+        return self.users.find_by_name(name)
 
     def user_from_username(self, username):
         """Get User for username, creating if it doesn't exist"""
@@ -241,6 +287,7 @@ class BaseHandler(RequestHandler):
             self.db.add(u)
             self.db.commit()
             user = self._user_from_orm(u)
+            user._bump_model()
             # self.log.error('user:', user)
             self.authenticator.add_user(user)
         return user
@@ -325,13 +372,52 @@ class BaseHandler(RequestHandler):
     def spawner_class(self):
         return self.settings.get('spawner_class', LocalProcessSpawner)
 
+    # whether spawns that are not admitted right away wait in the queue (True)
+    # or are rejected with 429 Too Many Requests (False)
+    queue_spawns = True
+
+    def spawn_queue_position(self, user):
+        """Return user's position in the queue of spawns, or None if not queued"""
+        if self.spawn_admission is None:
+            return None
+        return self.spawn_admission.position(user)
+
+    @gen.coroutine
+    def _spawn_when_admitted(self, user, admitted, options=None):
+        yield admitted
+        try:
+            yield self.spawn_single_user(user, options=options)
+        except Exception:
+            self.log.error("Failed to start queued server for %s", user.name, exc_info=True)
+            # the spawn may have failed before starting (e.g. one was already pending),
+            # in which case nothing else releases its admission
+            self.spawn_admission.release(user)
+
     @gen.coroutine
     def spawn_single_user(self, user, options=None):
-        if user.spawn_pending:
+        """Spawn a user's server, waiting up to `slow_spawn_timeout` for it
+
+        Returns the Future of `user.spawn()`, which may still be pending,
+        or None if the spawn is waiting in the admission queue.
+        """
+        if user.spawn_pending or self.spawn_queue_position(user):
             raise RuntimeError("Spawn already pending for: %s" % user.name)
+        admission = self.spawn_admission
+        if admission is not None and not admission.admit(user):
+            if not self.queue_spawns:
+                e = web.HTTPError(429, "Too many servers are starting, try again later")
+                e.retry_after = admission.retry_after
+                raise e
+            # wait in line without holding up the request,
+            # which can show the position in the queue
+            admitted = admission.wait(user)
+            IOLoop.current().add_callback(self._spawn_when_admitted, user, admitted, options)
+            return
         tic = IOLoop.current().time()
 
         f = user.spawn(options)
+        if admission is not None:
+            f.add_done_callback(lambda f: admission.release(user))
 
         @gen.coroutine
         def finish_user_spawn(f=None):
@@ -379,6 +465,7 @@ class BaseHandler(RequestHandler):
                     raise web.HTTPError(500, "Spawner failed to start [status=%s]" % status)
         else:
             yield finish_user_spawn()
+        return f
 
     @gen.coroutine
     def user_stopped(self, user):
@@ -394,6 +481,10 @@ class BaseHandler(RequestHandler):
 
     @gen.coroutine
     def stop_single_user(self, user):
+        """Stop a user's server, waiting up to `slow_stop_timeout` for it
+
+        Returns the Future of `user.stop()`, which may still be pending.
+        """
         if user.stop_pending:
             raise RuntimeError("Stop already pending for: %s" % user.name)
         tic = IOLoop.current().time()
@@ -424,6 +515,7 @@ class BaseHandler(RequestHandler):
                 raise
         else:
             yield finish_stop()
+        return f
 
     #---------------------------------------------------------------
     # template rendering
@@ -543,10 +635,14 @@ class UserSpawnHandler(BaseHandler):
 
             # logged in as correct user, spawn the server
             if current_user.spawner:
-                if current_user.spawn_pending:
-                    # spawn has started, but not finished
+                queue_position = self.spawn_queue_position(current_user)
+                if current_user.spawn_pending or queue_position:
+                    # spawn has started (or is waiting to start), but not finished
                     self.statsd.incr('redirects.user_spawn_pending', 1)
-                    html = self.render_template("spawn_pending.html", user=current_user)
+                    html = self.render_template("spawn_pending.html",
+                        user=current_user,
+                        queue_position=queue_position,
+                    )
                     self.finish(html)
                     return
 
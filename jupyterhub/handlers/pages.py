@@ -66,7 +66,7 @@ class HomeHandler(BaseHandler):
         user = self.get_current_user()
         if user.running:
             # trigger poll_and_notify event in case of a server that died
-            yield user.spawner.poll_and_notify()
+            yield user.spawner.poll_and_notify(cached=True)
         html = self.render_template('home.html',
             user=user,
             url=user.url,
@@ -180,7 +180,7 @@ class AdminHandler(BaseHandler):
         # get User.col.desc() order objects
         ordered = [ getattr(c, o)() for c, o in zip(cols, orders) ]
 
-        users = self.db.query(orm.User).order_by(*ordered)
+        users = orm.User.listing_query(self.db).order_by(*ordered)
         users = [ self._user_from_orm(u) for u in users ]
         running = [ u for u in users if u.running ]
 
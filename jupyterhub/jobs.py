@@ -0,0 +1,259 @@
+"""A persistent queue of background jobs
+
+Creating, moving and changing users' directories can take a long time
+(moving a large data directory can take minutes).
+Instead of running these commands in request handlers,
+handlers submit a job, recorded in the database,
+and respond right away with the job's id.
+
+Jobs are run by a fixed number of workers on the IOLoop,
+each running one command at a time in a subprocess,
+so no filesystem work ever blocks the Hub.
+
+Jobs can also track coroutines run by the Hub itself,
+such as spawning many servers at once, with a result for each.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from datetime import datetime
+import pipes
+from subprocess import STDOUT
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+from tornado.process import Subprocess
+from tornado.queues import Queue
+
+from traitlets.config import LoggingConfigurable
+from traitlets import Any, Integer, default
+
+from . import orm
+from .emptyclass import EmptyClass
+
+
+class JobQueue(LoggingConfigurable):
+    """Run jobs of commands in the background
+
+    Submit a job with a list of commands (each a list of arguments)::
+
+        job = job_queue.submit('create_dirs', [['mkdir', '-p', path]])
+
+    Commands run in order, and the job fails at the first command that fails.
+    Progress is stored in the database after each command.
+
+    Jobs that are still pending when the Hub starts are run again.
+    Jobs that were running when the Hub stopped are marked as failed,
+    because it is not known how far their last command got.
+
+    `run_tasks` runs coroutines instead of commands, with a result for each.
+
+    Metrics, sent to statsd:
+
+    - jobs.queued: jobs waiting for a worker (gauge)
+    - jobs.<action>.duration: time spent running a job (timer, ms)
+    """
+
+    concurrency = Integer(4,
+        help="""
+        Maximum number of jobs to run at the same time.
+
+        Each job runs one command at a time.
+        """
+    ).tag(config=True)
+
+    db_factory = Any(help="Callable returning the database session")
+
+    statsd = Any(allow_none=False, help="The statsd client, if any.")
+
+    @default('statsd')
+    def _statsd_default(self):
+        return EmptyClass()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._queue = Queue()
+        self._workers = []
+
+    @property
+    def db(self):
+        return self.db_factory()
+
+    def start(self):
+        """Start the workers, queueing jobs left over from a previous run"""
+        db = self.db
+        now = datetime.utcnow()
+        for job in db.query(orm.Job).filter(orm.Job.state == 'running'):
+            self.log.warning("Job %s was interrupted by shutdown", job.id)
+            job.state = 'failed'
+            job.message = "Interrupted by Hub shutdown"
+            job.finished = now
+        db.commit()
+        for job in db.query(orm.Job).filter(orm.Job.state == 'pending').order_by(orm.Job.id):
+            self.log.info("Resuming job %s", job.id)
+            self._queue.put_nowait(job.id)
+        for i in range(self.concurrency):
+            self._workers.append(self._work())
+
+    def stop(self):
+        """Stop the workers once they are done with their current job
+
+        Jobs that are not started yet stay pending, and resume at the next start.
+        """
+        for worker in self._workers:
+            self._queue.put_nowait(None)
+        self._workers = []
+
+    def submit(self, action, commands, user=None, **spec):
+        """Submit a job running commands, returning the orm.Job
+
+        Extra keyword arguments are stored in the job's spec.
+        """
+        db = self.db
+        spec['commands'] = commands
+        job = orm.Job(
+            action=action,
+            user=user,
+            spec=spec,
+            total=len(commands),
+        )
+        db.add(job)
+        db.commit()
+        self.log.info("Submitted job %s (%s) with %i commands", job.id, action, job.total)
+        self._queue.put_nowait(job.id)
+        self.statsd.gauge('jobs.queued', self._queue.qsize())
+        return job
+
+    def run_tasks(self, action, tasks, concurrency, user=None):
+        """Run tasks in the background, at most `concurrency` at a time, as a job
+
+        tasks is a list of (name, f), where f() returns a Future.
+        The Future may resolve to a dict, which is added to the task's result.
+        Each task's result is recorded in job.results[name] when it finishes,
+        with state 'done' or 'failed' (and the error message) by default.
+
+        Returns the orm.Job, which is running.
+        """
+        db = self.db
+        job = orm.Job(
+            action=action,
+            user=user,
+            state='running',
+            spec={'tasks': [ name for name, f in tasks ]},
+            total=len(tasks),
+            results={ name: {'state': 'pending'} for name, f in tasks },
+            started=datetime.utcnow(),
+        )
+        db.add(job)
+        db.commit()
+        self.log.info("Started job %s (%s) with %i tasks", job.id, action, job.total)
+        IOLoop.current().add_callback(self._run_tasks, job.id, tasks, concurrency)
+        return job
+
+    @gen.coroutine
+    def _run_tasks(self, job_id, tasks, concurrency):
+        semaphore = Semaphore(concurrency)
+        tic = time.perf_counter()
+        failed = []
+
+        @gen.coroutine
+        def run(name, f):
+            with (yield semaphore.acquire()):
+                result = {'state': 'done'}
+                try:
+                    result.update((yield f()) or {})
+                except Exception as e:
+                    self.log.error("Task %s of job %s failed", name, job_id, exc_info=True)
+                    failed.append(name)
+                    result = {'state': 'failed', 'message': str(e)}
+            job = self.db.query(orm.Job).filter(orm.Job.id == job_id).one()
+            # JSON columns are only saved when assigned
+            job.results = dict(job.results, **{name: result})
+            job.progress += 1
+            self.db.commit()
+
+        yield [ run(name, f) for name, f in tasks ]
+        job = self.db.query(orm.Job).filter(orm.Job.id == job_id).one()
+        job.state = 'done'
+        if failed:
+            job.message = "%i of %i tasks failed" % (len(failed), len(tasks))
+        job.finished = datetime.utcnow()
+        self.db.commit()
+        self.statsd.timing('jobs.%s.duration' % job.action, (time.perf_counter() - tic) * 1000)
+
+    @gen.coroutine
+    def _work(self):
+        while True:
+            job_id = yield self._queue.get()
+            self.statsd.gauge('jobs.queued', self._queue.qsize())
+            if job_id is None:
+                return
+            try:
+                yield self.run_job(job_id)
+            except Exception:
+                self.log.error("Error running job %s", job_id, exc_info=True)
+
+    @gen.coroutine
+    def run_command(self, cmd):
+        """Run one command in a subprocess
+
+        Raises RuntimeError with the command's output if it fails.
+        """
+        self.log.info("Running %s", ' '.join(map(pipes.quote, cmd)))
+        p = Subprocess(cmd, stdout=Subprocess.STREAM, stderr=STDOUT)
+        output = yield p.stdout.read_until_close()
+        status = yield p.wait_for_exit(raise_error=False)
+        if status:
+            raise RuntimeError("%s exited with status %i: %s" % (
+                ' '.join(map(pipes.quote, cmd)), status,
+                output.decode('utf8', 'replace').strip(),
+            ))
+
+    def finish_job(self, job):
+        """Apply the results of a job whose commands all succeeded
+
+        Sets the fields of the job's user's user_info given in spec['user_info'].
+        Does not commit.
+        """
+        user_info = job.spec.get('user_info')
+        if user_info and job.user is not None:
+            info = self.db.query(orm.User_info).filter(
+                orm.User_info.user_id == job.user_id).first()
+            if info is None:
+                info = orm.User_info(user_id=job.user_id)
+                self.db.add(info)
+            for key, value in user_info.items():
+                setattr(info, key, value)
+
+    @gen.coroutine
+    def run_job(self, job_id):
+        """Run a pending job's remaining commands"""
+        db = self.db
+        job = db.query(orm.Job).filter(orm.Job.id == job_id).first()
+        if job is None or job.state != 'pending':
+            return
+        job.state = 'running'
+        job.started = datetime.utcnow()
+        db.commit()
+        tic = time.perf_counter()
+        try:
+            for cmd in job.spec['commands'][job.progress:]:
+                yield self.run_command(cmd)
+                job.progress += 1
+                db.commit()
+            self.finish_job(job)
+        except Exception as e:
+            self.log.error("Job %s failed: %s", job.id, e)
+            # the session is shared with the rest of the Hub,
+            # so don't roll back changes made elsewhere, only reload the job
+            db.expire(job)
+            job.state = 'failed'
+            job.message = str(e)
+        else:
+            job.state = 'done'
+        job.finished = datetime.utcnow()
+        db.commit()
+        self.statsd.timing('jobs.%s.duration' % job.action, (time.perf_counter() - tic) * 1000)
@@ -0,0 +1,158 @@
+"""Cached passwd and group lookups
+
+With users and groups from a directory service (e.g. LDAP via NSS),
+each `pwd.getpwnam` or `grp.getgrnam` can be a network round trip,
+and `grp.getgrall` enumerates every group in the directory.
+
+The functions here are drop-in replacements that cache results for `ttl` seconds,
+and missing users or groups for `negative_ttl` seconds.
+Group memberships come from one `getgrall` snapshot,
+indexed by member, instead of enumerating all groups for each user.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from collections import Counter, defaultdict
+import grp
+import pwd
+import time
+
+
+class NSSCache(object):
+    """TTL cache of passwd and group lookups
+
+    Hits and misses are counted for each kind of lookup
+    ('passwd', 'group', 'getgrall') in `hits` and `misses`,
+    and sent to statsd as nss_cache.<kind>.hit|miss if there is a statsd client.
+
+    A ttl of 0 disables caching.
+    """
+
+    def __init__(self, ttl=60, negative_ttl=10, statsd=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.statsd = statsd
+        self.hits = Counter()
+        self.misses = Counter()
+        # kind: {name: (entry or None, expiry)}
+        self._entries = defaultdict(dict)
+        # (groups, groups by name, gids by member name), expiry
+        self._snapshot = None
+        self._snapshot_expiry = 0
+
+    def _count(self, kind, hit):
+        if hit:
+            self.hits[kind] += 1
+        else:
+            self.misses[kind] += 1
+        if self.statsd is not None:
+            self.statsd.incr('nss_cache.%s.%s' % (kind, 'hit' if hit else 'miss'))
+
+    def _lookup(self, kind, name, fetch):
+        entries = self._entries[kind]
+        now = time.monotonic()
+        cached = entries.get(name)
+        if cached is not None and cached[1] > now:
+            self._count(kind, True)
+            entry = cached[0]
+        else:
+            self._count(kind, False)
+            try:
+                entry = fetch(name)
+            except KeyError:
+                entry = None
+            ttl = self.ttl if entry is not None else self.negative_ttl
+            if self.ttl > 0 and ttl > 0:
+                entries[name] = (entry, now + ttl)
+            else:
+                entries.pop(name, None)
+        if entry is None:
+            raise KeyError("%s not found: %r" % (kind, name))
+        return entry
+
+    def _groups(self):
+        """Return the snapshot of all groups, refreshed when it has expired"""
+        now = time.monotonic()
+        if self._snapshot is not None and self._snapshot_expiry > now:
+            self._count('getgrall', True)
+            return self._snapshot
+        self._count('getgrall', False)
+        groups = grp.getgrall()
+        by_name = {}
+        by_member = defaultdict(list)
+        for group in groups:
+            by_name[group.gr_name] = group
+            for member in group.gr_mem:
+                by_member[member].append(group.gr_gid)
+        snapshot = (groups, by_name, dict(by_member))
+        if self.ttl > 0:
+            self._snapshot = snapshot
+            self._snapshot_expiry = now + self.ttl
+        return snapshot
+
+    def getpwnam(self, name):
+        """pwd.getpwnam, cached"""
+        return self._lookup('passwd', name, pwd.getpwnam)
+
+    def getgrnam(self, name):
+        """grp.getgrnam, cached
+
+        Answered from the getgrall snapshot, if there is one.
+        """
+        if self._snapshot is not None and self._snapshot_expiry > time.monotonic():
+            group = self._snapshot[1].get(name)
+            self._count('group', True)
+            if group is None:
+                raise KeyError("group not found: %r" % name)
+            return group
+        return self._lookup('group', name, grp.getgrnam)
+
+    def getgrall(self):
+        """grp.getgrall, cached"""
+        return list(self._groups()[0])
+
+    def user_gids(self, name):
+        """The gids of the groups that list a user as a member
+
+        (supplementary groups, not including the user's primary group).
+        """
+        return list(self._groups()[2].get(name, []))
+
+    def forget_user(self, name):
+        """Forget what is cached about a user, e.g. after creating it"""
+        self._entries['passwd'].pop(name, None)
+        self._snapshot = None
+
+    def clear(self):
+        """Forget everything"""
+        self._entries.clear()
+        self._snapshot = None
+
+    def stats(self):
+        """Return hits, misses and number of entries, by kind of lookup"""
+        return {
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'entries': { kind: len(entries) for kind, entries in self._entries.items() },
+        }
+
+
+# the cache shared by the Hub
+cache = NSSCache()
+
+
+def getpwnam(name):
+    return cache.getpwnam(name)
+
+
+def getgrnam(name):
+    return cache.getgrnam(name)
+
+
+def getgrall():
+    return cache.getgrall()
+
+
+def user_gids(name):
+    return cache.user_gids(name)
@@ -111,10 +111,14 @@ class Server(HasTraits):
         return self.url
 
     @gen.coroutine
-    def wait_up(self, timeout=10, http=False):
-        """Wait for this server to come up"""
+    def wait_up(self, timeout=10, http=False, ready=None):
+        """Wait for this server to come up
+
+        ready, if given, is a Future resolving when the server has said that it is up
+        (only used with http).
+        """
         if http:
-            yield wait_for_http_server(self.url, timeout=timeout)
+            yield wait_for_http_server(self.url, timeout=timeout, ready=ready)
         else:
             yield wait_for_server(self._connect_ip, self.port, timeout=timeout)
 
@@ -13,22 +13,28 @@ from tornado.httpclient import HTTPRequest, AsyncHTTPClient
 
 from sqlalchemy.types import TypeDecorator, TEXT
 from sqlalchemy import (
-    inspect,
+    inspect, func, and_,
     Column, Integer, ForeignKey, Unicode, Boolean,
     DateTime, Enum
 )
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import sessionmaker, relationship, backref
+from sqlalchemy.orm import (
+    Session, sessionmaker, relationship, backref,
+    defer, joinedload, subqueryload,
+    object_session,
+)
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.pool import StaticPool
 from sqlalchemy.schema import Index, UniqueConstraint
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.sql.expression import bindparam
-from sqlalchemy import create_engine, Table
+from sqlalchemy import create_engine, event, Table
 
 from .utils import (
     random_port, url_path_join, wait_for_server, wait_for_http_server,
-    new_token, hash_token, compare_token, can_connect,
+    new_token, hash_token, compare_token, digest_token, can_connect,
 )
+from hmac import compare_digest
 
 
 class JSONDict(TypeDecorator):
@@ -95,9 +101,92 @@ class Group(Base):
     users = relationship('User', secondary='user_group_map', back_populates='groups')
 
     def __repr__(self):
-        return "<%s %s (%i users)>" % (
-            self.__class__.__name__, self.name, len(self.users)
-        )
+        # don't load the members
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+    # number of ids per IN clause, below sqlite's limit of 999 parameters
+    _in_chunk_size = 500
+
+    def member_count(self):
+        """Return the number of users in the group, without loading them"""
+        db = object_session(self)
+        return db.query(func.count(user_group_map.c.user_id)).filter(
+            user_group_map.c.group_id == self.id).scalar()
+
+    def member_names(self, offset=0, limit=None):
+        """Return the names of users in the group, sorted, from offset up to limit"""
+        db = object_session(self)
+        query = db.query(User.name).join(
+            user_group_map, user_group_map.c.user_id == User.id
+        ).filter(
+            user_group_map.c.group_id == self.id
+        ).order_by(User.name).offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return [ name for (name,) in query ]
+
+    def member_ids(self, user_ids=None):
+        """Return the set of ids of users in the group
+
+        If user_ids is given, only those users are checked.
+        """
+        db = object_session(self)
+        query = db.query(user_group_map.c.user_id).filter(
+            user_group_map.c.group_id == self.id)
+        if user_ids is None:
+            return { user_id for (user_id,) in query }
+        user_ids = list(user_ids)
+        member_ids = set()
+        for i in range(0, len(user_ids), self._in_chunk_size):
+            chunk = user_ids[i:i + self._in_chunk_size]
+            member_ids.update(user_id for (user_id,) in
+                query.filter(user_group_map.c.user_id.in_(chunk)))
+        return member_ids
+
+    def _expire_memberships(self, user_ids):
+        """Expire membership collections changed outside of the ORM"""
+        db = object_session(self)
+        db.expire(self, ['users'])
+        for user_id in user_ids:
+            user = db.identity_map.get(identity_key(User, user_id))
+            if user is not None:
+                db.expire(user, ['groups'])
+
+    def add_users(self, user_ids):
+        """Add users to the group by id, with a single bulk insert
+
+        Returns the set of ids of users that were not members already.
+        Does not commit.
+        """
+        db = object_session(self)
+        db.flush()
+        user_ids = set(user_ids)
+        added = user_ids.difference(self.member_ids(user_ids))
+        if added:
+            db.execute(user_group_map.insert(), [
+                {'group_id': self.id, 'user_id': user_id} for user_id in sorted(added)
+            ])
+            self._expire_memberships(added)
+        return added
+
+    def remove_users(self, user_ids):
+        """Remove users from the group by id, with bulk deletes
+
+        Returns the set of ids of users that were members.
+        Does not commit.
+        """
+        db = object_session(self)
+        db.flush()
+        removed = self.member_ids(user_ids)
+        ids = sorted(removed)
+        for i in range(0, len(ids), self._in_chunk_size):
+            db.execute(user_group_map.delete().where(and_(
+                user_group_map.c.group_id == self.id,
+                user_group_map.c.user_id.in_(ids[i:i + self._in_chunk_size]),
+            )))
+        if removed:
+            self._expire_memberships(removed)
+        return removed
 
     @classmethod
     def find(cls, db, name):
@@ -116,18 +205,26 @@ class User_info(Base):
     data_dir = Column(Unicode(255), default='/home/jupyter_data')
     shell = Column(Unicode(255), default='/bin/bash')
     used = Column(Boolean, default=False)
+
+    @staticmethod
+    def defaults(name):
+        """The default home, shell and data_dir for a new user"""
+        home = '/home/' + name
+        return {
+            'home': home,
+            'shell': '/bin/bash',
+            'data_dir': home + '/data',
+        }
+
     @classmethod
     def create(cls, db, name):
         if not name:
             return None
-        _home = '/home/' + name
-        _shell = '/bin/bash'
-        _data_dir = _home + '/data'
         u = User.find(db, name)
         if u is None:
             return None
         u_id = u.id
-        u_info = User_info(home=_home, shell=_shell, data_dir=_data_dir, user_id=u_id)
+        u_info = User_info(user_id=u_id, **cls.defaults(name))
         db.add(u_info)
         db.commit()
         return u_info
@@ -172,7 +269,7 @@ class User(Base):
     servers = association_proxy("user_to_servers", "server", creator=lambda server: UserServer(server=server))
 
     admin = Column(Boolean, default=False)
-    last_activity = Column(DateTime, default=datetime.utcnow)
+    last_activity = Column(DateTime, default=datetime.utcnow, index=True)
 
     api_tokens = relationship("APIToken", backref="user")
     cookie_id = Column(Unicode(1023), default=new_token, nullable=False, unique=True)
@@ -184,7 +281,7 @@ class User(Base):
     # group mapping
     groups = relationship('Group', secondary='user_group_map', back_populates='users')
     # user_info
-    user_info = relationship('User_info', backref='user')
+    user_info = relationship('User_info', backref='user', cascade='all, delete-orphan')
     def __repr__(self):
         if self.servers:
             server = self.servers[0]
@@ -214,6 +311,21 @@ class User(Base):
         """
         return db.query(cls).filter(cls.name == name).first()
 
+    @classmethod
+    def listing_query(cls, db):
+        """Start the query for listing users.
+
+        Groups and servers, which user models need, are loaded eagerly
+        and the JSON state columns, which they don't, are deferred,
+        so listing any number of users takes a constant number of queries.
+        """
+        return db.query(cls).options(
+            defer(cls.state),
+            defer(cls.auth_state),
+            subqueryload(cls.groups),
+            subqueryload('user_to_servers').joinedload('server'),
+        )
+
 
 class UserServer(Base):
     """The UserServer table
@@ -290,7 +402,16 @@ class Service(Base):
         return db.query(cls).filter(cls.name == name).first()
 
 class Hashed(object):
-    """Mixin for tables with hashed tokens"""
+    """Mixin for tables with hashed tokens
+
+    Tokens are stored as their sha256 `digest`,
+    in a unique indexed column, so finding a token is a single indexed lookup.
+
+    Rows created before the digest column existed only have a salted, stretched
+    `hashed` value, which can only be checked by re-hashing every candidate
+    with the same prefix. These rows are upgraded to a digest
+    the first time their token is found.
+    """
     prefix_length = 4
     algorithm = "sha512"
     rounds = 16384
@@ -303,12 +424,16 @@ class Hashed(object):
 
     @token.setter
     def token(self, token):
-        """Store the hashed value and prefix for a token"""
+        """Store the digest and prefix for a token"""
         self.prefix = token[:self.prefix_length]
-        self.hashed = hash_token(token, rounds=self.rounds, salt=self.salt_bytes, algorithm=self.algorithm)
+        self.digest = digest_token(token)
+        # legacy hashes are only checked when there is no digest
+        self.hashed = None
 
     def match(self, token):
         """Is this my token?"""
+        if self.digest is not None:
+            return compare_digest(self.digest, digest_token(token))
         return compare_token(self.hashed, token)
     
     @classmethod
@@ -334,18 +459,70 @@ class Hashed(object):
         return db.query(cls).filter(bindparam('prefix', prefix).startswith(cls.prefix))
 
     @classmethod
-    def find(cls, db, token):
+    def find_legacy(cls, db, token):
+        """Start the query for legacy rows that may match a token.
+
+        Returns an SQLAlchemy query for rows with no digest and the token's prefix.
+        All prefixes are stored with `prefix_length` characters,
+        so this is an equality match on the indexed prefix column.
+        """
+        prefix = token[:cls.prefix_length]
+        return db.query(cls).filter(cls.digest == None).filter(cls.prefix == prefix)
+
+    @classmethod
+    def find_cached(cls, db, token, cache):
+        """Find a token object previously verified and stored in a TokenCache.
+
+        The row is loaded by id and its digest must be unchanged,
+        so deleted or replaced tokens are dropped from the cache.
+
+        Returns None if not cached.
+        """
+        cached = cache.get(cls.__tablename__, token)
+        if cached is None:
+            return None
+        id, digest = cached
+        orm_token = db.query(cls).get(id)
+        if orm_token is None or orm_token.digest != digest:
+            cache.discard(cls.__tablename__, token)
+            return None
+        return orm_token
+
+    @classmethod
+    def find(cls, db, token, cache=None):
         """Find a token object by value.
 
         Returns None if not found.
 
-        `kind='user'` only returns API tokens for users
-        `kind='service'` only returns API tokens for services
+        If a TokenCache is given, it is checked first
+        and updated with the token if it is found.
+
+        Legacy rows without a digest are upgraded when their token is found.
+        The upgrade is committed right away if the session has no other changes,
+        which is the case for lookups authenticating a request.
+        Otherwise it is flushed, and saved when the caller commits.
         """
-        prefix_match = cls.find_prefix(db, token)
-        for orm_token in prefix_match:
-            if orm_token.match(token):
+        if cache is not None:
+            orm_token = cls.find_cached(db, token, cache)
+            if orm_token is not None:
                 return orm_token
+        orm_token = db.query(cls).filter(cls.digest == digest_token(token)).first()
+        if orm_token is None:
+            for legacy_token in cls.find_legacy(db, token):
+                if legacy_token.match(token):
+                    app_log.debug("Upgrading hash of %s", legacy_token)
+                    # don't commit changes that belong to the caller
+                    commit = not has_uncommitted_changes(db)
+                    legacy_token.token = token
+                    if commit:
+                        db.commit()
+                    else:
+                        db.flush()
+                    orm_token = legacy_token
+                    break
+        if orm_token is not None and cache is not None:
+            cache.set(cls.__tablename__, token, orm_token.id, orm_token.digest)
+        return orm_token
 
 class APIToken(Hashed, Base):
     """An API token"""
@@ -361,7 +538,8 @@ class APIToken(Hashed, Base):
 
     id = Column(Integer, primary_key=True)
     hashed = Column(Unicode(1023))
-    prefix = Column(Unicode(16))
+    digest = Column(Unicode(64), index=True, unique=True)
+    prefix = Column(Unicode(16), index=True)
 
     def __repr__(self):
         if self.user is not None:
@@ -382,24 +560,27 @@ class APIToken(Hashed, Base):
         )
 
     @classmethod
-    def find(cls, db, token, *, kind=None):
+    def find(cls, db, token, *, kind=None, cache=None):
         """Find a token object by value.
 
         Returns None if not found.
 
         `kind='user'` only returns API tokens for users
         `kind='service'` only returns API tokens for services
+
+        If a TokenCache is given, it is checked first
+        and updated with the token if it is found.
         """
-        prefix_match = cls.find_prefix(db, token)
-        if kind == 'user':
-            prefix_match = prefix_match.filter(cls.user_id != None)
-        elif kind == 'service':
-            prefix_match = prefix_match.filter(cls.service_id != None)
-        elif kind is not None:
+        if kind not in {'user', 'service', None}:
             raise ValueError("kind must be 'user', 'service', or None, not %r" % kind)
-        for orm_token in prefix_match:
-            if orm_token.match(token):
-                return orm_token
+        orm_token = super().find(db, token, cache=cache)
+        if orm_token is None:
+            return None
+        if kind == 'user' and orm_token.user_id is None:
+            return None
+        if kind == 'service' and orm_token.service_id is None:
+            return None
+        return orm_token
 
     @classmethod
     def new(cls, token=None, user=None, service=None):
@@ -452,7 +633,8 @@ class OAuthAccessToken(Hashed, Base):
 
     # from Hashed
     hashed = Column(Unicode(64))
-    prefix = Column(Unicode(16))
+    digest = Column(Unicode(64), index=True, unique=True)
+    prefix = Column(Unicode(16), index=True)
     
     def __repr__(self):
         return "<{cls}('{prefix}...', user='{user}'>".format(
@@ -480,6 +662,79 @@ class OAuthClient(Base):
     redirect_uri = Column(Unicode(1023))
 
 
+class Job(Base):
+    """A background job, such as creating or moving a user's directories
+
+    `action` names the kind of job, and `spec` describes the work,
+    e.g. `{"commands": [["mkdir", "-p", path]]}`.
+    `progress` counts the steps completed, out of `total`.
+    `state` is one of 'pending', 'running', 'done' or 'failed',
+    with `message` explaining failures.
+    Jobs made of independent tasks, such as spawning many servers,
+    record the result of each task by name in `results`.
+    """
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    action = Column(Unicode(255))
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    user = relationship('User')
+    state = Column(Unicode(16), default='pending', index=True)
+    spec = Column(JSONDict)
+    progress = Column(Integer, default=0)
+    total = Column(Integer, default=0)
+    message = Column(TEXT)
+    results = Column(JSONDict)
+    created = Column(DateTime, default=datetime.utcnow)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+
+    def __repr__(self):
+        return "<{cls}({id} {action} {state} {progress}/{total})>".format(
+            cls=self.__class__.__name__,
+            id=self.id,
+            action=self.action,
+            state=self.state,
+            progress=self.progress,
+            total=self.total,
+        )
+
+
+class QueryCounter(object):
+    """Count the SQL statements executed on an engine
+
+    Used to measure the database work done by a piece of code::
+
+        before = counter.count
+        do_something()
+        queries = counter.count - before
+    """
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+
+def has_uncommitted_changes(db):
+    """Does a session have changes that haven't been committed?
+
+    Includes changes that have been flushed, but not yet committed.
+    """
+    return bool(db.new or db.dirty or db.deleted or db.info.get('flushed'))
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_flush(session, flush_context):
+    session.info['flushed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _clear_flush(session):
+    session.info.pop('flushed', None)
+
+
 def new_session_factory(url="sqlite:///:memory:", reset=False, **kwargs):
     """Create a new session at url"""
     if url.startswith('sqlite'):
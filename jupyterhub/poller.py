@@ -0,0 +1,144 @@
+"""Poll running single-user servers from one place
+
+Each running server has to be polled now and then,
+to notice servers that have stopped without the Hub stopping them.
+Instead of a timer per server, the Hub has one poller,
+which checks every `tick` seconds for spawners that are due
+and polls them in batches.
+
+Each spawner is polled about every `Spawner.poll_interval` seconds,
+spread randomly by `jitter`, so that servers started at the same time
+are not all polled at the same time.
+Spawner classes can poll a batch of their servers at once,
+by implementing `Spawner.poll_batch`.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from collections import defaultdict
+import random
+import time
+
+from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from traitlets.config import LoggingConfigurable
+from traitlets import Any, Float, Integer, default
+
+from .emptyclass import EmptyClass
+
+
+class SpawnerPoller(LoggingConfigurable):
+    """Poll running spawners in batches
+
+    Spawners register with `add` when they start polling,
+    and are removed with `remove` when they stop.
+
+    Metrics, sent to statsd:
+
+    - spawner_poller.spawners: spawners being polled (gauge)
+    - spawner_poller.sweep: time spent polling the spawners that were due (timer, ms)
+    """
+
+    tick = Float(1,
+        help="""
+        Interval, in seconds, at which to check for spawners that are due to be polled.
+        """
+    ).tag(config=True)
+
+    batch_size = Integer(100,
+        help="""
+        Maximum number of spawners to poll at once.
+
+        The IOLoop handles other events between batches.
+        """
+    ).tag(config=True)
+
+    jitter = Float(0.1,
+        help="""
+        Fraction of Spawner.poll_interval by which to randomly spread each poll.
+        """
+    ).tag(config=True)
+
+    statsd = Any(allow_none=False, help="The statsd client, if any.")
+
+    @default('statsd')
+    def _statsd_default(self):
+        return EmptyClass()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # spawner: when it is next due
+        self._due = {}
+        self._callback = None
+        self._sweeping = False
+
+    def _next_poll(self, spawner, now):
+        return now + spawner.poll_interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def add(self, spawner):
+        """Start polling a spawner"""
+        self._due[spawner] = self._next_poll(spawner, IOLoop.current().time())
+
+    def remove(self, spawner):
+        """Stop polling a spawner"""
+        self._due.pop(spawner, None)
+
+    def __contains__(self, spawner):
+        return spawner in self._due
+
+    def start(self):
+        """Start polling"""
+        self._callback = PeriodicCallback(self.sweep, 1e3 * self.tick)
+        self._callback.start()
+
+    def stop(self):
+        """Stop polling"""
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    @gen.coroutine
+    def sweep(self):
+        """Poll the spawners that are due"""
+        if self._sweeping:
+            # the last sweep is still going
+            return
+        self._sweeping = True
+        tic = time.perf_counter()
+        try:
+            now = IOLoop.current().time()
+            due = [ spawner for spawner, when in self._due.items() if when <= now ]
+            for i in range(0, len(due), self.batch_size):
+                # spawners may have stopped polling while the last batch was polled
+                batch = [ spawner for spawner in due[i:i + self.batch_size] if spawner in self._due ]
+                for spawner in batch:
+                    self._due[spawner] = self._next_poll(spawner, now)
+                statuses = yield self.poll(batch)
+                yield [
+                    spawner.handle_poll(status) for spawner, status in statuses.items()
+                    if spawner in self._due
+                ]
+        finally:
+            self._sweeping = False
+        self.statsd.gauge('spawner_poller.spawners', len(self._due))
+        self.statsd.timing('spawner_poller.sweep', (time.perf_counter() - tic) * 1000)
+
+    @gen.coroutine
+    def poll(self, spawners):
+        """Poll spawners, with one call to poll_batch per spawner class
+
+        Returns a dict of spawner: status.
+        Spawners that failed to poll are left out.
+        """
+        by_class = defaultdict(list)
+        for spawner in spawners:
+            by_class[type(spawner)].append(spawner)
+        statuses = {}
+        for cls, batch in by_class.items():
+            try:
+                statuses.update((yield cls.poll_batch(batch)))
+            except Exception:
+                self.log.exception("Failed to poll %i %s spawners", len(batch), cls.__name__)
+        return statuses
@@ -0,0 +1,186 @@
+"""Allocate ports for single-user servers from a range owned by the Hub
+
+`utils.random_port` asks the OS for a free port, closes it,
+and hopes that nobody else takes it before the server binds it.
+Under bursts of spawns, two servers can end up with the same port.
+
+The PortAllocator instead leases ports from a configured range,
+recording leases in a bitmap (one bit per port in the range).
+Leases are the ports of `orm.Server` rows:
+they are released when the server is stopped,
+and rebuilt from the database when the Hub starts.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import socket
+
+from traitlets.config import LoggingConfigurable
+from traitlets import Any, Integer, Tuple, default, observe, validate, TraitError
+
+from . import orm
+from .emptyclass import EmptyClass
+
+
+def _can_bind(port):
+    """Can we listen on port? (is it not in use outside the Hub?)"""
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(('', port))
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class PortAllocator(LoggingConfigurable):
+    """Lease ports from a range, for LocalProcessSpawner
+
+    Other spawners pick their servers' ports as before.
+    Servers are created with a random port from the OS,
+    which is outside the range if the range is reserved as recommended,
+    so releasing the port of a server that never leased one is a no-op.
+
+    Metrics, sent to statsd:
+
+    - ports.leased: ports leased (gauge)
+    """
+
+    port_range = Tuple(Integer(), Integer(), default_value=(0, 0),
+        help="""
+        First and last port (inclusive) to give to single-user servers, e.g. (50000, 50999).
+
+        Only used by LocalProcessSpawner and its subclasses.
+
+        Ports in the range should not be used by anything else on the host,
+        including outgoing connections,
+        e.g. reserve them with the net.ipv4.ip_local_reserved_ports sysctl.
+        Ports that are in use anyway are skipped.
+
+        The default (0, 0) disables the allocator,
+        and servers get random ports from the OS.
+        """
+    ).tag(config=True)
+
+    @validate('port_range')
+    def _validate_port_range(self, proposal):
+        first, last = proposal['value']
+        if (first, last) != (0, 0) and not 0 < first <= last <= 65535:
+            raise TraitError("port_range must be (first, last) with 0 < first <= last <= 65535, not %r"
+                % (proposal['value'],))
+        return proposal['value']
+
+    statsd = Any(allow_none=False, help="The statsd client, if any.")
+
+    @default('statsd')
+    def _statsd_default(self):
+        return EmptyClass()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._reset()
+
+    @observe('port_range')
+    def _port_range_changed(self, change):
+        self._reset()
+
+    def _reset(self):
+        first, last = self.port_range
+        self._size = last - first + 1 if self.enabled else 0
+        self._bits = bytearray((self._size + 7) // 8)
+        self._count = 0
+        # where to start looking for a free port
+        self._cursor = 0
+
+    @property
+    def enabled(self):
+        return self.port_range[0] > 0
+
+    def _index(self, port):
+        i = port - self.port_range[0]
+        if 0 <= i < self._size:
+            return i
+
+    def _is_set(self, i):
+        return bool(self._bits[i >> 3] & (1 << (i & 7)))
+
+    def __contains__(self, port):
+        i = self._index(port)
+        return i is not None and self._is_set(i)
+
+    def __len__(self):
+        return self._count
+
+    def reserve(self, port):
+        """Mark a port as leased, e.g. the port of a server that is already running
+
+        Ports outside the range are ignored.
+        """
+        i = self._index(port)
+        if i is None or self._is_set(i):
+            return
+        self._bits[i >> 3] |= 1 << (i & 7)
+        self._count += 1
+        self.statsd.gauge('ports.leased', self._count)
+
+    def release(self, port):
+        """Release the lease on a port
+
+        Ports outside the range, or not leased, are ignored.
+        """
+        i = self._index(port)
+        if i is None or not self._is_set(i):
+            return
+        self._bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+        self._count -= 1
+        self.statsd.gauge('ports.leased', self._count)
+
+    def _free(self):
+        """Iterate over unleased indexes, starting from the cursor
+
+        Bytes of the bitmap that are fully leased are skipped whole.
+        """
+        nbytes = len(self._bits)
+        start, start_bit = self._cursor >> 3, self._cursor & 7
+        # the byte of the cursor is visited twice:
+        # first from the cursor on, and last up to the cursor
+        for n in range(nbytes + 1):
+            b = (start + n) % nbytes
+            byte = self._bits[b]
+            if byte == 0xff:
+                continue
+            first_bit = start_bit if n == 0 else 0
+            last_bit = start_bit if n == nbytes else 8
+            for bit in range(first_bit, last_bit):
+                i = (b << 3) + bit
+                if i < self._size and not byte & (1 << bit):
+                    yield i
+
+    def allocate(self):
+        """Lease a free port
+
+        Raises RuntimeError if all ports in the range are leased or in use.
+        """
+        first, last = self.port_range
+        for i in self._free():
+            port = first + i
+            if not _can_bind(port):
+                self.log.debug("Port %i is in use outside the Hub, skipping", port)
+                continue
+            self.reserve(port)
+            self._cursor = (i + 1) % self._size
+            return port
+        raise RuntimeError("No free ports left in %i-%i (%i leased)" % (first, last, self._count))
+
+    def load(self, db):
+        """Rebuild the leases from the ports of servers in the database"""
+        self._reset()
+        if not self.enabled:
+            return
+        for (port,) in db.query(orm.Server.port):
+            if port:
+                self.reserve(port)
+        self.log.info("%i ports in %i-%i leased", self._count, *self.port_range)
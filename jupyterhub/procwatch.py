@@ -0,0 +1,224 @@
+"""Notice when local processes exit, without polling
+
+Stopping a server used to mean polling it every `Spawner.death_interval`
+until it was gone, and a server that died on its own was only noticed
+at the next periodic poll.
+
+ProcessWatcher registers processes with the IOLoop instead:
+
+- with a pidfd (Linux >= 5.3, Python >= 3.9), which becomes readable when the process exits.
+  This works for any process, including servers resumed after a Hub restart.
+- otherwise, for children of the Hub only, with a central SIGCHLD handler,
+  which reaps exactly the registered children.
+  It chains to the SIGCHLD handler of tornado's Subprocess (used e.g. by the JobQueue),
+  which does not chain to other handlers, so that one is installed first.
+
+Children are reaped as soon as they exit, so they don't linger as zombies.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import os
+import signal
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.process import Subprocess
+
+from traitlets.config import SingletonConfigurable
+from traitlets import Bool
+
+
+class ProcessWatcher(SingletonConfigurable):
+    """Resolve a Future when a process exits
+
+    Use the shared instance::
+
+        exited = ProcessWatcher.instance().watch(pid, proc)
+        if exited is not None:
+            status = yield exited
+    """
+
+    use_pidfd = Bool(True,
+        help="""
+        Watch processes with pidfds, where available.
+
+        If False, or pidfds are not available, only children of the Hub are watched,
+        with a SIGCHLD handler.
+        """
+    ).tag(config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # pid: Future resolving to the exit status
+        self._exits = {}
+        # pid: (pidfd, IOLoop) of processes watched via pidfd
+        self._pidfds = {}
+        # pid: Popen of children watched via SIGCHLD
+        self._children = {}
+        self._sigchld_installed = False
+        self._previous_handler = None
+        # the bound method installed as the handler, to check that it is still installed
+        self._sigchld_handler = self._handle_sigchld
+        # whether we initialized tornado's Subprocess SIGCHLD handler
+        self._subprocess_initialized = False
+        self.io_loop = None
+
+    @property
+    def pidfd_available(self):
+        return self.use_pidfd and hasattr(os, 'pidfd_open')
+
+    def watch(self, pid, proc=None):
+        """Watch a process, by pid and Popen if it is a child of the Hub
+
+        Returns a Future resolving to the exit status when the process exits,
+        or None if the process can't be watched, and has to be polled instead.
+        The status is 0 if it is not known (the process is not a child).
+        """
+        if pid in self._exits:
+            return self._exits[pid]
+        self.io_loop = IOLoop.current()
+        if self.pidfd_available:
+            return self._watch_pidfd(pid, proc)
+        elif proc is not None:
+            return self._watch_child(pid, proc)
+        return None
+
+    def _status(self, proc):
+        if proc is None:
+            return 0
+        status = proc.poll()
+        return 0 if status is None else status
+
+    def _resolve(self, pid, proc):
+        f = self._exits.pop(pid, None)
+        if f is not None and not f.done():
+            f.set_result(self._status(proc))
+
+    def _watch_pidfd(self, pid, proc):
+        f = self._exits[pid] = Future()
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            self._resolve(pid, proc)
+            return f
+        except OSError as e:
+            # e.g. pidfd_open not supported by the kernel
+            self.log.warning("Can't watch process %i with a pidfd (%s), using SIGCHLD", pid, e)
+            self._exits.pop(pid)
+            self.use_pidfd = False
+            return self.watch(pid, proc)
+
+        def exited(fd, events):
+            self._close_pidfd(pid)
+            self._resolve(pid, proc)
+
+        self._pidfds[pid] = (fd, self.io_loop)
+        self.io_loop.add_handler(fd, exited, IOLoop.READ)
+        return f
+
+    def _close_pidfd(self, pid):
+        fd, io_loop = self._pidfds.pop(pid)
+        io_loop.remove_handler(fd)
+        os.close(fd)
+
+    def _install_sigchld(self):
+        """Install the SIGCHLD handler, if it isn't installed anymore
+
+        tornado's Subprocess replaces the SIGCHLD handler the first time it is used,
+        without chaining to the previous handler,
+        so it is initialized first, and ours chains to it.
+        """
+        if self._sigchld_installed and signal.getsignal(signal.SIGCHLD) is self._sigchld_handler:
+            return True
+        try:
+            if not Subprocess._initialized:
+                Subprocess.initialize()
+                self._subprocess_initialized = True
+            self._previous_handler = signal.signal(signal.SIGCHLD, self._sigchld_handler)
+        except ValueError:
+            # not the main thread
+            self.log.warning("Can't handle SIGCHLD outside the main thread")
+            return False
+        if self._sigchld_installed:
+            self.log.warning("SIGCHLD handler was replaced by %r, reinstalled it",
+                self._previous_handler)
+        self._sigchld_installed = True
+        return True
+
+    def _handle_sigchld(self, signum, frame):
+        try:
+            self.io_loop.add_callback_from_signal(self._reap)
+        except RuntimeError:
+            # the IOLoop is closed
+            pass
+        if callable(self._previous_handler):
+            self._previous_handler(signum, frame)
+
+    def _watch_child(self, pid, proc):
+        if not self._install_sigchld():
+            return None
+        f = self._exits[pid] = Future()
+        self._children[pid] = proc
+        # it may have exited before the handler was installed
+        if proc.poll() is not None:
+            self._children.pop(pid)
+            self._resolve(pid, proc)
+        return f
+
+    def _reap(self):
+        """Reap watched children that have exited
+
+        Exited children are found without reaping them (WNOWAIT),
+        and only the registered children are reaped,
+        so exit statuses of other subprocesses of the Hub are left alone.
+        Only children that have exited are polled,
+        unless an exited child that isn't ours has yet to be reaped by its owner.
+        """
+        while self._children:
+            try:
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            except ChildProcessError:
+                # no children left
+                return
+            if info is None:
+                # no more exited children
+                return
+            pid = info.si_pid
+            proc = self._children.pop(pid, None)
+            if proc is None:
+                # it is someone else's, and hides any exited children of ours behind it
+                self._poll_children()
+                return
+            # reaps it
+            proc.poll()
+            self._resolve(pid, proc)
+
+    def reaped(self, pid, proc):
+        """Record that a watched child has been reaped elsewhere, e.g. by `proc.poll()`
+
+        Its exit can't be found by waiting for it anymore.
+        """
+        if self._children.pop(pid, None) is not None:
+            self._resolve(pid, proc)
+
+    def _poll_children(self):
+        """Poll every watched child"""
+        for pid, proc in list(self._children.items()):
+            if proc.poll() is not None:
+                self._children.pop(pid)
+                self._resolve(pid, proc)
+
+    def stop(self):
+        """Stop watching processes, and restore the previous SIGCHLD handler"""
+        for pid in list(self._pidfds):
+            self._close_pidfd(pid)
+        if self._sigchld_installed:
+            if signal.getsignal(signal.SIGCHLD) is self._sigchld_handler:
+                signal.signal(signal.SIGCHLD, self._previous_handler or signal.SIG_DFL)
+            self._sigchld_installed = False
+        if self._subprocess_initialized:
+            Subprocess.uninitialize()
+            self._subprocess_initialized = False
+        self._children.clear()
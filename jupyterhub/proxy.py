@@ -44,6 +44,9 @@ class Proxy(LoggingConfigurable):
         such as by systemd, docker, or another service manager.
         """)
 
+    # names per IN clause, below sqlite's limit of 999 parameters
+    _in_chunk_size = 500
+
     def start(self):
         """Start the proxy.
 
@@ -180,7 +183,7 @@ class Proxy(LoggingConfigurable):
         """
         db = self.db
         futures = []
-        for orm_user in db.query(User):
+        for orm_user in db.query(User).filter(User.user_to_servers.any()):
             user = user_dict[orm_user]
             if user.running:
                 futures.append(self.add_user(user))
@@ -197,7 +200,14 @@ class Proxy(LoggingConfigurable):
         user_routes = {r['data']['user'] for r in routes.values() if 'user' in r['data']}
         futures = []
         db = self.db
-        for orm_user in db.query(User):
+        # only users with servers or routes need checking,
+        # so that users that are not running aren't all loaded
+        orm_users = db.query(User).filter(User.user_to_servers.any()).all()
+        orphans = sorted(user_routes.difference(u.name for u in orm_users))
+        for i in range(0, len(orphans), self._in_chunk_size):
+            orm_users.extend(db.query(User).filter(
+                User.name.in_(orphans[i:i + self._in_chunk_size])))
+        for orm_user in orm_users:
             user = user_dict[orm_user]
             if user.running:
                 if user.name not in user_routes:
@@ -0,0 +1,59 @@
+"""Run a command as another user
+
+A small helper for starting single-user servers without a preexec_fn:
+the Hub runs it instead of setting uid/gid in a forked copy of itself,
+and it drops privileges, changes to the user's home directory,
+and execs the command::
+
+    python -I setuid.py UID GID GIDS HOME -- CMD [ARGS...]
+
+where GIDS is a comma-separated list of supplementary group ids.
+
+It does not import anything beyond the standard library,
+so that it starts quickly, and can run with -I (isolated mode).
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import os
+import sys
+from tempfile import mkdtemp
+
+
+def _try_setcwd(path):
+    """Try to set CWD to path, walking up until a valid directory is found.
+
+    If no valid directory is found, a temp directory is created and cwd is set to that.
+    """
+    while path != '/':
+        try:
+            os.chdir(path)
+        except OSError as e:
+            exc = e  # break exception instance out of except scope
+            print("Couldn't set CWD to %s (%s)" % (path, e), file=sys.stderr)
+            path, _ = os.path.split(path)
+        else:
+            return
+    print("Couldn't set CWD at all (%s), using temp dir" % exc, file=sys.stderr)
+    td = mkdtemp()
+    os.chdir(td)
+
+
+def main(argv):
+    uid, gid, gids, home, sep = argv[:5]
+    cmd = argv[5:]
+    if sep != '--' or not cmd:
+        sys.exit("Usage: setuid.py UID GID GIDS HOME -- CMD [ARGS...]")
+    os.setgid(int(gid))
+    try:
+        os.setgroups([ int(g) for g in gids.split(',') if g ])
+    except Exception as e:
+        print('Failed to set groups %s' % e, file=sys.stderr)
+    os.setuid(int(uid))
+    _try_setcwd(home)
+    os.execvp(cmd[0], cmd)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
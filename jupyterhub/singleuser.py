@@ -6,11 +6,12 @@
 
 import os
 from textwrap import dedent
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 
 from jinja2 import ChoiceLoader, FunctionLoader
 
-from tornado import ioloop
+from tornado import gen, ioloop
+from tornado.httpclient import AsyncHTTPClient, HTTPError as HTTPClientError, HTTPRequest
 from tornado.web import HTTPError
 
 try:
@@ -338,8 +339,31 @@ class SingleUserNotebookApp(NotebookApp):
         return path
 
     def start(self):
+        # the server is listening by now, tell the Hub once the loop runs
+        ioloop.IOLoop.current().add_callback(self.notify_hub_ready)
         super(SingleUserNotebookApp, self).start()
 
+    @gen.coroutine
+    def notify_hub_ready(self):
+        """Tell the Hub that the server is up
+
+        so that it doesn't have to keep checking.
+        """
+        url = url_path_join(self.hub_api_url, 'users', quote(self.user, safe=''), 'server/ready')
+        req = HTTPRequest(url, method='POST', body='',
+            headers={'Authorization': 'token %s' % self.hub_auth.api_token},
+        )
+        try:
+            yield AsyncHTTPClient().fetch(req)
+        except HTTPClientError as e:
+            if e.code == 404:
+                # a Hub without the ready API, it will find the server by itself
+                self.log.debug("Hub does not accept ready notifications")
+            else:
+                self.log.warning("Failed to tell the Hub that the server is up: %s", e)
+        except Exception as e:
+            self.log.warning("Failed to tell the Hub that the server is up: %s", e)
+
     def init_hub_auth(self):
         api_token = None
         if os.getenv('JPY_API_TOKEN'):
@@ -8,17 +8,15 @@ Contains base Spawner class & default implementation
 import errno
 import os
 import pipes
-import pwd
 import shutil
 import signal
 import sys
-import grp
 import warnings
+from datetime import timedelta
 from subprocess import Popen
-from tempfile import mkdtemp
 
 from tornado import gen
-from tornado.ioloop import PeriodicCallback
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 from traitlets.config import LoggingConfigurable
 from traitlets import (
@@ -26,8 +24,12 @@ from traitlets import (
     validate,
 )
 
+from . import nss, setuid
+from .setuid import _try_setcwd
 from .traitlets import Command, ByteSpecification
+from .procwatch import ProcessWatcher
 from .utils import random_port, url_path_join
+from .zygote import ZygoteLauncher
 
 
 class Spawner(LoggingConfigurable):
@@ -117,8 +119,32 @@ class Spawner(LoggingConfigurable):
         """
     ).tag(config=True)
 
+    poll_cache_ttl = Float(5,
+        help="""
+        Time (in seconds) for which a poll finding the single-user server running is trusted.
+
+        Page views and REST API requests that check whether a server is running
+        use the result of a poll this recent instead of polling again.
+        0 means always poll.
+        """
+    ).tag(config=True)
+
+    poller = Any(
+        help="""The Hub's SpawnerPoller, if any.
+
+        Spawners are polled by it instead of each having its own timer.
+        """
+    )
+    port_allocator = Any(
+        help="""The Hub's PortAllocator, if any.
+
+        Spawners that pick ports for their servers on the Hub's host can lease them from it.
+        """
+    )
+
     _callbacks = List()
     _poll_callback = Any()
+    _last_running_poll = Float(0)
 
     debug = Bool(False,
         help="Enable debug-logging of the single-user server"
@@ -586,9 +612,12 @@ class Spawner(LoggingConfigurable):
 
     def stop_polling(self):
         """Stop polling for single-user server's running state"""
+        if self.poller is not None:
+            self.poller.remove(self)
         if self._poll_callback:
             self._poll_callback.stop()
             self._poll_callback = None
+        self._last_running_poll = 0
 
     def start_polling(self):
         """Start polling periodically for single-user server's running state.
@@ -604,18 +633,58 @@ class Spawner(LoggingConfigurable):
 
         self.stop_polling()
 
+        if self.poller is not None:
+            self.poller.add(self)
+            return
         self._poll_callback = PeriodicCallback(
             self.poll_and_notify,
             1e3 * self.poll_interval
         )
         self._poll_callback.start()
 
+    @classmethod
     @gen.coroutine
-    def poll_and_notify(self):
-        """Used as a callback to periodically poll the process and notify any watchers"""
+    def poll_batch(cls, spawners):
+        """Poll many spawners of this class at once
+
+        Returns a dict of spawner: status, with status as returned by `poll`.
+        Used by the Hub's SpawnerPoller.
+        Override in subclasses that can check many servers more cheaply than one at a time.
+        The default polls each spawner, concurrently.
+        Spawners that fail to poll are logged, and left out.
+        """
+        statuses = {}
+
+        @gen.coroutine
+        def poll(spawner):
+            try:
+                statuses[spawner] = yield spawner.poll()
+            except Exception:
+                spawner.log.exception("Failed to poll spawner for %s", spawner.user.name)
+
+        yield [ poll(spawner) for spawner in spawners ]
+        return statuses
+
+    @gen.coroutine
+    def poll_and_notify(self, cached=False):
+        """Used as a callback to periodically poll the process and notify any watchers
+
+        If cached, a poll finding the server running within `poll_cache_ttl` is trusted,
+        without polling again.
+        """
+        if cached and self._last_running_poll and \
+                IOLoop.current().time() - self._last_running_poll < self.poll_cache_ttl:
+            return None
         status = yield self.poll()
+        yield self.handle_poll(status)
+        return status
+
+    @gen.coroutine
+    def handle_poll(self, status):
+        """Handle the result of a poll, notifying any watchers if the server has stopped"""
         if status is None:
             # still running, nothing to do here
+            self._last_running_poll = IOLoop.current().time()
             return
 
         self.stop_polling()
@@ -628,7 +697,6 @@ class Spawner(LoggingConfigurable):
                 yield gen.maybe_future(callback())
             except Exception:
                 self.log.exception("Unhandled error in poll callback for %s", self)
-        return status
 
     death_interval = Float(0.1)
 
@@ -643,23 +711,40 @@ class Spawner(LoggingConfigurable):
                 yield gen.sleep(self.death_interval)
 
 
-def _try_setcwd(path):
-    """Try to set CWD to path, walking up until a valid directory is found.
+def _proc_start_time(pid):
+    """Return when a process started, in clock ticks after boot, from /proc
 
-    If no valid directory is found, a temp directory is created and cwd is set to that.
+    Together with the pid, this identifies a process,
+    since pids are reused once processes exit.
+    Returns None if the process doesn't exist, or /proc is not available.
     """
-    while path != '/':
-        try:
-            os.chdir(path)
-        except OSError as e:
-            exc = e  # break exception instance out of except scope
-            print("Couldn't set CWD to %s (%s)" % (path, e), file=sys.stderr)
-            path, _ = os.path.split(path)
-        else:
-            return
-    print("Couldn't set CWD at all (%s), using temp dir" % exc, file=sys.stderr)
-    td = mkdtemp()
-    os.chdir(td)
+    try:
+        with open('/proc/%i/stat' % pid) as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name, in parentheses, may contain spaces
+    fields = stat[stat.rindex(')') + 2:].split()
+    # starttime is field 22, counting from pid as 1
+    return int(fields[19])
+
+
+def _running_pids():
+    """Return the set of pids of running processes, from /proc
+
+    Returns None if /proc is not available.
+    """
+    try:
+        return { int(name) for name in os.listdir('/proc') if name.isdigit() }
+    except OSError:
+        return None
+
+
+def user_ids(username):
+    """Return the uid, gid, supplementary gids and home directory of a system user"""
+    user = nss.getpwnam(username)
+    gids = nss.user_gids(username)
+    return user.pw_uid, user.pw_gid, gids, user.pw_dir
 
 
 def set_user_setuid(username, chdir=True):
@@ -668,11 +753,7 @@ def set_user_setuid(username, chdir=True):
     Returned preexec_fn will set uid/gid, and attempt to chdir to the target user's
     home directory.
     """
-    user = pwd.getpwnam(username)
-    uid = user.pw_uid
-    gid = user.pw_gid
-    home = user.pw_dir
-    gids = [ g.gr_gid for g in grp.getgrall() if username in g.gr_mem ]
+    uid, gid, gids, home = user_ids(username)
 
     def preexec():
         """Set uid/gid of current process
@@ -761,6 +842,35 @@ class LocalProcessSpawner(Spawner):
         """
     )
 
+    use_zygote = Bool(False,
+        help="""Start single-user servers from a preloaded zygote process.
+
+        The zygote imports jupyterhub.singleuser once,
+        and forks a server for each spawn, which saves the time
+        each server would otherwise spend importing the notebook package.
+
+        Only applies when `cmd` is the default `jupyterhub-singleuser`
+        and `shell_cmd` is not set. `popen_kwargs` are not used.
+
+        Servers started by the zygote are not children of the Hub,
+        so their exit status is not known, as after a Hub restart.
+        """
+    ).tag(config=True)
+
+    use_preexec_fn = Bool(True,
+        help="""Drop privileges to the user in a preexec_fn, run by a fork of the Hub.
+
+        Running Python code between fork and exec requires a full fork of the Hub,
+        whose memory grows with the number of users.
+        If False, the server is started without a preexec_fn:
+        Popen drops privileges itself on Python >= 3.9,
+        otherwise a small helper process does, before it execs the server.
+        Either way, no Python code runs in the forked Hub.
+
+        `make_preexec_fn` is not used if False.
+        """
+    ).tag(config=True)
+
     proc = Instance(Popen,
         allow_none=True,
         help="""
@@ -773,6 +883,14 @@ class LocalProcessSpawner(Spawner):
         The process id (pid) of the single-user server process spawned for current user.
         """
     )
+    pid_start_time = Integer(0,
+        help="""
+        When the single-user server process started, in clock ticks after boot, if known.
+
+        Used to tell the process apart from later processes with the same pid.
+        """
+    )
+    _exit_notify = Any()
 
     def make_preexec_fn(self, name):
         """
@@ -782,6 +900,23 @@ class LocalProcessSpawner(Spawner):
         """
         return set_user_setuid(name)
 
+    def make_setuid_cmd(self, name, cmd):
+        """Return the command and Popen keyword arguments to run cmd as the user with name `name`
+
+        Used instead of `make_preexec_fn` if `use_preexec_fn` is False.
+        """
+        uid, gid, gids, home = user_ids(name)
+        if sys.version_info >= (3, 9):
+            kwargs = dict(user=uid, group=gid, extra_groups=gids)
+            if os.path.isdir(home):
+                kwargs['cwd'] = home
+            return cmd, kwargs
+        helper = [
+            sys.executable, '-I', setuid.__file__,
+            str(uid), str(gid), ','.join(map(str, gids)), home, '--',
+        ]
+        return helper + cmd, {}
+
     def load_state(self, state):
         """Restore state about spawned single-user server after a hub restart.
 
@@ -790,6 +925,8 @@ class LocalProcessSpawner(Spawner):
         super(LocalProcessSpawner, self).load_state(state)
         if 'pid' in state:
             self.pid = state['pid']
+        if 'pid_start_time' in state:
+            self.pid_start_time = state['pid_start_time']
 
     def get_state(self):
         """Save state that is needed to restore this spawner instance after a hub restore.
@@ -799,18 +936,22 @@ class LocalProcessSpawner(Spawner):
         state = super(LocalProcessSpawner, self).get_state()
         if self.pid:
             state['pid'] = self.pid
+        if self.pid_start_time:
+            state['pid_start_time'] = self.pid_start_time
         return state
 
     def clear_state(self):
         """Clear stored state about this spawner (pid)"""
         super(LocalProcessSpawner, self).clear_state()
         self.pid = 0
+        self.pid_start_time = 0
 
     def user_env(self, env):
         """Augment environment of spawned process with user specific env variables."""
         env['USER'] = self.user.name
-        home = pwd.getpwnam(self.user.name).pw_dir
-        shell = pwd.getpwnam(self.user.name).pw_shell
+        pw = nss.getpwnam(self.user.name)
+        home = pw.pw_dir
+        shell = pw.pw_shell
         # These will be empty if undefined,
         # in which case don't set the env:
         if home:
@@ -825,10 +966,40 @@ class LocalProcessSpawner(Spawner):
         env = self.user_env(env)
         return env
 
+    def _allocate_port(self):
+        """Pick a port for the server, leased from the Hub's range if there is one
+
+        A leased port is recorded on the user's server right away,
+        replacing the random port it was created with,
+        so that User.stop releases this lease even if the start fails.
+        """
+        if self.port_allocator is not None and self.port_allocator.enabled:
+            port = self.port_allocator.allocate()
+            self._record_port(port)
+            return port
+        return random_port()
+
+    def _record_port(self, port):
+        """Set the port of the user's server, whose port User.stop releases"""
+        server = self.user.server
+        if server is not None:
+            server.port = port
+
     @gen.coroutine
     def start(self):
         """Start the single-user server."""
-        self.port = random_port()
+        self.port = self._allocate_port()
+        try:
+            return (yield self._start())
+        except Exception:
+            # the server won't be recorded with this port
+            if self.port_allocator is not None and self.port_allocator.enabled:
+                self.port_allocator.release(self.port)
+                self._record_port(0)
+            raise
+
+    @gen.coroutine
+    def _start(self):
         cmd = []
         env = self.get_env()
 
@@ -840,12 +1011,22 @@ class LocalProcessSpawner(Spawner):
             # add our cmd list as the last (single) argument:
             cmd = self.shell_cmd + [' '.join(pipes.quote(s) for s in cmd)]
 
+        if self.use_zygote:
+            if self.cmd == ['jupyterhub-singleuser'] and not self.shell_cmd:
+                yield self._start_from_zygote(cmd, env)
+                return self._server_address()
+            self.log.warning("Not using the zygote for custom cmd %s", self.cmd)
+
         self.log.info("Spawning %s", ' '.join(pipes.quote(s) for s in cmd))
         
         popen_kwargs = dict(
-            preexec_fn=self.make_preexec_fn(self.user.name),
             start_new_session=True,  # don't forward signals
         )
+        if self.use_preexec_fn:
+            popen_kwargs['preexec_fn'] = self.make_preexec_fn(self.user.name)
+        else:
+            cmd, setuid_kwargs = self.make_setuid_cmd(self.user.name, cmd)
+            popen_kwargs.update(setuid_kwargs)
         popen_kwargs.update(self.popen_kwargs)
         # don't let user config override env
         popen_kwargs['env'] = env
@@ -860,7 +1041,21 @@ class LocalProcessSpawner(Spawner):
             raise
 
         self.pid = self.proc.pid
+        self.pid_start_time = _proc_start_time(self.pid) or 0
+        return self._server_address()
 
+    @gen.coroutine
+    def _start_from_zygote(self, cmd, env):
+        """Start the single-user server from the zygote"""
+        self.log.info("Spawning %s from zygote", ' '.join(pipes.quote(s) for s in cmd))
+        uid, gid, gids, home = user_ids(self.user.name)
+        launcher = ZygoteLauncher.instance(config=self.config)
+        self.proc = None
+        self.pid = yield launcher.launch(cmd, env, uid, gid, gids, home)
+        self.pid_start_time = _proc_start_time(self.pid) or 0
+
+    def _server_address(self):
+        """Return the (ip, port) to return from start"""
         if self.__class__ is not LocalProcessSpawner:
             # subclasses may not pass through return value of super().start,
             # relying on deprecated 0.6 way of setting ip, port,
@@ -883,6 +1078,8 @@ class LocalProcessSpawner(Spawner):
         if self.proc is not None:
             status = self.proc.poll()
             if status is not None:
+                if ProcessWatcher.initialized():
+                    ProcessWatcher.instance().reaped(self.proc.pid, self.proc)
                 # clear state if the process is done
                 self.clear_state()
             return status
@@ -894,15 +1091,93 @@ class LocalProcessSpawner(Spawner):
             self.clear_state()
             return 0
 
-        # send signal 0 to check if PID exists
-        # this doesn't work on Windows, but that's okay because we don't support Windows.
-        alive = yield self._signal(0)
+        if self.pid_start_time:
+            # check that the pid is still the process we started
+            alive = _proc_start_time(self.pid) == self.pid_start_time
+        else:
+            # send signal 0 to check if PID exists
+            # this doesn't work on Windows, but that's okay because we don't support Windows.
+            alive = yield self._signal(0)
         if not alive:
             self.clear_state()
             return 0
         else:
             return None
 
+    @classmethod
+    @gen.coroutine
+    def poll_batch(cls, spawners):
+        """Poll many local processes at once
+
+        Lists running processes once, from /proc,
+        instead of signalling each process.
+        """
+        running = _running_pids()
+        if running is None or cls.poll is not LocalProcessSpawner.poll:
+            # no /proc, or a subclass that polls differently
+            return (yield super().poll_batch(spawners))
+        statuses = {}
+        # children of the Hub, and processes of unknown start time, are polled one by one
+        polled = []
+        for spawner in spawners:
+            if spawner.proc is not None or not spawner.pid_start_time:
+                polled.append(spawner)
+            elif spawner.pid in running and \
+                    _proc_start_time(spawner.pid) == spawner.pid_start_time:
+                statuses[spawner] = None
+            else:
+                spawner.clear_state()
+                statuses[spawner] = 0
+        if polled:
+            statuses.update((yield super().poll_batch(polled)))
+        return statuses
+
+    def _watch_exit(self):
+        """Return a Future resolving when the server process exits
+
+        or None, if it can't be watched and has to be polled.
+        """
+        if not self.pid:
+            return None
+        return ProcessWatcher.instance(config=self.config).watch(self.pid, self.proc)
+
+    @gen.coroutine
+    def wait_for_death(self, timeout=10):
+        """Wait for the single-user server to die, up to timeout seconds
+
+        Returns as soon as the process exits, if it can be watched,
+        instead of polling every `death_interval`.
+        """
+        exited = self._watch_exit()
+        if exited is None:
+            yield super().wait_for_death(timeout)
+            return
+        try:
+            yield gen.with_timeout(timedelta(seconds=timeout), exited)
+        except gen.TimeoutError:
+            pass
+
+    def start_polling(self):
+        """Start polling, and notice right away if the process exits"""
+        super().start_polling()
+        if self.poll_interval <= 0:
+            return
+        exited = self._watch_exit()
+        if exited is not None:
+            # regular polls continue, in case the pid was reused before it was watched
+            self._exit_notify = exited
+            IOLoop.current().add_future(exited, self._exited)
+
+    def stop_polling(self):
+        super().stop_polling()
+        self._exit_notify = None
+
+    def _exited(self, f):
+        # ignore exits after polling was stopped, e.g. by an explicit stop
+        if self._exit_notify is f:
+            self._exit_notify = None
+            IOLoop.current().add_callback(self.poll_and_notify)
+
     @gen.coroutine
     def _signal(self, sig):
         """Send given signal to a single-user server's process.
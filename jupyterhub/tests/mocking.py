@@ -8,19 +8,26 @@ from unittest import mock
 
 import requests
 
-from tornado import gen
+from jinja2 import Environment, FileSystemLoader
+from tornado import gen, web
 from tornado.concurrent import Future
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
 from tornado.ioloop import IOLoop
 
 from traitlets import default
 
 from ..app import JupyterHub
-from ..auth import PAMAuthenticator
+from ..auth import Authenticator, PAMAuthenticator
 from .. import orm
-from ..objects import Server
+from .._data import DATA_FILES_PATH
+from ..emptyclass import EmptyClass
+from ..jobs import JobQueue
+from ..admission import SpawnAdmission
+from ..objects import Hub, Server
 from ..spawner import LocalProcessSpawner
 from ..singleuser import SingleUserNotebookApp
-from ..utils import random_port, url_path_join
+from ..user import UserDict
+from ..utils import random_port, url_path_join, ModelCache
 
 from pamela import PAMError
 
@@ -109,13 +116,16 @@ class MockPAMAuthenticator(PAMAuthenticator):
         # skip the add-system-user bit
         return not user.name.startswith('dne')
     
+    @gen.coroutine
     def authenticate(self, *args, **kwargs):
+        # pamela is called on a thread, so keep it patched until it returns
         with mock.patch.multiple('pamela',
                 authenticate=mock_authenticate,
                 open_session=mock_open_session,
                 close_session=mock_open_session,
                 ):
-            return super(MockPAMAuthenticator, self).authenticate(*args, **kwargs)
+            username = yield super(MockPAMAuthenticator, self).authenticate(*args, **kwargs)
+        return username
 
 
 class MockHub(JupyterHub):
@@ -227,6 +237,141 @@ def public_url(app, user_or_service=None, path=''):
         return host + prefix
 
 
+# handler mocking, for testing handlers without running a Hub:
+
+def mock_settings(db, **kwargs):
+    """Return minimal tornado settings for instantiating Hub handlers
+
+    `users` is a UserDict on `db`, and `query_counter` counts queries on `db`.
+    Jobs submitted to `job_queue` are not run unless it is started.
+    """
+    settings = dict(
+        db=db,
+        hub=Hub(base_url='/hub/', cookie_name='jupyter-hub-token'),
+        authenticator=Authenticator(),
+        cookie_secret=b'secret',
+        cookie_max_age_days=14,
+        base_url='/',
+        login_url='/hub/login',
+        logout_url='/hub/logout',
+        static_path=os.path.join(DATA_FILES_PATH, 'static'),
+        jinja2_env=Environment(
+            loader=FileSystemLoader(os.path.join(DATA_FILES_PATH, 'templates')),
+        ),
+        statsd=EmptyClass(),
+        query_counter=orm.QueryCounter(db.get_bind()),
+        model_cache=ModelCache(),
+        job_queue=JobQueue(db_factory=lambda: db),
+        spawn_admission=SpawnAdmission(db_factory=lambda: db),
+    )
+    settings.update(kwargs)
+    settings.setdefault('users', UserDict(db_factory=lambda: db, settings=settings))
+    return settings
+
+
+class MockConnection(object):
+    """An HTTP connection that records the response written to it"""
+    def __init__(self):
+        self.start_line = None
+        self.headers = None
+        self.chunks = []
+        self.finished = False
+
+    def _done(self):
+        f = Future()
+        f.set_result(None)
+        return f
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        self.start_line = start_line
+        self.headers = headers
+        if chunk:
+            self.chunks.append(chunk)
+        return self._done()
+
+    def write(self, chunk, callback=None):
+        self.chunks.append(chunk)
+        return self._done()
+
+    def finish(self):
+        self.finished = True
+
+
+def mock_handler(Handler, settings, method='GET', uri='/', headers=None, body=b''):
+    """Instantiate a handler for a single request, without a server
+
+    Output written by the handler can be retrieved with `handler_output`.
+    """
+    application = web.Application(**settings)
+    request = HTTPServerRequest(method, uri,
+        headers=HTTPHeaders(headers or {}),
+        body=body,
+        connection=MockConnection(),
+    )
+    handler = Handler(application, request)
+    # normally set by Handler._execute
+    handler._transforms = []
+    return handler
+
+
+def handler_output(handler):
+    """Return the bytes written by a handler created with mock_handler
+
+    Includes output that has been flushed and output that is still buffered.
+    """
+    return b''.join(handler.request.connection.chunks + handler._write_buffer)
+
+
+def mock_request(Handler, settings, uri, *args, method='GET', token=None, headers=None, body=b''):
+    """Make a single request to a handler created with mock_handler
+
+    Runs the handler's method with `args` on the current IOLoop and finishes the response,
+    sending an error page for an HTTPError as tornado would.
+    Changes not committed by the handler are rolled back afterwards.
+
+    Returns the handler. The number of queries made by the request,
+    not counting authentication, is stored in `handler.queries`.
+    """
+    headers = dict(headers or {})
+    if token:
+        headers['Authorization'] = 'token %s' % token
+    handler = mock_handler(Handler, settings, method=method, uri=uri,
+        headers=headers, body=body)
+    counter = settings['query_counter']
+    before = counter.count
+    try:
+        IOLoop.current().run_sync(lambda: getattr(handler, method.lower())(*args))
+    except web.HTTPError as e:
+        handler.send_error(e.status_code, exc_info=sys.exc_info())
+    if not handler._finished:
+        handler.finish()
+    handler.queries = counter.count - before - handler.request_stats['auth_queries']
+    settings['db'].rollback()
+    return handler
+
+
+def add_running_users(settings, prefix, n):
+    """Add n users to the db, each with a server and a group of their own
+
+    For checking that the queries made by a request don't grow with the number of users.
+    """
+    db = settings['db']
+    users = settings['users']
+    orm_users = []
+    for i in range(n):
+        name = '%s-%i' % (prefix, db.query(orm.User).count() + i)
+        orm_user = orm.User(name=name)
+        orm_user.servers.append(orm.Server())
+        orm_user.groups.append(orm.Group(name='%s-group' % name))
+        orm_users.append(orm_user)
+    db.add_all(orm_users)
+    db.commit()
+    return [ users[orm_user] for orm_user in orm_users ]
+
+
 # single-user-server mocking:
 
 class MockSingleUserServer(SingleUserNotebookApp):
@@ -0,0 +1,129 @@
+"""Tests for spawn admission control"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from sqlalchemy import event
+from tornado import gen
+
+from .. import orm
+from ..admission import SpawnAdmission, read_available_memory
+
+
+def add_users(db, prefix, n):
+    users = [ orm.User(name='%s-%i' % (prefix, i)) for i in range(n) ]
+    db.add_all(users)
+    db.commit()
+    return users
+
+
+def test_no_limits(db):
+    admission = SpawnAdmission(db_factory=lambda: db)
+    users = add_users(db, 'unlimited', 3)
+    assert all(admission.admit(user) for user in users)
+    assert admission.position(users[0]) is None
+
+
+def test_max_pending_spawns(db, io_loop):
+    admission = SpawnAdmission(db_factory=lambda: db, max_pending_spawns=2)
+    users = add_users(db, 'pending', 5)
+
+    @gen.coroutine
+    def check():
+        assert admission.admit(users[0])
+        assert admission.admit(users[1])
+        assert not admission.admit(users[2])
+        waiting = [ admission.wait(user) for user in users[2:] ]
+        assert [ admission.position(user) for user in users ] == [None, None, 1, 2, 3]
+        # a new request can't jump the queue, even if there is room
+        admission.release(users[0])
+        assert waiting[0].done()
+        assert admission.position(users[3]) == 1
+        admission.release(users[1])
+        admission.release(users[2])
+        yield waiting[1:]
+        assert admission.position(users[4]) is None
+
+    io_loop.run_sync(check)
+
+
+def test_group_limits(db, io_loop):
+    admission = SpawnAdmission(db_factory=lambda: db,
+        group_limits={'limited': 1}, recheck_interval=0.01)
+    users = add_users(db, 'grouped', 3)
+    group = orm.Group(name='limited', users=users[:2])
+    db.add(group)
+    db.commit()
+
+    @gen.coroutine
+    def check():
+        assert admission.admit(users[0])
+        waiting = admission.wait(users[1])
+        assert admission.position(users[1]) == 1
+        # users outside the group are not held up by the queue
+        assert admission.admit(users[2])
+        # the first spawn finishes, and its server keeps running
+        server = orm.Server()
+        users[0].servers.append(server)
+        db.commit()
+        admission.release(users[0])
+        yield gen.sleep(0.05)
+        assert not waiting.done()
+        # the server stops, which is noticed on the next check
+        db.delete(server)
+        db.commit()
+        yield gen.with_timeout(io_loop.time() + 1, waiting)
+
+    io_loop.run_sync(check)
+
+
+def test_group_limits_queries(db, io_loop):
+    admission = SpawnAdmission(db_factory=lambda: db,
+        group_limits={'queue-a': 1, 'queue-b': 1}, recheck_interval=30)
+    users = add_users(db, 'queued', 12)
+    db.add(orm.Group(name='queue-a', users=users))
+    db.add(orm.Group(name='queue-b', users=users))
+    db.commit()
+
+    queries = []
+    def count(*args):
+        queries.append(args)
+
+    @gen.coroutine
+    def check():
+        assert admission.admit(users[0])
+        waiting = [ admission.wait(user) for user in users[1:] ]
+        event.listen(db.bind, 'before_cursor_execute', count)
+        try:
+            # one pass over the whole queue, blocked by both groups
+            admission.release(users[1])
+        finally:
+            event.remove(db.bind, 'before_cursor_execute', count)
+        assert len(queries) == 1
+        assert not any(f.done() for f in waiting)
+        admission.release(users[0])
+        assert waiting[0].done()
+        assert not any(f.done() for f in waiting[1:])
+
+    io_loop.run_sync(check)
+    for group in db.query(orm.Group).filter(orm.Group.name.in_(['queue-a', 'queue-b'])):
+        db.delete(group)
+    db.commit()
+
+
+def test_min_free_memory(db, tmpdir):
+    meminfo = tmpdir.join('meminfo')
+    meminfo.write('\n'.join([
+        'MemTotal:        8000000 kB',
+        'MemFree:          100000 kB',
+        'MemAvailable:    1000000 kB',
+    ]))
+    assert read_available_memory(str(meminfo)) == 1000000 * 1024
+    assert read_available_memory(str(tmpdir.join('nope'))) is None
+
+    admission = SpawnAdmission(db_factory=lambda: db, meminfo_path=str(meminfo),
+        min_free_memory=2 * 2**30)
+    user, = add_users(db, 'memory', 1)
+    assert not admission.admit(user)
+    admission.min_free_memory = 2**29
+    assert admission.admit(user)
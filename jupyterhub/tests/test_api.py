@@ -1,21 +1,30 @@
 """Tests for the REST API."""
 
+from datetime import datetime, timedelta
 import json
 import time
 from queue import Queue
 import sys
 from unittest import mock
-from urllib.parse import urlparse, quote
+from urllib.parse import urlparse, quote, parse_qs
 
 from pytest import mark, yield_fixture
 import requests
 
-from tornado import gen
+from tornado import gen, web
+from tornado.httputil import url_concat
 
 import jupyterhub
 from .. import orm
+from ..apihandlers.jobs import JobAPIHandler
+from ..apihandlers.groups import GroupAPIHandler, GroupListAPIHandler, GroupUsersAPIHandler
+from ..admission import SpawnAdmission
+from ..apihandlers.users import (
+    BulkServerAPIHandler, BulkUserAPIHandler, UserAPIHandler, UserListAPIHandler,
+    UserServerAPIHandler, UserServerReadyAPIHandler,
+)
 from ..user import User
-from ..utils import url_path_join as ujoin
+from ..utils import url_path_join as ujoin, hash_token, digest_token, TokenCache
 from . import mocking
 from .mocking import public_host, public_url
 
@@ -217,6 +226,563 @@ def test_get_users(app):
     assert r.status_code == 403
 
 
+@mark.user
+def test_legacy_token_upgraded(db, io_loop):
+    settings = mocking.mock_settings(db, token_cache=TokenCache())
+    users = settings['users']
+    user = users[add_user(db, name='legacy-token-user')]
+    token = 'legacy-token-for-legacy-token-user'
+    orm_token = orm.APIToken(user_id=user.id, prefix=token[:4],
+        hashed=hash_token(token, rounds=orm.APIToken.rounds, algorithm='sha512'),
+    )
+    db.add(orm_token)
+    db.commit()
+
+    def get():
+        handler = mocking.mock_request(UserAPIHandler, settings,
+            '/hub/api/users/legacy-token-user', 'legacy-token-user', token=token)
+        assert handler.get_status() == 200
+
+    # the upgrade is kept, although the handler rolls back when it finishes
+    get()
+    db.expire_all()
+    assert orm_token.digest == digest_token(token)
+    assert orm_token.hashed is None
+    with mock.patch.object(orm.APIToken, 'match') as match:
+        get()
+        get()
+    assert not match.called
+
+
+@mark.user
+def test_get_users_queries(db, io_loop):
+    settings = mocking.mock_settings(db)
+    users = settings['users']
+    admin = users[add_user(db, name='list-queries', admin=True)]
+    token = admin.new_api_token()
+
+    def count_queries():
+        handler = mocking.mock_request(UserListAPIHandler, settings, '/hub/api/users',
+            token=token)
+        models = json.loads(mocking.handler_output(handler).decode('utf8'))
+        assert len(models) == db.query(orm.User).count()
+        return handler.queries
+
+    mocking.add_running_users(settings, 'list-queries', 2)
+    # the first request loads the requesting user
+    count_queries()
+    few = count_queries()
+    mocking.add_running_users(settings, 'list-queries', 10)
+    assert count_queries() == few
+
+
+@mark.user
+def test_get_users_filter_paginate(db, io_loop):
+    settings = mocking.mock_settings(db)
+    users = settings['users']
+    admin = users[add_user(db, name='page-admin', admin=True)]
+    token = admin.new_api_token()
+    group = orm.Group(name='page-group')
+    db.add(group)
+    t0 = datetime(2017, 1, 1)
+    for i in range(5):
+        user = users[add_user(db, name='page-%i' % i,
+            last_activity=t0 + timedelta(days=i))]
+        if i < 3:
+            user.servers.append(orm.Server())
+        if i % 2:
+            user.groups.append(group)
+    db.commit()
+    users['page-2'].spawn_pending = True
+    # only look at the users created here
+    prefix = 'page-'
+
+    def get_users(**args):
+        handler = mocking.mock_request(UserListAPIHandler, settings,
+            url_concat('/hub/api/users', args), token=token)
+        assert handler.get_status() == 200
+        models = json.loads(mocking.handler_output(handler).decode('utf8'))
+        names = [ m['name'] for m in models if m['name'].startswith(prefix) ]
+        return names, handler._headers.get('Link')
+
+    names, link = get_users(state='running')
+    assert names == ['page-0', 'page-1']
+    names, link = get_users(state='pending')
+    assert names == ['page-2']
+    names, link = get_users(state='inactive', admin='false')
+    assert names == ['page-3', 'page-4']
+    names, link = get_users(group='page-group')
+    assert names == ['page-1', 'page-3']
+    names, link = get_users(inactive_since='2017-01-03T00:00:00Z')
+    assert names == ['page-0', 'page-1']
+    names, link = get_users(admin='true')
+    assert names == ['page-admin']
+
+    # keyset pagination
+    pages = []
+    args = {'sort': 'last_activity', 'inactive_since': '2017-01-10T00:00:00', 'limit': '2'}
+    while True:
+        names, link = get_users(**args)
+        pages.append(names)
+        if link is None:
+            break
+        assert link.endswith('>; rel="next"')
+        next_url = link[1:].split('>', 1)[0]
+        args = { key: values[0] for key, values in parse_qs(urlparse(next_url).query).items() }
+        assert args['limit'] == '2'
+    assert pages == [['page-0', 'page-1'], ['page-2', 'page-3'], ['page-4']]
+
+    for bad in [{'state': 'asleep'}, {'limit': '-1'}, {'admin': 'maybe'},
+                {'sort': 'cookie_id'}, {'cursor': 'garbage'}, {'inactive_since': 'today'}]:
+        handler = mocking.mock_request(UserListAPIHandler, settings,
+            url_concat('/hub/api/users', bad), token=token)
+        assert handler.get_status() == 400
+
+
+@mark.user
+def test_get_users_ndjson(db, io_loop):
+    settings = mocking.mock_settings(db)
+    users = settings['users']
+    admin = users[add_user(db, name='export-admin', admin=True)]
+    token = admin.new_api_token()
+    for i in range(5):
+        user = users[add_user(db, name='export-%i' % i)]
+        user.servers.append(orm.Server())
+    users['export-1'].spawn_pending = True
+    # not loaded
+    add_user(db, name='export-5')
+    db.commit()
+    loaded = len(users)
+    handler = mocking.mock_handler(UserListAPIHandler, settings,
+        uri='/hub/api/users?sort=name',
+        headers={
+            'Authorization': 'token %s' % token,
+            'Accept': 'application/x-ndjson',
+        },
+    )
+    handler.export_chunk_size = 2
+    flushes = []
+    real_flush = handler.flush
+    def flush(*args, **kwargs):
+        flushes.append(len(handler.request.connection.chunks))
+        return real_flush(*args, **kwargs)
+    handler.flush = flush
+    io_loop.run_sync(handler.get)
+    db.rollback()
+
+    assert handler._headers['Content-Type'] == 'application/x-ndjson'
+    lines = mocking.handler_output(handler).decode('utf8').splitlines()
+    models = [ json.loads(line) for line in lines ]
+    names = [ m['name'] for m in models ]
+    assert names == sorted(names)
+    assert len(names) == db.query(orm.User).count()
+    exported = [ m for m in models if m['name'].startswith('export-') ]
+    assert [ m['name'] for m in exported ] == [
+        'export-0', 'export-1', 'export-2', 'export-3', 'export-4', 'export-5', 'export-admin']
+    assert len(exported[0]['servers']) == 1
+    assert exported[1]['pending'] == 'spawn'
+    assert exported[-1]['servers'] == []
+    # exporting doesn't load users
+    assert len(users) == loaded
+    users['export-1'].spawn_pending = False
+    # output is flushed one chunk at a time
+    assert len(flushes) == len(names) // 2
+    assert flushes == sorted(flushes)
+
+
+@mark.user
+@mark.group
+def test_model_etags(db, io_loop):
+    settings = mocking.mock_settings(db)
+    users = settings['users']
+    admin = users[add_user(db, name='etag-admin', admin=True)]
+    user = users[add_user(db, name='etag-user')]
+    group = orm.Group(name='etag-group')
+    db.add(group)
+    db.commit()
+    token = admin.new_api_token()
+
+    def request(Handler, uri, *args, etag=None, method='GET', body=b''):
+        return mocking.mock_request(Handler, settings, uri, *args, method=method,
+            token=token, headers={'If-None-Match': etag} if etag else None, body=body)
+
+    for Handler, uri, args in [
+        (UserListAPIHandler, '/hub/api/users', ()),
+        (UserAPIHandler, '/hub/api/users/etag-user', ('etag-user',)),
+        (GroupListAPIHandler, '/hub/api/groups', ()),
+        (GroupAPIHandler, '/hub/api/groups/etag-group', ('etag-group',)),
+    ]:
+        handler = request(Handler, uri, *args)
+        assert handler.get_status() == 200
+        etag = handler._headers['Etag']
+        body = mocking.handler_output(handler)
+        json.loads(body.decode('utf8'))
+
+        # unchanged: 304 without touching the db
+        handler = request(Handler, uri, *args, etag=etag)
+        assert handler.get_status() == 304
+        assert handler.queries == 0
+
+        # any change to a user or group invalidates the ETag
+        request(GroupUsersAPIHandler, '/hub/api/groups/etag-group/users', 'etag-group',
+            method='POST', body=json.dumps({'users': ['etag-user']}).encode('utf8'))
+        handler = request(Handler, uri, *args, etag=etag)
+        assert handler.get_status() == 200
+        assert handler._headers['Etag'] != etag
+        assert mocking.handler_output(handler) != body
+        request(GroupUsersAPIHandler, '/hub/api/groups/etag-group/users', 'etag-group',
+            method='DELETE', body=json.dumps({'users': ['etag-user']}).encode('utf8'))
+
+    # so do changes made directly in the ORM
+    handler = request(GroupAPIHandler, '/hub/api/groups/etag-group', 'etag-group')
+    etag = handler._headers['Etag']
+    group.users.append(user.orm_user)
+    db.commit()
+    handler = request(GroupAPIHandler, '/hub/api/groups/etag-group', 'etag-group', etag=etag)
+    assert handler.get_status() == 200
+    assert json.loads(mocking.handler_output(handler).decode('utf8'))['users'] == ['etag-user']
+
+    # a group that doesn't exist is not found, whatever the ETag
+    model_cache = settings['model_cache']
+    handler = request(GroupAPIHandler, '/hub/api/groups/etag-nogroup', 'etag-nogroup',
+        etag=model_cache.etag('group', 'etag-nogroup'))
+    assert handler.get_status() == 404
+    handler = request(GroupAPIHandler, '/hub/api/groups/etag-gone', 'etag-gone', method='POST')
+    assert handler.get_status() == 201
+    handler = request(GroupAPIHandler, '/hub/api/groups/etag-gone', 'etag-gone')
+    etag = handler._headers['Etag']
+    handler = request(GroupAPIHandler, '/hub/api/groups/etag-gone', 'etag-gone', method='DELETE')
+    assert handler.get_status() == 204
+    handler = request(GroupAPIHandler, '/hub/api/groups/etag-gone', 'etag-gone', etag=etag)
+    assert handler.get_status() == 404
+
+    # stopping bumps the user's version
+    request(UserAPIHandler, '/hub/api/users/etag-user', 'etag-user')
+    assert model_cache.get('user', user.id) is not None
+    version = model_cache.version('user', user.id)
+    io_loop.run_sync(user.stop)
+    assert model_cache.version('user', user.id) > version
+    assert model_cache.get('user', user.id) is None
+
+
+@mark.group
+def test_group_members(db, io_loop):
+    settings = mocking.mock_settings(db)
+    users = settings['users']
+    admin = users[add_user(db, name='members-admin', admin=True)]
+    token = admin.new_api_token()
+    names = [ 'member-%02i' % i for i in range(30) ]
+    for name in names:
+        add_user(db, name=name)
+    group = orm.Group(name='members')
+    db.add(group)
+    db.commit()
+
+    def request(Handler, uri, *args, method='GET', data=None):
+        handler = mocking.mock_request(Handler, settings, uri, *args, method=method,
+            token=token, body=json.dumps(data).encode('utf8') if data else b'')
+        return json.loads(mocking.handler_output(handler).decode('utf8')), handler.queries
+
+    def add_members(members):
+        return request(GroupUsersAPIHandler, '/hub/api/groups/members/users', 'members',
+            method='POST', data={'users': members})
+
+    model, few = add_members(names[:2])
+    assert model['user_count'] == 2
+    # adding many users costs the same number of queries
+    model, many = add_members(names)
+    assert model['user_count'] == 30
+    assert many == few
+
+    model, queries = request(GroupAPIHandler, '/hub/api/groups/members?offset=10&limit=5', 'members')
+    assert model['users'] == names[10:15]
+    assert model['user_count'] == 30
+    model, queries = request(GroupListAPIHandler, '/hub/api/groups?limit=0')
+    model = [ g for g in model if g['name'] == 'members' ][0]
+    assert model == {'kind': 'group', 'name': 'members', 'users': [], 'user_count': 30}
+
+    model, queries = request(GroupUsersAPIHandler, '/hub/api/groups/members/users', 'members',
+        method='DELETE', data={'users': names[5:]})
+    assert model['users'] == names[:5]
+    assert [ g.name for g in users['member-00'].groups ] == ['members']
+    assert users['member-05'].groups == []
+
+    handler = mocking.mock_request(GroupUsersAPIHandler, settings,
+        '/hub/api/groups/members/users', 'members', method='POST', token=token,
+        body=json.dumps({'users': ['member-00', 'nobody']}).encode('utf8'))
+    assert handler.get_status() == 400
+
+
+@mark.user
+def test_bulk_users(db, io_loop):
+    settings = mocking.mock_settings(db, bulk_user_concurrency=2)
+    users = settings['users']
+    authenticator = settings['authenticator']
+    admin = users[add_user(db, name='bulk-admin', admin=True)]
+    add_user(db, name='bulk-exists')
+    token = admin.new_api_token()
+    running = []
+    max_running = []
+
+    @gen.coroutine
+    def add_user_hook(user):
+        running.append(user.name)
+        max_running.append(len(running))
+        yield gen.sleep(0.01)
+        running.remove(user.name)
+        if user.name == 'bulk-fail':
+            raise ValueError("no room for bulk-fail")
+
+    def request(method, data):
+        handler = mocking.mock_request(BulkUserAPIHandler, settings, '/hub/api/bulk/users',
+            method=method, token=token, body=json.dumps(data).encode('utf8'))
+        return json.loads(mocking.handler_output(handler).decode('utf8'))
+
+    names = ['bulk-%i' % i for i in range(5)] + ['bulk-exists', 'bulk-fail', 'Bulk-0', '']
+    with mock.patch.object(authenticator, 'add_user', add_user_hook):
+        results = request('POST', {'usernames': names, 'admin': True})
+    assert list(results) == names[:-2] + ['']
+    statuses = { name: result['status'] for name, result in results.items() }
+    assert statuses == dict(
+        [ ('bulk-%i' % i, 'created') for i in range(5) ],
+        **{'bulk-exists': 'exists', 'bulk-fail': 'failed', '': 'invalid'}
+    )
+    assert results['bulk-fail']['message'] == 'no room for bulk-fail'
+    assert results['bulk-0']['user']['admin']
+    assert max(max_running) == 2
+    # data directories are created by one job
+    job = db.query(orm.Job).filter(orm.Job.id == results['bulk-0']['job']).one()
+    assert job.state == 'pending'
+    assert job.spec['commands'] == [
+        ['mkdir', '-p', '-m', '777', '/home/bulk-%i/data' % i] for i in range(5)
+    ]
+    # failed users are removed again
+    assert find_user(db, 'bulk-fail') is None
+    for i in range(5):
+        assert orm.User_info.find(db, 'bulk-%i' % i).data_dir == '/home/bulk-%i/data' % i
+
+    results = request('DELETE', {'usernames': ['bulk-0', 'bulk-1', 'bulk-nobody', 'bulk-admin']})
+    assert { name: result['status'] for name, result in results.items() } == {
+        'bulk-0': 'deleted',
+        'bulk-1': 'deleted',
+        'bulk-nobody': 'not found',
+        'bulk-admin': 'failed',
+    }
+    assert find_user(db, 'bulk-0') is None
+    assert find_user(db, 'bulk-2') is not None
+    assert db.query(orm.User_info).filter(orm.User_info.home == '/home/bulk-0').count() == 0
+
+
+@mark.user
+def test_patch_user_job(db, io_loop, tmpdir):
+    settings = mocking.mock_settings(db)
+    users = settings['users']
+    admin = users[add_user(db, name='patch-admin', admin=True)]
+    user = users[add_user(db, name='patch-user')]
+    db.add(orm.User_info(user_id=user.id, **orm.User_info.defaults('patch-user')))
+    db.commit()
+    token = admin.new_api_token()
+
+    def request(Handler, uri, *args, method='GET', data=None):
+        handler = mocking.mock_request(Handler, settings, uri, *args, method=method,
+            token=token, body=json.dumps(data).encode('utf8') if data else b'')
+        return handler, json.loads(mocking.handler_output(handler).decode('utf8'))
+
+    # no filesystem changes, no job
+    handler, model = request(UserAPIHandler, '/hub/api/users/patch-user', 'patch-user',
+        method='PATCH', data={'admin': True})
+    assert handler.get_status() == 200
+    assert model['admin']
+
+    data_dir = str(tmpdir.join('patch-data'))
+    handler, model = request(UserAPIHandler, '/hub/api/users/patch-user', 'patch-user',
+        method='PATCH', data={'data': data_dir, 'shell': '/bin/sh'})
+    assert handler.get_status() == 202
+    location = handler._headers['Location']
+    job_id = location.rsplit('/', 1)[1]
+    assert location == '/hub/api/jobs/%s' % job_id
+    job = db.query(orm.Job).filter(orm.Job.id == int(job_id)).one()
+    # the old data dir doesn't exist, so the new one is created
+    assert job.spec == {
+        'commands': [
+            ['mkdir', '-p', '-m', '777', data_dir],
+            ['usermod', '-s', '/bin/sh', 'patch-user'],
+        ],
+        'user_info': {'data_dir': data_dir, 'shell': '/bin/sh'},
+    }
+    # user_info is not changed until the job is done
+    assert orm.User_info.find(db, 'patch-user').data_dir == '/home/patch-user/data'
+
+    handler, model = request(JobAPIHandler, location, job_id)
+    assert model['state'] == 'pending'
+    assert model['user'] == 'patch-user'
+    assert model['progress'] == 0
+    assert model['total'] == 2
+
+
+@mark.user
+def test_bulk_servers(db, io_loop):
+    settings = mocking.mock_settings(db, bulk_server_concurrency=2)
+    users = settings['users']
+    admin = users[add_user(db, name='servers-admin', admin=True)]
+    token = admin.new_api_token()
+    names = [ 'servers-%i' % i for i in range(5) ]
+    for name in names:
+        add_user(db, name=name)
+    group = orm.Group(name='servers-group')
+    db.add(group)
+    db.flush()
+    group.add_users([ users[name].id for name in names[:2] ])
+    db.commit()
+    users['servers-4'].spawn_pending = True
+    running = []
+    max_running = []
+
+    @gen.coroutine
+    def spawn_single_user(self, user, options=None):
+        running.append(user.name)
+        max_running.append(len(running))
+
+        # a slow spawn, still going when spawn_single_user returns
+        @gen.coroutine
+        def spawn():
+            yield gen.sleep(0.05)
+            running.remove(user.name)
+            if user.name == 'servers-3':
+                raise ValueError("no room for servers-3")
+        return spawn()
+
+    def request(method, data):
+        handler = mocking.mock_request(BulkServerAPIHandler, settings, '/hub/api/bulk/servers',
+            method=method, token=token, body=json.dumps(data).encode('utf8'))
+        return handler, json.loads(mocking.handler_output(handler).decode('utf8'))
+
+    @gen.coroutine
+    def wait_for_job(job_id):
+        while True:
+            db.expire_all()
+            job = db.query(orm.Job).filter(orm.Job.id == job_id).one()
+            if job.state != 'running':
+                return job
+            yield gen.sleep(0.01)
+
+    with mock.patch.object(BulkServerAPIHandler, 'spawn_single_user', spawn_single_user):
+        handler, model = request('POST', {'users': names + ['servers-0']})
+        assert handler.get_status() == 202
+        assert handler._headers['Location'] == '/hub/api/jobs/%i' % model['id']
+        assert model['state'] == 'running'
+        assert model['total'] == 5
+        assert model['results'] == { name: {'state': 'pending'} for name in names }
+        job = io_loop.run_sync(lambda: wait_for_job(model['id']), timeout=10)
+    assert max(max_running) == 2
+    assert job.state == 'done'
+    assert job.progress == 5
+    assert job.message == '1 of 5 tasks failed'
+    assert job.results == {
+        'servers-0': {'state': 'done'},
+        'servers-1': {'state': 'done'},
+        'servers-2': {'state': 'done'},
+        'servers-3': {'state': 'failed', 'message': 'no room for servers-3'},
+        'servers-4': {'state': 'skipped', 'message': 'Spawn already pending'},
+    }
+
+    # stop a group's servers, none of which are running
+    handler, model = request('DELETE', {'group': 'servers-group'})
+    assert handler.get_status() == 202
+    job = io_loop.run_sync(lambda: wait_for_job(model['id']), timeout=10)
+    assert job.action == 'stop_servers'
+    assert job.results == {
+        name: {'state': 'skipped', 'message': 'Not running'} for name in names[:2]
+    }
+
+    njobs = db.query(orm.Job).count()
+    for data in [{}, {'users': []}, {'users': ['servers-nobody']}, {'group': 'nogroup'}]:
+        handler, model = request('POST', data)
+        assert handler.get_status() == 400
+    assert db.query(orm.Job).count() == njobs
+
+
+@mark.user
+def test_spawn_not_admitted(db, io_loop):
+    settings = mocking.mock_settings(db)
+    settings['spawn_admission'] = SpawnAdmission(db_factory=lambda: db,
+        max_pending_spawns=1, retry_after=30)
+    users = settings['users']
+    busy = users[add_user(db, name='admission-busy')]
+    user = users[add_user(db, name='admission-user')]
+    token = user.new_api_token()
+    assert settings['spawn_admission'].admit(busy)
+
+    with mock.patch.object(User, 'spawn') as spawn:
+        handler = mocking.mock_request(UserServerAPIHandler, settings,
+            '/hub/api/users/admission-user/server', 'admission-user',
+            method='POST', token=token)
+    assert not spawn.called
+    assert handler.get_status() == 429
+    assert handler._headers['Retry-After'] == '30'
+    assert settings['spawn_admission'].position(user) is None
+
+
+@mark.user
+def test_queued_spawn_fails_before_starting(db, io_loop):
+    settings = mocking.mock_settings(db)
+    admission = settings['spawn_admission'] = SpawnAdmission(db_factory=lambda: db,
+        max_pending_spawns=1)
+    users = settings['users']
+    user = users[add_user(db, name='admission-failed')]
+    other = users[add_user(db, name='admission-next')]
+    token = user.new_api_token()
+    handler = mocking.mock_handler(UserServerAPIHandler, settings, method='POST',
+        uri='/hub/api/users/admission-failed/server',
+        headers={'Authorization': 'token %s' % token},
+    )
+    admitted = admission.wait(user)
+    assert admitted.done()
+    # the spawn fails before starting, because one is already pending
+    user.spawn_pending = True
+    try:
+        io_loop.run_sync(lambda: handler._spawn_when_admitted(user, admitted))
+    finally:
+        user.spawn_pending = False
+    # and doesn't keep its place
+    assert admission.admit(other)
+    admission.release(other)
+
+
+def test_server_ready(db, io_loop):
+    settings = mocking.mock_settings(db)
+    users = settings['users']
+    user = users[add_user(db, name='ready-user')]
+    users[add_user(db, name='ready-other')]
+    admin = users[add_user(db, name='ready-admin', admin=True)]
+    # the token issued to the server by User.spawn
+    user.spawner.api_token = token = user.new_api_token()
+
+    def post(name, token=None, headers=None):
+        handler = mocking.mock_request(UserServerReadyAPIHandler, settings,
+            '/hub/api/users/%s/server/ready' % name, name, method='POST',
+            token=token, headers=headers)
+        return handler.get_status()
+
+    # nothing waiting for it
+    assert post('ready-user', token) == 204
+    # a spawn waiting for the server
+    user._server_ready = ready = gen.Future()
+    # only the server's own token is accepted
+    cookie_name = settings['hub'].cookie_name
+    cookie = web.create_signed_value(settings['cookie_secret'], cookie_name, user.cookie_id)
+    assert post('ready-user', headers={'Cookie': '%s=%s' % (cookie_name, cookie.decode('ascii'))}) == 403
+    assert post('ready-user', user.new_api_token()) == 403
+    assert post('ready-user', admin.new_api_token()) == 403
+    assert post('ready-other', token) == 403
+    assert post('ready-nobody', token) == 403
+    assert post('ready-user') == 403
+    assert not ready.done()
+    assert post('ready-user', token) == 204
+    assert ready.done()
+    user._server_ready = None
+
+
 @mark.user
 def test_add_user(app):
     db = app.db
@@ -274,7 +840,9 @@ def test_add_multi_user(app):
     r = api_request(app, 'users', method='post',
         data=json.dumps({'usernames': names}),
     )
-    assert r.status_code == 201
+    # data directories are created by a background job
+    assert r.status_code == 202
+    assert r.headers['Location'].startswith(ujoin(app.hub.base_url, 'api/jobs/'))
     reply = r.json()
     r_names = [ user['name'] for user in reply ]
     assert names == r_names
@@ -297,7 +865,7 @@ def test_add_multi_user(app):
     r = api_request(app, 'users', method='post',
         data=json.dumps({'usernames': names}),
     )
-    assert r.status_code == 201
+    assert r.status_code == 202
     reply = r.json()
     r_names = [ user['name'] for user in reply ]
     assert r_names == ['ab']
@@ -310,7 +878,7 @@ def test_add_multi_user_admin(app):
     r = api_request(app, 'users', method='post',
         data=json.dumps({'usernames': names, 'admin': True}),
     )
-    assert r.status_code == 201
+    assert r.status_code == 202
     reply = r.json()
     r_names = [ user['name'] for user in reply ]
     assert names == r_names
@@ -615,7 +1183,8 @@ def test_groups_list(app):
     assert reply == [{
         'kind': 'group',
         'name': 'alphaflight',
-        'users': []
+        'users': [],
+        'user_count': 0,
     }]
 
 
@@ -635,7 +1204,8 @@ def test_group_get(app):
     assert reply == {
         'kind': 'group',
         'name': 'alphaflight',
-        'users': ['sasquatch']
+        'users': ['sasquatch'],
+        'user_count': 1,
     }
 
 
@@ -6,7 +6,7 @@ import re
 import sys
 from subprocess import check_output, Popen, PIPE
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import pytest
 
@@ -157,3 +157,66 @@ def test_load_groups(io_loop):
     gold = orm.Group.find(db, name='gold')
     assert gold is not None
     assert sorted([ u.name for u in gold.users ]) == sorted(to_load['gold'])
+
+
+def test_init_users_and_groups_again(io_loop):
+    with TemporaryDirectory() as td:
+        db_file = os.path.join(td, 'jupyterhub.sqlite')
+        kwargs = dict(db_url=db_file, load_groups={'blue': ['cyclops', 'rogue', 'rogue']})
+        hub = MockHub(**kwargs)
+        hub.init_db()
+        hub.authenticator.admin_users = {'xavier'}
+        hub.authenticator.whitelist = {'xavier', 'storm', 'cyclops', 'rogue'}
+        io_loop.run_sync(hub.init_users)
+        io_loop.run_sync(hub.init_groups)
+
+        # a second startup finds the same users and groups
+        hub = MockHub(**kwargs)
+        hub.init_db()
+        hub.authenticator.admin_users = {'xavier', 'storm'}
+        io_loop.run_sync(hub.init_users)
+        io_loop.run_sync(hub.init_groups)
+        db = hub.db
+        names = sorted(name for (name,) in db.query(orm.User.name))
+        assert names == ['cyclops', 'rogue', 'storm', 'xavier']
+        assert orm.User.find(db, 'storm').admin
+        blue = orm.Group.find(db, 'blue')
+        assert blue.member_names() == ['cyclops', 'rogue']
+
+
+def test_init_phases_timed(io_loop):
+    with TemporaryDirectory() as td:
+        db_file = os.path.join(td, 'jupyterhub.sqlite')
+        statsd = Mock()
+        app = MockHub(db_url=db_file, statsd=statsd)
+        io_loop.run_sync(lambda : app.initialize([]))
+    timed = [ call[0][0] for call in statsd.timing.call_args_list ]
+    assert 'init.init_db' in timed
+    assert 'init.init_users' in timed
+    assert 'init.init_spawners' in timed
+
+
+def test_init_spawners_loads_only_users_with_servers(io_loop):
+    with TemporaryDirectory() as td:
+        db_file = os.path.join(td, 'jupyterhub.sqlite')
+        hub = MockHub(db_url=db_file)
+        hub.init_db()
+        db = hub.db
+        db.add(orm.User(name='idle'))
+        serving = orm.User(name='serving')
+        serving.servers.append(orm.Server())
+        db.add(serving)
+        db.commit()
+
+        hub = MockHub(db_url=db_file)
+        io_loop.run_sync(lambda : hub.initialize([]))
+        db = hub.db
+        serving = orm.User.find(db, 'serving')
+        idle = orm.User.find(db, 'idle')
+        assert serving.id in hub.users
+        assert idle.id not in hub.users
+        # the server was not running, and is gone
+        assert serving.servers == []
+        # other users are loaded on first access
+        assert hub.users['idle'].orm_user is idle
+        assert idle.id in hub.users
@@ -2,6 +2,7 @@ from glob import glob
 import os
 import shutil
 
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.exc import OperationalError
 from pytest import raises
 
@@ -23,6 +24,9 @@ def test_upgrade(tmpdir):
     db_url = generate_old_db(str(tmpdir))
     print(db_url)
     upgrade(db_url)
+    engine = create_engine(db_url)
+    columns = [ c['name'] for c in inspect(engine).get_columns('api_tokens') ]
+    assert 'digest' in columns
 
 def test_upgrade_entrypoint(tmpdir, io_loop):
     generate_old_db(str(tmpdir))
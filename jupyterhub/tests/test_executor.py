@@ -0,0 +1,57 @@
+"""Tests for the shared blocking executor"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import threading
+
+import pytest
+from tornado import gen
+
+from ..executor import BlockingExecutor
+
+
+def test_run(io_loop):
+    executor = BlockingExecutor()
+    result = io_loop.run_sync(lambda: executor.run('test', lambda x, y=1: (x, y), 5, y=2))
+    assert result == (5, 2)
+    assert executor.stats['test'] == {
+        'queued': 0,
+        'running': 0,
+        'completed': 1,
+    }
+
+    def fail():
+        raise ValueError("oops")
+
+    with pytest.raises(ValueError):
+        io_loop.run_sync(lambda: executor.run('test', fail))
+    assert executor.stats['test']['completed'] == 2
+    assert executor.stats['test']['running'] == 0
+
+
+def test_concurrency_limit(io_loop):
+    executor = BlockingExecutor(
+        max_workers=4,
+        concurrency_limits={'slow': 1},
+    )
+    assert executor.limit('slow') == 1
+    assert executor.limit('other') == executor.default_concurrency_limit
+    release = threading.Event()
+
+    @gen.coroutine
+    def check():
+        slow = [ executor.run('slow', release.wait, 10) for i in range(3) ]
+        yield gen.sleep(0.1)
+        # only one slow call runs at a time, the rest are queued
+        assert executor.stats['slow']['running'] == 1
+        assert executor.stats['slow']['queued'] == 2
+        # other kinds are not blocked by slow calls
+        result = yield executor.run('fast', lambda: 'done')
+        assert result == 'done'
+        release.set()
+        yield slow
+        assert executor.stats['slow']['completed'] == 3
+
+    io_loop.run_sync(check)
+    executor.shutdown()
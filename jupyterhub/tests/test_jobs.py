@@ -0,0 +1,90 @@
+"""Tests for the background job queue"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import os
+from unittest import mock
+
+from tornado import gen
+
+from .. import orm
+from ..jobs import JobQueue
+
+
+def wait_for_jobs(io_loop, db, *jobs):
+    @gen.coroutine
+    def wait():
+        while True:
+            db.expire_all()
+            if all(job.state in {'done', 'failed'} for job in jobs):
+                return
+            yield gen.sleep(0.01)
+    io_loop.run_sync(wait, timeout=10)
+
+
+def test_run_jobs(db, io_loop, tmpdir):
+    queue = JobQueue(db_factory=lambda: db, concurrency=2)
+    user = orm.User(name='job-user')
+    db.add(user)
+    db.commit()
+    path = str(tmpdir.join('a', 'b'))
+    ok = queue.submit('create_dirs', [
+        ['mkdir', '-p', path],
+        ['touch', os.path.join(path, 'c')],
+    ], user=user, user_info={'data_dir': path})
+    fail = queue.submit('fail', [['true'], ['false'], ['true']])
+    assert ok.state == 'pending'
+    assert ok.total == 2
+    queue.start()
+    try:
+        wait_for_jobs(io_loop, db, ok, fail)
+    finally:
+        queue.stop()
+
+    assert ok.state == 'done'
+    assert ok.progress == 2
+    assert ok.started <= ok.finished
+    assert os.path.exists(os.path.join(path, 'c'))
+    info = db.query(orm.User_info).filter(orm.User_info.user_id == user.id).one()
+    assert info.data_dir == path
+
+    assert fail.state == 'failed'
+    assert fail.progress == 1
+    assert 'false exited with status 1' in fail.message
+
+
+def test_failed_job_keeps_session(db, io_loop):
+    queue = JobQueue(db_factory=lambda: db)
+    job = queue.submit('fail', [['false']])
+
+    @gen.coroutine
+    def run_command(cmd):
+        # a change made elsewhere in the Hub while the command runs
+        db.add(orm.User(name='job-bystander'))
+        raise RuntimeError("no room")
+
+    with mock.patch.object(queue, 'run_command', run_command):
+        io_loop.run_sync(lambda: queue.run_job(job.id))
+    assert job.state == 'failed'
+    assert job.message == "no room"
+    assert orm.User.find(db, 'job-bystander') is not None
+
+
+def test_resume_jobs(db, io_loop):
+    queue = JobQueue(db_factory=lambda: db)
+    pending = queue.submit('resume', [['true']])
+    interrupted = queue.submit('interrupted', [['true']])
+    interrupted.state = 'running'
+    db.commit()
+
+    # a new queue, as after a restart
+    queue = JobQueue(db_factory=lambda: db)
+    queue.start()
+    try:
+        wait_for_jobs(io_loop, db, pending, interrupted)
+    finally:
+        queue.stop()
+    assert pending.state == 'done'
+    assert interrupted.state == 'failed'
+    assert interrupted.message == "Interrupted by Hub shutdown"
@@ -0,0 +1,121 @@
+"""Tests for cached passwd and group lookups"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from collections import namedtuple
+from unittest import mock
+
+import pytest
+
+from ..nss import NSSCache
+
+pwent = namedtuple('pwent', ['pw_name', 'pw_uid', 'pw_dir'])
+grent = namedtuple('grent', ['gr_name', 'gr_gid', 'gr_mem'])
+
+passwd = {
+    'alice': pwent('alice', 1000, '/home/alice'),
+}
+groups = [
+    grent('staff', 50, ['alice', 'bob']),
+    grent('wheel', 10, ['alice']),
+    grent('guests', 70, []),
+]
+
+
+@pytest.fixture
+def lookups():
+    """Mock pwd and grp, counting calls"""
+    getpwnam = mock.Mock(side_effect=lambda name: passwd[name])
+    getgrnam = mock.Mock(side_effect=lambda name: { g.gr_name: g for g in groups }[name])
+    getgrall = mock.Mock(side_effect=lambda: list(groups))
+    with mock.patch('pwd.getpwnam', getpwnam), \
+            mock.patch('grp.getgrnam', getgrnam), \
+            mock.patch('grp.getgrall', getgrall):
+        yield getpwnam, getgrnam, getgrall
+
+
+def test_getpwnam(lookups):
+    getpwnam, _, _ = lookups
+    cache = NSSCache(ttl=60, negative_ttl=10)
+    with mock.patch('time.monotonic', lambda: 100):
+        assert cache.getpwnam('alice').pw_uid == 1000
+        assert cache.getpwnam('alice').pw_uid == 1000
+        with pytest.raises(KeyError):
+            cache.getpwnam('nobody')
+        with pytest.raises(KeyError):
+            cache.getpwnam('nobody')
+    assert getpwnam.call_count == 2
+    assert cache.hits['passwd'] == 2
+    assert cache.misses['passwd'] == 2
+
+    # missing users are remembered for less time
+    with mock.patch('time.monotonic', lambda: 120):
+        with pytest.raises(KeyError):
+            cache.getpwnam('nobody')
+        cache.getpwnam('alice')
+    assert getpwnam.call_count == 3
+    with mock.patch('time.monotonic', lambda: 200):
+        cache.getpwnam('alice')
+    assert getpwnam.call_count == 4
+
+    cache.forget_user('alice')
+    with mock.patch('time.monotonic', lambda: 200):
+        cache.getpwnam('alice')
+    assert getpwnam.call_count == 5
+    assert cache.stats()['entries'] == {'passwd': 2}
+
+
+def test_user_gids(lookups):
+    _, getgrnam, getgrall = lookups
+    cache = NSSCache(ttl=60)
+    with mock.patch('time.monotonic', lambda: 100):
+        assert sorted(cache.user_gids('alice')) == [10, 50]
+        assert cache.user_gids('bob') == [50]
+        assert cache.user_gids('carol') == []
+        # group lookups are answered from the snapshot
+        assert cache.getgrnam('staff').gr_gid == 50
+        with pytest.raises(KeyError):
+            cache.getgrnam('nosuchgroup')
+        assert len(cache.getgrall()) == 3
+    assert getgrall.call_count == 1
+    assert not getgrnam.called
+    assert cache.misses['getgrall'] == 1
+    assert cache.hits['getgrall'] == 3
+
+    with mock.patch('time.monotonic', lambda: 200):
+        cache.user_gids('alice')
+    assert getgrall.call_count == 2
+
+
+def test_getgrnam(lookups):
+    _, getgrnam, getgrall = lookups
+    cache = NSSCache(ttl=60)
+    with mock.patch('time.monotonic', lambda: 100):
+        assert cache.getgrnam('wheel').gr_mem == ['alice']
+        assert cache.getgrnam('wheel').gr_mem == ['alice']
+    assert getgrnam.call_count == 1
+    assert not getgrall.called
+
+
+def test_disabled(lookups):
+    getpwnam, _, getgrall = lookups
+    cache = NSSCache(ttl=0)
+    cache.getpwnam('alice')
+    cache.getpwnam('alice')
+    cache.user_gids('alice')
+    cache.user_gids('alice')
+    assert getpwnam.call_count == 2
+    assert getgrall.call_count == 2
+    assert cache.hits == {}
+
+
+def test_statsd(lookups):
+    statsd = mock.Mock()
+    cache = NSSCache(statsd=statsd)
+    cache.getpwnam('alice')
+    cache.getpwnam('alice')
+    statsd.incr.assert_has_calls([
+        mock.call('nss_cache.passwd.miss'),
+        mock.call('nss_cache.passwd.hit'),
+    ])
@@ -3,14 +3,18 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+from datetime import datetime
 import socket
+from unittest import mock
 
 import pytest
+from sqlalchemy import event
 from tornado import gen
 
 from .. import orm
 from .. import objects
-from ..user import User
+from ..user import User, UserDict
+from ..utils import ModelCache, TokenCache, hash_token, digest_token
 from .mocking import MockSpawner
 
 
@@ -50,12 +54,134 @@ def test_user(db):
     assert user.server.ip == ''
     assert user.state == {'pid': 4234}
 
+    # the Server wrapper is reused while it is the user's server
+    assert user.server is user.server
+    user.server.port = 1234
+    assert server.port == 1234
+    assert user.running
+    # attributes that are not the user's own are set on the orm.User
+    user.admin = True
+    assert user.orm_user.admin
+
     found = orm.User.find(db, 'kaylee')
     assert found.name == user.name
     found = orm.User.find(db, 'badger')
     assert found is None
 
 
+def test_user_dict_cookie_id(db):
+    users = UserDict(db_factory=lambda: db, settings={})
+    orm_user = orm.User(name='simon')
+    db.add(orm_user)
+    db.commit()
+    user = users[orm_user]
+    cookie_id = user.cookie_id
+    db.commit()
+
+    queries = []
+    def count(*args):
+        queries.append(args)
+    event.listen(db.bind, 'before_cursor_execute', count)
+    try:
+        # warm lookups don't touch the db
+        assert users.find_by_cookie_id(cookie_id) is user
+        assert queries == []
+
+        # changing cookie_id updates the index
+        user.cookie_id = 'new-cookie-for-simon'
+        db.commit()
+        queries[:] = []
+        assert users.find_by_cookie_id('new-cookie-for-simon') is user
+        assert queries == []
+        assert users.find_by_cookie_id(cookie_id) is None
+
+        # deleted users are removed from the index
+        del users[user.id]
+        assert users.find_by_cookie_id('new-cookie-for-simon') is None
+    finally:
+        event.remove(db.bind, 'before_cursor_execute', count)
+
+    # users not yet in the dict are found in the db, and indexed
+    orm_user = orm.User(name='river')
+    db.add(orm_user)
+    db.commit()
+    user = users.find_by_cookie_id(orm_user.cookie_id)
+    assert user.orm_user is orm_user
+    assert users.find_by_cookie_id(orm_user.cookie_id) is user
+
+
+def test_user_dict_names(db):
+    users = UserDict(db_factory=lambda: db, settings={})
+    orm_user = orm.User(name='jayne')
+    db.add(orm_user)
+    db.commit()
+    # not loaded yet, found in the db
+    user = users['jayne']
+    assert user.orm_user is orm_user
+    with pytest.raises(KeyError):
+        users['vera']
+    db.commit()
+
+    queries = []
+    def count(*args):
+        queries.append(args)
+    event.listen(db.bind, 'before_cursor_execute', count)
+    try:
+        assert users['jayne'] is user
+        assert users.find_by_name('jayne') is user
+        # the orm user is only re-fetched if the db session changes
+        assert users[orm_user] is user
+        assert users[user] is user
+        assert queries == []
+
+        user.name = 'cobb'
+        db.commit()
+        queries[:] = []
+        assert users['cobb'] is user
+        assert queries == []
+    finally:
+        event.remove(db.bind, 'before_cursor_execute', count)
+    assert users.find_by_name('jayne') is None
+    del users['cobb']
+    assert users.find_by_name('cobb') is None
+
+
+def test_user_dict_evict_idle(db):
+    users = UserDict(db_factory=lambda: db, settings={})
+    orm_user = orm.User(name='book')
+    db.add(orm_user)
+    running = orm.User(name='mr-universe')
+    server = orm.Server()
+    running.servers.append(server)
+    db.add(running)
+    db.commit()
+    user = users['book']
+    running_user = users['mr-universe']
+    # users are not created with a spawner
+    assert not user.spawner_loaded
+    assert user.spawner.user is user
+    assert user.spawner_loaded
+
+    # recently accessed users stay loaded
+    assert users.evict_idle(60) == 0
+    user.spawn_pending = True
+    assert users.evict_idle(0) == 0
+    assert orm_user.id in users
+    user.spawn_pending = False
+
+    # idle users without servers are unloaded, and reloaded on access
+    assert users.evict_idle(0) == 1
+    assert orm_user.id not in users
+    assert running.id in users
+    assert users.find_by_name('book') is not user
+    assert users.find_by_cookie_id(orm_user.cookie_id).orm_user is orm_user
+    assert users[running] is running_user
+
+    db.delete(running)
+    db.delete(server)
+    db.delete(orm_user)
+    db.commit()
+
 def test_tokens(db):
     user = orm.User(name='inara')
     db.add(user)
@@ -143,6 +269,81 @@ def test_token_find(db):
     assert found is None
 
 
+def test_token_digest(db):
+    user = orm.User(name='wash')
+    db.add(user)
+    db.commit()
+    token = user.new_api_token()
+    orm_token = orm.APIToken.find(db, token)
+    assert orm_token.digest == digest_token(token)
+    assert orm_token.hashed is None
+
+    # legacy salted hashes are upgraded on first match
+    def add_legacy(legacy):
+        orm_token = orm.APIToken(user_id=user.id, prefix=legacy[:4],
+            hashed=hash_token(legacy, rounds=orm.APIToken.rounds, algorithm='sha512'),
+        )
+        db.add(orm_token)
+        db.commit()
+        return orm_token
+
+    legacy = 'legacy-token-for-wash'
+    orm_token = add_legacy(legacy)
+    assert orm_token.digest is None
+    assert orm.APIToken.find(db, 'legacy-token-for-mal') is None
+    assert orm_token.digest is None
+    found = orm.APIToken.find(db, legacy)
+    assert found is orm_token
+    assert found.digest == digest_token(legacy)
+    assert found.hashed is None
+    # the upgrade is committed, so it survives a rollback
+    db.rollback()
+    assert orm_token.digest == digest_token(legacy)
+    with mock.patch.object(orm.APIToken, 'match') as match:
+        assert orm.APIToken.find(db, legacy) is orm_token
+        assert not match.called
+
+    # a lookup doesn't commit changes made by the caller
+    legacy = 'legacy-token-for-wash-2'
+    orm_token = add_legacy(legacy)
+    for flush in [False, True]:
+        with mock.patch.object(db, 'commit') as commit:
+            db.add(orm.User(name='wash-pending'))
+            if flush:
+                db.flush()
+            assert orm.APIToken.find(db, legacy) is orm_token
+        assert not commit.called
+        assert orm_token.digest == digest_token(legacy)
+        db.rollback()
+        assert orm.User.find(db, 'wash-pending') is None
+        assert orm_token.digest is None
+
+
+def test_token_find_cached(db):
+    user = orm.User(name='zoe')
+    db.add(user)
+    db.commit()
+    token = user.new_api_token()
+    cache = TokenCache()
+    found = orm.APIToken.find(db, token, cache=cache)
+    assert found.user is user
+    assert cache.misses == 1
+    with mock.patch.object(orm.APIToken, 'match') as match:
+        found = orm.APIToken.find(db, token, cache=cache)
+        assert not match.called
+    assert found.user is user
+    assert cache.hits == 1
+    # kind is still checked for cached tokens
+    assert orm.APIToken.find(db, token, kind='service', cache=cache) is None
+    assert orm.APIToken.find(db, token, kind='user', cache=cache) is found
+
+    # deleted tokens are not found, even if cached
+    db.delete(found)
+    db.commit()
+    assert orm.APIToken.find(db, token, cache=cache) is None
+    assert len(cache) == 0
+
+
 def test_spawn_fails(db, io_loop):
     orm_user = orm.User(name='aeofel')
     db.add(orm_user)
@@ -177,3 +378,62 @@ def test_groups(db):
     db.commit()
     assert group.users == [user]
     assert user.groups == [group]
+
+
+def test_group_bulk_membership(db):
+    group = orm.Group(name='bulk-members')
+    db.add(group)
+    users = [ orm.User(name='bulk-member-%i' % i) for i in range(5) ]
+    db.add_all(users)
+    db.commit()
+    ids = [ user.id for user in users ]
+    # load a membership collection, which must not go stale
+    assert users[0].groups == []
+
+    assert group.add_users(ids[:3]) == set(ids[:3])
+    assert group.add_users(ids[1:4]) == {ids[3]}
+    assert users[0].groups == [group]
+    db.commit()
+    assert group.member_count() == 4
+    assert group.member_ids() == set(ids[:4])
+    assert group.member_names(offset=1, limit=2) == ['bulk-member-1', 'bulk-member-2']
+
+    assert group.remove_users([ids[0], ids[4]]) == {ids[0]}
+    assert users[0].groups == []
+    db.commit()
+    assert sorted(u.name for u in group.users) == ['bulk-member-%i' % i for i in range(1, 4)]
+
+    # repr doesn't load members
+    db.expire(group)
+    group.name
+    assert repr(group) == '<Group bulk-members>'
+    assert 'users' not in group.__dict__
+
+
+def test_orm_changes_bump_models(db):
+    model_cache = ModelCache()
+    users = UserDict(db_factory=lambda: db, settings={'model_cache': model_cache})
+    orm_user = orm.User(name='hoban-washburne')
+    group = orm.Group(name='serenity-crew')
+    db.add_all([orm_user, group])
+    db.commit()
+    users[orm_user]
+
+    def bumped(kind, key, change):
+        version = model_cache.version(kind, key)
+        change()
+        db.commit()
+        return model_cache.version(kind, key) > version
+
+    assert bumped('user', orm_user.id, lambda: setattr(orm_user, 'admin', True))
+    assert not bumped('user', orm_user.id, lambda: setattr(orm_user, 'admin', True))
+    assert bumped('user', orm_user.id, lambda: setattr(orm_user, 'name', 'wash-hoban'))
+    assert bumped('user', orm_user.id, lambda: setattr(orm_user, 'last_activity', datetime.utcnow()))
+    # not part of the model
+    assert not bumped('user', orm_user.id, lambda: setattr(orm_user, 'state', {'pid': 1}))
+    assert bumped('group', 'serenity-crew', lambda: group.users.append(orm_user))
+    assert bumped('user', orm_user.id, lambda: orm_user.groups.remove(group))
+
+    del users[orm_user.id]
+    db.delete(group)
+    db.commit()
@@ -3,16 +3,21 @@
 from urllib.parse import urlencode, urlparse
 
 import requests
-from tornado import gen
+from tornado import gen, web
 
 from ..handlers import BaseHandler
+from ..handlers.pages import AdminHandler
+from ..log import log_request
 from ..utils import url_path_join as ujoin
 from .. import orm
 from ..auth import Authenticator
 
 import mock
-from .mocking import FormSpawner, public_url, public_host
-from .test_api import api_request
+from .mocking import (
+    FormSpawner, public_url, public_host,
+    mock_settings, mock_handler, mock_request, handler_output, add_running_users,
+)
+from .test_api import api_request, add_user
 
 def get_page(path, app, hub=True, **kw):
     if hub:
@@ -23,6 +28,47 @@ def get_page(path, app, hub=True, **kw):
     print(base_url)
     return requests.get(ujoin(base_url, path), **kw)
 
+def test_current_user_once_per_request(db):
+    settings = mock_settings(db)
+    users = settings['users']
+    orm_user = orm.User(name='book')
+    db.add(orm_user)
+    db.commit()
+    user = users[orm_user]
+    hub = settings['hub']
+    cookie = web.create_signed_value(settings['cookie_secret'], hub.cookie_name, user.cookie_id)
+    handler = mock_handler(BaseHandler, settings, uri='/hub/home', headers={
+        'Cookie': '%s=%s' % (hub.cookie_name, cookie.decode('ascii')),
+    })
+    assert handler.get_current_user() is user
+    assert handler.template_namespace['user'] is user
+    assert handler.current_user is user
+    log_request(handler)
+    assert handler.request_stats == {
+        'auth': 1,
+        'auth_queries': 0,
+    }
+
+
+def test_admin_page_queries(db, io_loop):
+    settings = mock_settings(db)
+    users = settings['users']
+    admin = users[add_user(db, name='admin-queries', admin=True)]
+    token = admin.new_api_token()
+
+    def count_queries():
+        handler = mock_request(AdminHandler, settings, '/hub/admin', token=token)
+        assert b'admin-queries' in handler_output(handler)
+        return handler.queries
+
+    add_running_users(settings, 'admin-queries', 2)
+    # the first request loads the requesting user
+    count_queries()
+    few = count_queries()
+    add_running_users(settings, 'admin-queries', 10)
+    assert count_queries() == few
+
+
 def test_root_no_auth(app, io_loop):
     print(app.hub.is_up())
     routes = io_loop.run_sync(app.proxy.get_all_routes)
@@ -0,0 +1,70 @@
+"""Tests for the central spawner poller"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from tornado import gen
+
+from .. import orm
+from ..poller import SpawnerPoller
+from ..spawner import Spawner
+from ..user import User
+
+
+class BatchSpawner(Spawner):
+    """A spawner whose servers are 'running' until told otherwise"""
+
+    batches = []
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.status = None
+
+    @gen.coroutine
+    def poll(self):
+        return self.status
+
+    @classmethod
+    @gen.coroutine
+    def poll_batch(cls, spawners):
+        cls.batches.append(len(spawners))
+        return (yield super().poll_batch(spawners))
+
+
+def test_sweep(db, io_loop):
+    poller = SpawnerPoller(batch_size=3, jitter=0.5)
+    user = User(db.query(orm.User).first(), {})
+    spawners = [ BatchSpawner(user=user, poller=poller, poll_interval=1) for i in range(7) ]
+    stopped = []
+    for i, spawner in enumerate(spawners):
+        spawner.add_poll_callback(stopped.append, i)
+        spawner.start_polling()
+        assert spawner in poller
+        # poll times are spread over [0.5, 1.5] * poll_interval
+        assert 0.5 <= poller._due[spawner] - io_loop.time() <= 1.5
+    assert spawners[0]._poll_callback is None
+
+    # nothing is due yet
+    io_loop.run_sync(poller.sweep)
+    assert BatchSpawner.batches == []
+
+    spawners[1].status = 0
+    spawners[2].stop_polling()
+    for spawner in spawners:
+        if spawner in poller:
+            poller._due[spawner] = 0
+    io_loop.run_sync(poller.sweep)
+    # six due spawners, in batches of three
+    assert BatchSpawner.batches == [3, 3]
+    assert stopped == [1]
+    assert spawners[1] not in poller
+    assert spawners[0] in poller
+    assert spawners[0]._last_running_poll
+
+    # a recent poll finding the server running is trusted
+    spawners[0].status = 0
+    status = io_loop.run_sync(lambda: spawners[0].poll_and_notify(cached=True))
+    assert status is None
+    status = io_loop.run_sync(spawners[0].poll_and_notify)
+    assert status == 0
+    assert stopped == [1, 0]
@@ -0,0 +1,98 @@
+"""Tests for the port allocator"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import socket
+
+import pytest
+from traitlets import TraitError
+
+from .. import orm
+from ..ports import PortAllocator
+from ..utils import random_port
+
+
+def free_range(size):
+    """Find a range of ports that are not in use"""
+    for i in range(100):
+        first = random_port()
+        if first + size > 65535:
+            continue
+        allocator = PortAllocator(port_range=(first, first + size - 1))
+        try:
+            for i in range(size):
+                allocator.allocate()
+        except RuntimeError:
+            continue
+        return (first, first + size - 1)
+    raise RuntimeError("No free range of %i ports" % size)
+
+
+def test_allocate():
+    first, last = free_range(10)
+    allocator = PortAllocator(port_range=(first, last))
+    assert allocator.enabled
+    ports = [ allocator.allocate() for i in range(10) ]
+    assert ports == list(range(first, last + 1))
+    assert len(allocator) == 10
+    with pytest.raises(RuntimeError):
+        allocator.allocate()
+
+    allocator.release(first + 3)
+    assert first + 3 not in allocator
+    assert allocator.allocate() == first + 3
+    # ports outside the range are ignored
+    allocator.release(first - 1)
+    allocator.reserve(last + 1)
+    assert len(allocator) == 10
+
+
+def test_allocate_next_fit():
+    first, last = free_range(20)
+    allocator = PortAllocator(port_range=(first, last))
+    assert allocator.allocate() == first
+    allocator.release(first)
+    # a just-released port is not reused right away
+    assert allocator.allocate() == first + 1
+
+
+def test_skip_ports_in_use():
+    first, last = free_range(3)
+    allocator = PortAllocator(port_range=(first, last))
+    sock = socket.socket()
+    sock.bind(('', first))
+    sock.listen(1)
+    try:
+        assert allocator.allocate() == first + 1
+    finally:
+        sock.close()
+    assert first not in allocator
+
+
+def test_disabled():
+    allocator = PortAllocator()
+    assert not allocator.enabled
+    allocator.reserve(8888)
+    assert len(allocator) == 0
+    with pytest.raises(TraitError):
+        PortAllocator(port_range=(10, 5))
+
+
+def test_load(db):
+    first, last = free_range(4)
+    allocator = PortAllocator(port_range=(first, last))
+    servers = [ orm.Server(port=first), orm.Server(port=first + 2), orm.Server(port=0) ]
+    db.add_all(servers)
+    db.commit()
+    try:
+        allocator.load(db)
+        assert len(allocator) == 2
+        assert first in allocator
+        assert first + 2 in allocator
+        assert allocator.allocate() == first + 1
+        assert allocator.allocate() == first + 3
+    finally:
+        for server in servers:
+            db.delete(server)
+        db.commit()
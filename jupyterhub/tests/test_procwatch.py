@@ -0,0 +1,93 @@
+"""Tests for watching process exits"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from datetime import timedelta
+import os
+import signal
+from subprocess import Popen
+import sys
+
+import pytest
+from tornado import gen
+
+from ..procwatch import ProcessWatcher
+
+_sleep = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+
+@pytest.fixture
+def watcher(request):
+    watcher = ProcessWatcher(use_pidfd=request.param)
+    request.addfinalizer(watcher.stop)
+    return watcher
+
+
+pidfd_params = [
+    False,
+    pytest.param(True, marks=pytest.mark.skipif(
+        not hasattr(os, 'pidfd_open'), reason="pidfds not available")),
+]
+
+
+@pytest.mark.parametrize('watcher', pidfd_params, indirect=True)
+@pytest.mark.gen_test
+def test_watch_child(watcher):
+    proc = Popen(_sleep)
+    exited = watcher.watch(proc.pid, proc)
+    assert watcher.watch(proc.pid, proc) is exited
+    yield gen.sleep(0.1)
+    assert not exited.done()
+    proc.send_signal(signal.SIGTERM)
+    status = yield gen.with_timeout(timedelta(seconds=5), exited)
+    assert status == -signal.SIGTERM
+    # reaped, not a zombie
+    with pytest.raises(ChildProcessError):
+        os.waitpid(proc.pid, os.WNOHANG)
+
+
+@pytest.mark.parametrize('watcher', pidfd_params, indirect=True)
+@pytest.mark.gen_test
+def test_watch_exited_child(watcher):
+    proc = Popen([sys.executable, '-c', 'import sys; sys.exit(3)'])
+    yield gen.sleep(0.5)
+    status = yield gen.with_timeout(timedelta(seconds=5), watcher.watch(proc.pid, proc))
+    assert status == 3
+
+
+@pytest.mark.parametrize('watcher', pidfd_params, indirect=True)
+@pytest.mark.gen_test
+def test_watch_pid(watcher):
+    # a process that is not a child of the Hub, as after a Hub restart,
+    # can only be watched with a pidfd
+    proc = Popen(_sleep)
+    exited = watcher.watch(proc.pid)
+    if not watcher.pidfd_available:
+        assert exited is None
+        proc.kill()
+        proc.wait()
+        return
+    proc.kill()
+    proc.wait()
+    status = yield gen.with_timeout(timedelta(seconds=5), exited)
+    assert status == 0
+
+
+@pytest.mark.gen_test
+def test_watch_child_behind_other_exit():
+    watcher = ProcessWatcher(use_pidfd=False)
+    try:
+        # an exited child that isn't watched, and isn't reaped yet
+        other = Popen(['true'])
+        yield gen.sleep(0.2)
+        proc = Popen(_sleep)
+        exited = watcher.watch(proc.pid, proc)
+        proc.send_signal(signal.SIGTERM)
+        status = yield gen.with_timeout(timedelta(seconds=5), exited)
+        assert status == -signal.SIGTERM
+        # the other child was left alone
+        assert other.returncode is None
+        assert other.wait() == 0
+    finally:
+        watcher.stop()
@@ -3,8 +3,11 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+from datetime import timedelta
+import json
 import logging
 import os
+import pwd
 import signal
 from subprocess import Popen
 import sys
@@ -15,11 +18,17 @@ from unittest import mock
 import pytest
 import requests
 from tornado import gen
+from tornado.process import Subprocess
 
+from ..jobs import JobQueue
 from ..user import User
 from ..objects import Hub
+from ..ports import PortAllocator
+from ..procwatch import ProcessWatcher
 from .. import spawner as spawnermod
 from ..spawner import LocalProcessSpawner
+from ..utils import random_port
+from ..zygote import ZygoteLauncher
 from .. import orm
 
 _echo_sleep = """
@@ -116,6 +125,88 @@ def test_single_user_spawner(db, request):
     assert status == 0
 
 
+@pytest.mark.gen_test(run_sync=False)
+def test_zygote_spawner(db, request):
+    spawner = new_spawner(db, cmd=['jupyterhub-singleuser'], use_zygote=True,
+        args=['--allow-root'] if os.getuid() == 0 else [],
+    )
+    spawner.api_token = 'secret'
+    spawner.oauth_client_id = 'user-zygote'
+    launcher = ZygoteLauncher.instance()
+    request.addfinalizer(ZygoteLauncher.clear_instance)
+    request.addfinalizer(launcher.stop)
+    ip, port = yield spawner.start()
+    assert spawner.proc is None
+    assert spawner.pid
+    spawner.user.server.ip = ip
+    spawner.user.server.port = port
+    db.commit()
+    yield wait_for_spawner(spawner)
+    # the server is not a child of the Hub
+    assert os.getppid() != spawner.pid
+    with pytest.raises(ChildProcessError):
+        os.waitpid(spawner.pid, os.WNOHANG)
+    # the zygote is reused for the next server
+    zygote = launcher.proc
+    yield spawner.stop()
+    status = yield spawner.poll()
+    assert status == 0
+    yield spawner.start()
+    assert launcher.proc is zygote
+    yield spawner.stop(now=True)
+
+
+_write_ids = """
+import json, os, sys, time
+with open(sys.argv[1], 'w') as f:
+    json.dump([os.getuid(), os.getgid(), os.getcwd()], f)
+time.sleep(30)
+"""
+
+
+def test_spawner_without_preexec_fn(db, io_loop, tmpdir):
+    out = str(tmpdir.join('ids.json'))
+    spawner = new_spawner(db, cmd=[sys.executable, '-c', _write_ids, out], use_preexec_fn=False)
+    with mock.patch.object(spawner, 'make_preexec_fn') as make_preexec_fn:
+        io_loop.run_sync(spawner.start)
+    assert not make_preexec_fn.called
+    deadline = time.monotonic() + 10
+    while not os.path.exists(out) and time.monotonic() < deadline:
+        io_loop.run_sync(lambda: gen.sleep(0.1))
+    with open(out) as f:
+        uid, gid, cwd = json.load(f)
+    user = pwd.getpwnam(spawner.user.name)
+    assert (uid, gid) == (user.pw_uid, user.pw_gid)
+    assert os.path.samefile(cwd, user.pw_dir)
+    io_loop.run_sync(lambda: spawner.stop(now=True))
+
+
+def test_poll_batch(db, io_loop):
+    spawners = [ new_spawner(db) for i in range(3) ]
+    for spawner in spawners:
+        io_loop.run_sync(spawner.start)
+        assert spawner.pid_start_time
+    procs = [ spawner.proc for spawner in spawners ]
+    # forget the Popen of two servers, as after a Hub restart
+    for spawner in spawners[1:]:
+        spawner.load_state(spawner.get_state())
+        spawner.proc = None
+    # the pid of the last server now belongs to a process started later
+    spawners[2].pid_start_time -= 1
+    with mock.patch.object(LocalProcessSpawner, '_signal') as send_signal:
+        statuses = io_loop.run_sync(lambda: LocalProcessSpawner.poll_batch(spawners))
+    assert not send_signal.called
+    assert [ statuses[spawner] for spawner in spawners ] == [None, None, 0]
+    assert spawners[2].pid == 0
+
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+    statuses = io_loop.run_sync(lambda: LocalProcessSpawner.poll_batch(spawners[:2]))
+    assert statuses[spawners[0]] == -signal.SIGKILL
+    assert statuses[spawners[1]] == 0
+
+
 def test_stop_spawner_sigint_fails(db, io_loop):
     spawner = new_spawner(db, cmd=[sys.executable, '-c', _uninterruptible])
     io_loop.run_sync(spawner.start)
@@ -243,3 +334,81 @@ def test_shell_cmd(db, tmpdir, request):
     r.raise_for_status()
     env = r.json()
     assert env['TESTVAR'] == 'foo'
+
+
+@pytest.mark.gen_test
+def test_stop_watches_exit(db, request):
+    # stop and poll callbacks don't wait for the next poll
+    spawner = new_spawner(db, death_interval=30, poll_interval=30)
+    ip, port = yield spawner.start()
+    pid = spawner.pid
+    spawner.start_polling()
+    stopped = gen.Future()
+    spawner.add_poll_callback(stopped.set_result, True)
+    os.kill(pid, signal.SIGTERM)
+    yield gen.with_timeout(timedelta(seconds=5), stopped)
+    assert spawner.pid == 0
+    # no zombie left behind
+    with pytest.raises(ChildProcessError):
+        os.waitpid(pid, os.WNOHANG)
+
+    ip, port = yield spawner.start()
+    pid = spawner.pid
+    tic = time.monotonic()
+    yield spawner.stop()
+    assert time.monotonic() - tic < 5
+    status = yield spawner.poll()
+    assert status == -signal.SIGINT
+    with pytest.raises(ChildProcessError):
+        os.waitpid(pid, os.WNOHANG)
+
+
+@pytest.mark.gen_test
+def test_spawner_port_allocator(db, request):
+    first = random_port()
+    allocator = PortAllocator(port_range=(first, first + 9))
+    spawner = new_spawner(db, port_allocator=allocator)
+    user = spawner.user
+    if user.server is None:
+        user.servers.append(orm.Server())
+        db.commit()
+    orm_server = user.server.orm_server
+    port_before = orm_server.port
+    ip, port = yield spawner.start()
+    assert first <= port <= first + 9
+    assert port in allocator
+    # the lease is recorded on the server, for User.stop to release
+    assert orm_server.port == port
+    yield spawner.stop()
+
+    # a failed start doesn't keep the port
+    spawner = new_spawner(db, user=user, port_allocator=allocator, cmd=['/no/such/cmd'])
+    with pytest.raises(FileNotFoundError):
+        yield spawner.start()
+    assert spawner.port not in allocator
+    assert len(allocator) == 1
+    assert orm_server.port == 0
+    user.server.port = port_before
+    db.commit()
+
+
+@pytest.mark.gen_test
+def test_stop_watches_exit_after_subprocess(db, request):
+    # tornado's Subprocess, used to run job commands,
+    # installs its own SIGCHLD handler the first time it is used
+    Subprocess.uninitialize()
+    ProcessWatcher.clear_instance()
+    watcher = ProcessWatcher.instance(use_pidfd=False)
+    def cleanup():
+        watcher.stop()
+        ProcessWatcher.clear_instance()
+    request.addfinalizer(cleanup)
+
+    spawner = new_spawner(db, death_interval=30, poll_interval=30, INTERRUPT_TIMEOUT=10)
+    ip, port = yield spawner.start()
+    spawner.start_polling()
+    yield JobQueue(db_factory=lambda: db).run_command(['true'])
+
+    tic = time.monotonic()
+    yield spawner.stop()
+    assert time.monotonic() - tic < 5
@@ -0,0 +1,86 @@
+"""Tests for utilities"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import time
+from unittest import mock
+
+import pytest
+from tornado import gen
+
+from ..utils import TokenCache, random_port, wait_for_http_server
+
+
+def test_token_cache():
+    cache = TokenCache(max_size=2, max_age=0)
+    assert cache.get('api_tokens', 'abcd') is None
+    assert cache.misses == 1
+    cache.set('api_tokens', 'abcd', 1, 'hashed-1')
+    assert cache.get('api_tokens', 'abcd') == (1, 'hashed-1')
+    assert cache.hits == 1
+    # kinds don't collide
+    assert cache.get('oauth_access_tokens', 'abcd') is None
+    # tokens are not stored in the clear
+    assert not any('abcd' in repr(key) for key in cache._entries)
+
+    cache.discard('api_tokens', 'abcd')
+    assert cache.get('api_tokens', 'abcd') is None
+    cache.set('api_tokens', 'abcd', 1, 'hashed-1')
+    cache.discard_id('api_tokens', 1)
+    assert cache.get('api_tokens', 'abcd') is None
+    assert len(cache) == 0
+
+
+def test_token_cache_lru():
+    cache = TokenCache(max_size=2, max_age=0)
+    cache.set('api_tokens', 'a', 1, 'h1')
+    cache.set('api_tokens', 'b', 2, 'h2')
+    # touch a, so b is least-recently used
+    assert cache.get('api_tokens', 'a')
+    cache.set('api_tokens', 'c', 3, 'h3')
+    assert len(cache) == 2
+    assert cache.get('api_tokens', 'b') is None
+    assert cache.get('api_tokens', 'a') == (1, 'h1')
+    assert cache.get('api_tokens', 'c') == (3, 'h3')
+
+
+def test_token_cache_max_age():
+    cache = TokenCache(max_age=10)
+    with mock.patch('time.monotonic', lambda: 100):
+        cache.set('api_tokens', 'a', 1, 'h1')
+    with mock.patch('time.monotonic', lambda: 105):
+        assert cache.get('api_tokens', 'a') == (1, 'h1')
+    with mock.patch('time.monotonic', lambda: 111):
+        assert cache.get('api_tokens', 'a') is None
+    assert len(cache) == 0
+
+
+def test_token_cache_statsd():
+    statsd = mock.Mock()
+    cache = TokenCache(statsd=statsd)
+    cache.get('api_tokens', 'a')
+    cache.set('api_tokens', 'a', 1, 'h1')
+    cache.get('api_tokens', 'a')
+    statsd.incr.assert_has_calls([
+        mock.call('token_cache.miss'),
+        mock.call('token_cache.hit'),
+    ])
+
+
+def test_wait_for_http_server_ready(io_loop):
+    url = 'http://127.0.0.1:%i/' % random_port()
+    ready = gen.Future()
+    io_loop.call_later(0.5, ready.set_result, None)
+    tic = time.monotonic()
+    io_loop.run_sync(lambda: wait_for_http_server(url, timeout=10, ready=ready))
+    # didn't wait for the next check
+    assert time.monotonic() - tic < 1
+
+    # checks back off exponentially
+    with mock.patch.object(gen, 'sleep', wraps=gen.sleep) as sleep:
+        with pytest.raises(TimeoutError):
+            io_loop.run_sync(lambda: wait_for_http_server(url, timeout=1, max_delay=0.2))
+    delays = [ call[0][0] for call in sleep.call_args_list ]
+    assert delays[:5] == [0.01, 0.02, 0.04, 0.08, 0.16]
+    assert max(delays) <= 0.2
@@ -2,107 +2,335 @@
 # Distributed under the terms of the Modified BSD License.
 
 from datetime import datetime, timedelta
+import time
 from urllib.parse import quote, urlparse
+import weakref
 
 from oauth2.error import ClientNotFoundError
-from sqlalchemy import inspect
+from sqlalchemy import event, inspect
 from tornado import gen
+from tornado.concurrent import Future
 from tornado.log import app_log
 
 from .utils import url_path_join, default_server_name
 
 from . import orm
 from .objects import Server
-from traitlets import HasTraits, Any, Dict, observe, default
 from .spawner import LocalProcessSpawner
 
 
+# live UserDicts, whose indexes are updated
+# when an indexed attribute is set on any orm.User
+_user_dicts = weakref.WeakValueDictionary()
+
+
+def _user_id(orm_user):
+    """Get the id of an orm.User
+
+    Uses the identity of persistent objects,
+    which is available without loading expired attributes from the db.
+    """
+    identity = inspect(orm_user).identity
+    if identity is None:
+        return orm_user.id
+    return identity[0]
+
+
+def _reindex_on_set(attr):
+    """Update UserDict indexes when attr is set on an orm.User"""
+    @event.listens_for(getattr(orm.User, attr), 'set')
+    def _reindex(orm_user, value, oldvalue, initiator):
+        identity = inspect(orm_user).identity
+        if identity is None:
+            # not in the db yet, will be indexed when it is added to a UserDict
+            return
+        for users in list(_user_dicts.values()):
+            users._reindex(attr, identity[0], value)
+
+for _attr in ('name', 'cookie_id'):
+    _reindex_on_set(_attr)
+
+
+def _model_caches():
+    """The model caches of live UserDicts"""
+    caches = []
+    for users in list(_user_dicts.values()):
+        cache = users.settings.get('model_cache')
+        if cache is not None and cache not in caches:
+            caches.append(cache)
+    return caches
+
+
+def _bump_user_on_set(attr):
+    """Record a change to a user's REST API model when attr is set on an orm.User
+
+    Changes made outside the ORM, or to in-memory state such as pending spawns,
+    must be recorded where they are made.
+    """
+    @event.listens_for(getattr(orm.User, attr), 'set')
+    def _bump(orm_user, value, oldvalue, initiator):
+        identity = inspect(orm_user).identity
+        if identity is None or value == oldvalue:
+            return
+        for cache in _model_caches():
+            cache.bump('user', identity[0])
+
+for _attr in ('name', 'admin', 'last_activity'):
+    _bump_user_on_set(_attr)
+
+
+def _bump_on_membership(collection, event_name):
+    """Record changes to user and group models when group membership changes in the ORM"""
+    @event.listens_for(collection, event_name)
+    def _bump(target, value, initiator):
+        if isinstance(target, orm.Group):
+            group, orm_user = target, value
+        else:
+            group, orm_user = value, target
+        identity = inspect(orm_user).identity
+        for cache in _model_caches():
+            cache.bump('group', group.name)
+            if identity is not None:
+                cache.bump('user', identity[0])
+
+for _collection in (orm.Group.users, orm.User.groups):
+    for _event_name in ('append', 'remove'):
+        _bump_on_membership(_collection, _event_name)
+
+
 class UserDict(dict):
     """Like defaultdict, but for users
 
-    Getting by a user id OR an orm.User instance returns a User wrapper around the orm user.
+    Getting by a user id, name, OR an orm.User instance returns a User wrapper around the orm user.
+
+    Users are indexed in memory by id, name, and cookie_id,
+    so that users that have been loaded once are found without a database query.
+
+    Users are only loaded when they are first accessed,
+    and users without servers that have not been accessed for a while
+    can be unloaded with `evict_idle`.
     """
+    _indexed = ('name', 'cookie_id')
+
     def __init__(self, db_factory, settings):
         self.db_factory = db_factory
         self.settings = settings
+        # attr: {value: user id}
+        self._indexes = { attr: {} for attr in self._indexed }
+        # attr: {user id: value}
+        self._indexed_values = { attr: {} for attr in self._indexed }
+        # user id: time.monotonic() of the last access
+        self._accessed = {}
         super().__init__()
+        _user_dicts[id(self)] = self
 
     @property
     def db(self):
         return self.db_factory()
 
+    def _reindex(self, attr, user_id, value):
+        """Record the value of an indexed attribute of a user, replacing any previous one"""
+        index = self._indexes[attr]
+        old = self._indexed_values[attr].pop(user_id, None)
+        if old is not None and index.get(old) == user_id:
+            index.pop(old)
+        if value is not None:
+            index[value] = user_id
+            self._indexed_values[attr][user_id] = value
+
+    def _find_indexed(self, attr, value):
+        """Find a User by an indexed attribute
+
+        Only the database is queried for users not already in the index.
+
+        Returns None if there is no such user.
+        """
+        user_id = self._indexes[attr].get(value)
+        if user_id is not None and dict.__contains__(self, user_id):
+            self._accessed[user_id] = time.monotonic()
+            return dict.__getitem__(self, user_id)
+        orm_user = self.db.query(orm.User).filter(getattr(orm.User, attr) == value).first()
+        if orm_user is None:
+            return None
+        user = self[orm_user]
+        self._reindex(attr, _user_id(orm_user), value)
+        return user
+
+    def find_by_cookie_id(self, cookie_id):
+        """Get a User by cookie_id
+
+        Returns None if there is no such user.
+        """
+        return self._find_indexed('cookie_id', cookie_id)
+
+    def find_by_name(self, name):
+        """Get a User by name
+
+        Returns None if there is no such user.
+        """
+        return self._find_indexed('name', name)
+
     def __contains__(self, key):
-        if isinstance(key, (User, orm.User)):
-            key = key.id
+        if isinstance(key, User):
+            key = key.orm_user
+        if isinstance(key, orm.User):
+            key = _user_id(key)
         return dict.__contains__(self, key)
 
+    def __setitem__(self, key, user):
+        dict.__setitem__(self, key, user)
+        self._accessed[key] = time.monotonic()
+        for attr in self._indexed:
+            self._reindex(attr, key, getattr(user.orm_user, attr))
+
     def __getitem__(self, key):
         if isinstance(key, User):
-            key = key.id
+            key = _user_id(key.orm_user)
         elif isinstance(key, str):
-            orm_user = self.db.query(orm.User).filter(orm.User.name == key).first()
-            if orm_user is None:
+            user = self.find_by_name(key)
+            if user is None:
                 raise KeyError("No such user: %s" % key)
-            else:
-                key = orm_user
+            return user
         if isinstance(key, orm.User):
             # users[orm_user] returns User(orm_user)
             orm_user = key
-            if orm_user.id not in self:
-                user = self[orm_user.id] = User(orm_user, self.settings)
+            id = _user_id(orm_user)
+            if not dict.__contains__(self, id):
+                user = self[id] = User(orm_user, self.settings)
                 return user
-            user = dict.__getitem__(self, orm_user.id)
-            user.db = self.db
+            user = dict.__getitem__(self, id)
+            self._accessed[id] = time.monotonic()
+            db = self.db
+            if user.db is not db:
+                # rebinding re-fetches the orm user, only do it if the session has changed
+                user.db = db
             return user
         elif isinstance(key, int):
             id = key
-            if id not in self:
+            if not dict.__contains__(self, id):
                 orm_user = self.db.query(orm.User).filter(orm.User.id == id).first()
                 if orm_user is None:
                     raise KeyError("No such user: %s" % id)
                 user = self[id] = User(orm_user, self.settings)
+            self._accessed[id] = time.monotonic()
             return dict.__getitem__(self, id)
         else:
             raise KeyError(repr(key))
 
+    def _forget(self, user_id):
+        """Remove a user from the registry and the indexes, but not from the database"""
+        dict.__delitem__(self, user_id)
+        self._accessed.pop(user_id, None)
+        for attr in self._indexed:
+            self._reindex(attr, user_id, None)
+
+    def _is_idle(self, user):
+        """Can a User be unloaded? (no servers, and nothing pending)"""
+        if user.spawn_pending or user.stop_pending or user._server_ready is not None:
+            return False
+        admission = self.settings.get('spawn_admission')
+        if admission is not None and admission.position(user) is not None:
+            return False
+        return not user.orm_user.servers
+
+    def evict_idle(self, max_idle):
+        """Unload Users without servers that have not been accessed for max_idle seconds
+
+        They are loaded again from the database on their next access.
+
+        Returns the number of users unloaded.
+        """
+        cutoff = time.monotonic() - max_idle
+        evicted = 0
+        for user_id, accessed in list(self._accessed.items()):
+            if accessed > cutoff or not dict.__contains__(self, user_id):
+                continue
+            user = dict.__getitem__(self, user_id)
+            if not self._is_idle(user):
+                continue
+            self._forget(user_id)
+            evicted += 1
+        return evicted
+
     def __delitem__(self, key):
-        user = self[key]
-        user_id = user.id
+        self.delete_users([self[key]])
+
+    def delete_users(self, users):
+        """Delete Users from the database and the registry, in one transaction
+
+        Their user_info is deleted with them.
+        """
         db = self.db
-        db.delete(user.orm_user)
+        token_cache = self.settings.get('token_cache')
+        model_cache = self.settings.get('model_cache')
+        user_ids = []
+        group_names = set()
+        for user in users:
+            user_id = user.id
+            user_ids.append(user_id)
+            if token_cache is not None:
+                for orm_token in user.api_tokens:
+                    token_cache.discard_id(orm.APIToken.__tablename__, orm_token.id)
+                for orm_token in db.query(orm.OAuthAccessToken).filter(
+                        orm.OAuthAccessToken.user_id == user_id):
+                    token_cache.discard_id(orm.OAuthAccessToken.__tablename__, orm_token.id)
+            group_names.update(group.name for group in user.groups)
+            db.delete(user.orm_user)
         db.commit()
-        dict.__delitem__(self, user_id)
+        for user_id in user_ids:
+            self._forget(user_id)
+            if model_cache is not None:
+                model_cache.bump('user', user_id)
+        if model_cache is not None:
+            for name in group_names:
+                model_cache.bump('group', name)
 
 
-class User(HasTraits):
+class User(object):
+    """A user of the Hub, wrapping its orm.User
 
-    @default('log')
-    def _log_default(self):
-        return app_log
+    Attributes not found on the User are looked up on the orm.User.
 
-    settings = Dict()
+    There can be a User in memory for every user in the database,
+    so its state is kept in slots rather than an instance dict.
+    """
 
-    db = Any(allow_none=True)
+    __slots__ = (
+        'orm_user',
+        'settings',
+        '_db',
+        '_spawner',
+        # the Server wrapper of orm_user.servers[0]
+        '_server',
+        'spawn_pending',
+        'stop_pending',
+        'waiting_for_response',
+        # resolved when the server being spawned says it is up
+        '_server_ready',
+        'allow_named_servers',
+        'base_url',
+    )
+
+    log = app_log
 
-    @default('db')
-    def _db_default(self):
-        if self.orm_user:
-            return inspect(self.orm_user).session
+    @property
+    def db(self):
+        if self._db is None and self.orm_user:
+            self._db = inspect(self.orm_user).session
+        return self._db
 
-    @observe('db')
-    def _db_changed(self, change):
+    @db.setter
+    def db(self, db):
         """Changing db session reacquires ORM User object"""
+        if db is self._db:
+            return
+        self._db = db
         # db session changed, re-get orm User
         if self.orm_user:
             id = self.orm_user.id
-            self.orm_user = change['new'].query(orm.User).filter(orm.User.id == id).first()
-        self.spawner.db = self.db
-
-    orm_user = None
-    spawner = None
-    spawn_pending = False
-    stop_pending = False
-    waiting_for_response = False
+            self.orm_user = db.query(orm.User).filter(orm.User.id == id).first()
+        if self._spawner is not None:
+            self._spawner.db = db
 
     @property
     def authenticator(self):
@@ -112,27 +340,73 @@ class User(HasTraits):
     def spawner_class(self):
         return self.settings.get('spawner_class', LocalProcessSpawner)
 
-    def __init__(self, orm_user, settings=None, **kwargs):
-        self.orm_user = orm_user
-        self.settings = settings or {}
-        super().__init__(**kwargs)
+    @property
+    def token_cache(self):
+        return self.settings.get('token_cache')
 
-        self.allow_named_servers = self.settings.get('allow_named_servers', False)
+    @property
+    def model_cache(self):
+        return self.settings.get('model_cache')
 
-        self.base_url = url_path_join(
-            self.settings.get('base_url', '/'), 'user', self.escaped_name)
+    def _bump_model(self):
+        """Record a change to my REST API model"""
+        if self.model_cache is not None:
+            self.model_cache.bump('user', _user_id(self.orm_user))
 
-        self.spawner = self.spawner_class(
-            user=self,
-            db=self.db,
-            hub=self.settings.get('hub'),
-            authenticator=self.authenticator,
-            config=self.settings.get('config'),
-        )
+    def _delete_api_token(self, token):
+        """Delete an API token from the db, and forget it if it was cached
+
+        Does not commit.
+        """
+        orm_token = orm.APIToken.find(self.db, token, cache=self.token_cache)
+        if orm_token is None:
+            return
+        self.db.delete(orm_token)
+        if self.token_cache is not None:
+            self.token_cache.discard(orm.APIToken.__tablename__, token)
+
+    def __init__(self, orm_user, settings=None):
+        # set slots directly, attributes of the orm.User are set on it
+        init = super().__setattr__
+        init('orm_user', orm_user)
+        init('settings', settings or {})
+        init('_db', None)
+        init('_spawner', None)
+        init('_server', None)
+        init('spawn_pending', False)
+        init('stop_pending', False)
+        init('waiting_for_response', False)
+        init('_server_ready', None)
+        init('allow_named_servers', self.settings.get('allow_named_servers', False))
+        init('base_url', url_path_join(
+            self.settings.get('base_url', '/'), 'user', self.escaped_name))
+
+    @property
+    def spawner(self):
+        """The user's Spawner, created on first use"""
+        if self._spawner is None:
+            self._spawner = self.spawner_class(
+                user=self,
+                db=self.db,
+                hub=self.settings.get('hub'),
+                authenticator=self.authenticator,
+                config=self.settings.get('config'),
+                poller=self.settings.get('spawner_poller'),
+                port_allocator=self.settings.get('port_allocator'),
+            )
+        return self._spawner
+
+    @property
+    def spawner_loaded(self):
+        """Whether the Spawner has been created"""
+        return self._spawner is not None
 
     # pass get/setattr to ORM user
 
     def __getattr__(self, attr):
+        if attr in User.__slots__:
+            # not set yet
+            raise AttributeError(attr)
         if hasattr(self.orm_user, attr):
             return getattr(self.orm_user, attr)
         else:
@@ -152,16 +426,28 @@ class User(HasTraits):
         """property for whether a user has a running server"""
         if self.spawn_pending or self.stop_pending:
             return False  # server is not running if spawn or stop is still pending
-        if self.server is None:
+        if not self.servers:
             return False
         return True
     
     @property
     def server(self):
-        if len(self.servers) == 0:
+        servers = self.servers
+        if len(servers) == 0:
+            self._server = None
             return None
         else:
-            return Server(orm_server=self.servers[0])
+            return self._wrap_server(servers[0])
+
+    def _wrap_server(self, orm_server):
+        """Get the Server wrapper for one of my orm.Servers
+
+        The wrapper is kept for as long as orm_server is my server,
+        instead of creating a new one on every access.
+        """
+        if self._server is None or self._server.orm_server is not orm_server:
+            self._server = Server(orm_server=orm_server)
+        return self._server
 
     @property
     def escaped_name(self):
@@ -237,7 +523,7 @@ class User(HasTraits):
         api_token = self.new_api_token()
         db.commit()
 
-        server = Server(orm_server=orm_server)
+        server = self._wrap_server(orm_server)
 
         spawner = self.spawner
         # Passing server_name to the spawner
@@ -268,12 +554,16 @@ class User(HasTraits):
                                         )
         db.commit()
 
+        # the server may say it is up as soon as it has started
+        self._server_ready = Future()
+
         # trigger pre-spawn hook on authenticator
         authenticator = self.authenticator
         if (authenticator):
             yield gen.maybe_future(authenticator.pre_spawn_start(self, spawner))
 
         self.spawn_pending = True
+        self._bump_model()
         # wait for spawner.start to return
         try:
             f = spawner.start()
@@ -289,10 +579,8 @@ class User(HasTraits):
                 self.log.warning("DEPRECATION: Spawner.start should return (ip, port) in JupyterHub >= 0.7")
             if spawner.api_token != api_token:
                 # Spawner re-used an API token, discard the unused api_token
-                orm_token = orm.APIToken.find(self.db, api_token)
-                if orm_token is not None:
-                    self.db.delete(orm_token)
-                    self.db.commit()
+                self._delete_api_token(api_token)
+                self.db.commit()
         except Exception as e:
             if isinstance(e, gen.TimeoutError):
                 self.log.warning("{user}'s server failed to start in {s} seconds, giving up".format(
@@ -320,7 +608,8 @@ class User(HasTraits):
         db.commit()
         self.waiting_for_response = True
         try:
-            yield server.wait_up(http=True, timeout=spawner.http_timeout)
+            yield server.wait_up(http=True, timeout=spawner.http_timeout,
+                ready=self._server_ready)
         except Exception as e:
             if isinstance(e, TimeoutError):
                 self.log.warning(
@@ -348,8 +637,21 @@ class User(HasTraits):
         finally:
             self.waiting_for_response = False
             self.spawn_pending = False
+            self._server_ready = None
+            self._bump_model()
         return self
 
+    def server_ready(self):
+        """Called when the server being spawned says that it is up
+
+        so that the spawn finishes without waiting for the next check.
+        Returns whether a spawn was waiting for it.
+        """
+        if self._server_ready is None or self._server_ready.done():
+            return False
+        self._server_ready.set_result(None)
+        return True
+
     @gen.coroutine
     def stop(self):
         """Stop the user's spawner
@@ -357,9 +659,11 @@ class User(HasTraits):
         and cleanup after it.
         """
         self.spawn_pending = False
+        self._server_ready = None
         spawner = self.spawner
         self.spawner.stop_polling()
         self.stop_pending = True
+        self._bump_model()
         try:
             api_token = self.spawner.api_token
             status = yield spawner.poll()
@@ -369,18 +673,20 @@ class User(HasTraits):
             self.state = spawner.get_state()
             self.last_activity = datetime.utcnow()
             # Cleanup defunct servers: delete entry and API token for each server
+            port_allocator = self.settings.get('port_allocator')
             for server in self.servers:
+                if port_allocator is not None:
+                    port_allocator.release(server.port)
                 # remove server entry from db
                 self.db.delete(server)
             if not spawner.will_resume:
                 # find and remove the API token if the spawner isn't
                 # going to re-use it next time
-                orm_token = orm.APIToken.find(self.db, api_token)
-                if orm_token:
-                    self.db.delete(orm_token)
+                self._delete_api_token(api_token)
             self.db.commit()
         finally:
             self.stop_pending = False
+            self._bump_model()
             # trigger post-spawner hook on authenticator
             auth = spawner.authenticator
             if auth:
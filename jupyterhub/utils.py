@@ -4,12 +4,15 @@
 # Distributed under the terms of the Modified BSD License.
 
 from binascii import b2a_hex
+from collections import OrderedDict
 import errno
 import hashlib
+import hmac
 from hmac import compare_digest
 import os
 import socket
 from threading import Thread
+import time
 import uuid
 import warnings
 
@@ -67,15 +70,23 @@ def wait_for_server(ip, port, timeout=10):
 
 
 @gen.coroutine
-def wait_for_http_server(url, timeout=10):
+def wait_for_http_server(url, timeout=10, ready=None, min_delay=0.01, max_delay=1):
     """Wait for an HTTP Server to respond at url.
 
     Any non-5XX response code will do, even 404.
+
+    Checks are spaced by exponential backoff, from min_delay to max_delay seconds.
+    If ready is given, it is a Future resolving when the server has said that it is up,
+    which ends the wait without checking again.
     """
     loop = ioloop.IOLoop.current()
     tic = loop.time()
     client = AsyncHTTPClient()
+    delay = min_delay
     while loop.time() - tic < timeout:
+        if ready is not None and ready.done():
+            app_log.debug("Server at %s is ready", url)
+            return
         try:
             r = yield client.fetch(url, follow_redirects=False)
         except HTTPError as e:
@@ -86,16 +97,24 @@ def wait_for_http_server(url, timeout=10):
                     # but 502 or other proxy error is conceivable
                     app_log.warning(
                         "Server at %s responded with error: %s", url, e.code)
-                yield gen.sleep(0.1)
             else:
                 app_log.debug("Server at %s responded with %s", url, e.code)
                 return
         except (OSError, socket.error) as e:
             if e.errno not in {errno.ECONNABORTED, errno.ECONNREFUSED, errno.ECONNRESET}:
                 app_log.warning("Failed to connect to %s (%s)", url, e)
-            yield gen.sleep(0.1)
         else:
             return
+        delay = min(delay, timeout - (loop.time() - tic))
+        if ready is None:
+            yield gen.sleep(delay)
+        else:
+            # wake up early if the server says it is ready
+            try:
+                yield gen.with_timeout(loop.time() + delay, ready)
+            except gen.TimeoutError:
+                pass
+        delay = min(2 * delay, max_delay)
 
     raise TimeoutError(
         "Server at {url} didn't respond in {timeout} seconds".format(**locals())
@@ -197,6 +216,173 @@ def compare_token(compare, token):
     return False
 
 
+def digest_token(token):
+    """Return the hex sha256 digest of a token.
+
+    Unlike `hash_token`, this is deterministic, so tokens can be looked up
+    by an indexed equality match on the digest.
+    Tokens generated by `new_token` are random 128-bit values,
+    so they need neither salt nor key stretching.
+    """
+    return hashlib.sha256(token.encode('utf8', 'replace')).hexdigest()
+
+
+class TokenCache(object):
+    """Bounded LRU cache of verified tokens
+
+    Maps a keyed digest of a presented token to the id and stored hash
+    of the database row it was verified against,
+    so that repeated requests with the same token can skip hashing.
+    The digest key is random per process, and raw tokens are never stored.
+
+    Entries expire after `max_age` seconds (0 means never),
+    and the least-recently-used entry is dropped when there are more than `max_size`.
+
+    Callers must still load the row by id and check that its hash is unchanged,
+    so tokens deleted by any path are never honored from the cache.
+    """
+
+    def __init__(self, max_size=10000, max_age=300, statsd=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.statsd = statsd
+        self.hits = 0
+        self.misses = 0
+        self._key = os.urandom(32)
+        # digest: (kind, id, hashed, timestamp)
+        self._entries = OrderedDict()
+        # (kind, id): digest, for invalidating by row
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _digest(self, kind, token):
+        msg = '{}:{}'.format(kind, token).encode('utf8', 'replace')
+        return hmac.new(self._key, msg, hashlib.sha256).digest()
+
+    def _pop(self, digest):
+        kind, id, hashed, timestamp = self._entries.pop(digest)
+        self._rows.pop((kind, id), None)
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.statsd is not None:
+            self.statsd.incr('token_cache.hit' if hit else 'token_cache.miss')
+
+    def get(self, kind, token):
+        """Get the cached (id, hashed) for a token of a given kind (table name)
+
+        Returns None if the token is not cached.
+        """
+        digest = self._digest(kind, token)
+        entry = self._entries.get(digest)
+        if entry is not None and self.max_age > 0 and entry[3] + self.max_age < time.monotonic():
+            self._pop(digest)
+            entry = None
+        if entry is None:
+            self._count(False)
+            return None
+        self._entries.move_to_end(digest)
+        self._count(True)
+        return entry[1], entry[2]
+
+    def set(self, kind, token, id, hashed):
+        """Record that `token` was verified against row `id` with hash `hashed`"""
+        digest = self._digest(kind, token)
+        if digest in self._entries:
+            self._pop(digest)
+        stale = self._rows.get((kind, id))
+        if stale is not None:
+            self._pop(stale)
+        self._entries[digest] = (kind, id, hashed, time.monotonic())
+        self._rows[(kind, id)] = digest
+        while len(self._entries) > self.max_size:
+            self._pop(next(iter(self._entries)))
+
+    def discard(self, kind, token):
+        """Forget a token, if it is cached"""
+        digest = self._digest(kind, token)
+        if digest in self._entries:
+            self._pop(digest)
+
+    def discard_id(self, kind, id):
+        """Forget the token cached for a given row, if any"""
+        digest = self._rows.get((kind, id))
+        if digest is not None:
+            self._pop(digest)
+
+    def clear(self):
+        """Forget all tokens"""
+        self._entries.clear()
+        self._rows.clear()
+
+
+class ModelCache(object):
+    """Versioned cache of serialized REST API models
+
+    Each user or group has a version, taken from a single counter
+    that increases every time anything is bumped,
+    so the counter is also the version of whole collections.
+
+    Code that changes what a model contains must call `bump`,
+    which forgets the cached model.
+    Changes to users and group membership made through the ORM
+    are bumped by ORM events (see jupyterhub.user).
+
+    Versions are only unique within a process,
+    so ETags also include a random per-process epoch.
+    """
+
+    def __init__(self):
+        self.epoch = b2a_hex(os.urandom(4)).decode('ascii')
+        self.counter = 0
+        # (kind, key): version. (kind, None) is the version of the collection
+        self._versions = {}
+        # (kind, key): (version, serialized model)
+        self._models = {}
+
+    def bump(self, kind, key):
+        """Record a change to the model `kind` (e.g. 'user'), identified by `key`
+
+        Deleting a model is a change, too:
+        its version is kept, so that a new model with the same key
+        never has the same ETag as the deleted one.
+        """
+        self.counter += 1
+        self._versions[(kind, key)] = self.counter
+        self._versions[(kind, None)] = self.counter
+        self._models.pop((kind, key), None)
+
+    def version(self, kind, key=None):
+        """Get the version of a model, or the collection of all models of a kind if key is None"""
+        return self._versions.get((kind, key), 0)
+
+    def etag(self, kind, key=None):
+        """Get the ETag for the current version of a model or collection"""
+        return '"%s-%i"' % (self.epoch, self.version(kind, key))
+
+    def get(self, kind, key):
+        """Get a serialized model, if cached for the current version
+
+        Returns None otherwise.
+        """
+        entry = self._models.get((kind, key))
+        if entry is not None and entry[0] == self.version(kind, key):
+            return entry[1]
+
+    def set(self, kind, key, serialized):
+        """Store a serialized model for the current version"""
+        self._models[(kind, key)] = (self.version(kind, key), serialized)
+
+    def clear(self):
+        """Forget all models"""
+        self._models.clear()
+
+
 def url_path_join(*pieces):
     """Join components of url into a relative url.
 
@@ -0,0 +1,248 @@
+"""A preloaded launcher ("zygote") for single-user servers
+
+Most of the time it takes to start jupyterhub-singleuser is spent importing
+notebook, tornado, jinja2 and traitlets, before the server can even start.
+
+The zygote is a process that imports jupyterhub.singleuser once,
+then forks a child for each server to start.
+Each child drops privileges to its user, as `set_user_setuid` does,
+sets the environment, and runs the single-user server
+with modules that are already imported.
+
+The Hub talks to the zygote over a UNIX socket only it can access,
+sending one JSON request per server::
+
+    {"argv": [...], "env": {...}, "uid": 1000, "gid": 1000, "gids": [...], "home": "/home/user"}
+
+and receiving `{"pid": 1234}` or `{"error": "..."}`.
+
+The zygote exits when the Hub does (when its stdin is closed).
+Servers it started keep running, and are found again by pid, as after a Hub restart.
+
+Run the zygote with::
+
+    python -m jupyterhub.zygote /path/to/socket
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+from subprocess import Popen, PIPE
+import sys
+from tempfile import mkdtemp
+import time
+import traceback
+
+from tornado import gen
+from tornado.iostream import IOStream, StreamClosedError
+
+from traitlets.config import SingletonConfigurable
+from traitlets import Integer
+
+
+def _run_child(request):
+    """Run a single-user server in a forked child of the zygote
+
+    Never returns.
+    """
+    status = 1
+    try:
+        # don't forward signals, as Popen(start_new_session=True)
+        os.setsid()
+        # children of the server are not reaped automatically
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+
+        os.setgid(request['gid'])
+        try:
+            os.setgroups(request['gids'])
+        except Exception as e:
+            print('Failed to set groups %s' % e, file=sys.stderr)
+        os.setuid(request['uid'])
+        from .setuid import _try_setcwd
+        _try_setcwd(request['home'])
+
+        os.environ.clear()
+        os.environ.update(request['env'])
+        argv = request['argv']
+        sys.argv = list(argv)
+        from .singleuser import main
+        main(argv[1:])
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def _handle(conn, listener):
+    """Handle one request to start a server"""
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            # connection checks send nothing
+            return
+        data += chunk
+    try:
+        request = json.loads(data.decode('utf8'))
+        pid = os.fork()
+    except Exception as e:
+        reply = {'error': str(e)}
+    else:
+        if pid == 0:
+            conn.close()
+            listener.close()
+            _run_child(request)
+        reply = {'pid': pid}
+    conn.sendall(json.dumps(reply).encode('utf8') + b'\n')
+
+
+def serve(socket_path):
+    """Preload the single-user server, and start servers when asked to"""
+    # the point of the zygote: import everything once
+    from . import singleuser, spawner  # noqa
+
+    # servers are reaped automatically, the Hub only checks their pids
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    listener.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    listener.listen(128)
+    stdin = sys.stdin.fileno()
+    while True:
+        readable, _, _ = select.select([listener, stdin], [], [])
+        if stdin in readable and not os.read(stdin, 1024):
+            break
+        if listener in readable:
+            conn, _ = listener.accept()
+            try:
+                _handle(conn, listener)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                conn.close()
+    listener.close()
+    os.remove(socket_path)
+
+
+class ZygoteLauncher(SingletonConfigurable):
+    """Start single-user servers from a preloaded zygote process
+
+    Use the shared instance::
+
+        pid = yield ZygoteLauncher.instance().launch(argv, env, uid, gid, gids, home)
+
+    The zygote is started the first time a server is launched,
+    and again if it has died.
+    """
+
+    start_timeout = Integer(30,
+        help="""
+        Seconds to wait for the zygote to import the single-user server and start listening.
+        """
+    ).tag(config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.proc = None
+        self._dir = None
+        self._starting = None
+
+    @property
+    def socket_path(self):
+        return os.path.join(self._dir, 'zygote.sock')
+
+    @gen.coroutine
+    def _connect(self):
+        stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        yield stream.connect(self.socket_path)
+        return stream
+
+    @gen.coroutine
+    def _start(self):
+        if self._dir is None:
+            # only the Hub's user can access the socket
+            self._dir = mkdtemp(prefix='jupyterhub-zygote-')
+        self.log.info("Starting single-user server zygote at %s", self.socket_path)
+        self.proc = Popen([sys.executable, '-m', 'jupyterhub.zygote', self.socket_path],
+            stdin=PIPE,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError("Single-user server zygote exited with status %i"
+                    % self.proc.returncode)
+            try:
+                stream = yield self._connect()
+            except (OSError, StreamClosedError):
+                yield gen.sleep(0.1)
+            else:
+                stream.close()
+                return
+        raise TimeoutError("Single-user server zygote didn't start in %i seconds"
+            % self.start_timeout)
+
+    @gen.coroutine
+    def start(self):
+        """Start the zygote, if it is not running"""
+        if self._starting is None:
+            if self.proc is not None and self.proc.poll() is None:
+                return
+            self._starting = self._start()
+        try:
+            yield self._starting
+        finally:
+            self._starting = None
+
+    @gen.coroutine
+    def launch(self, argv, env, uid, gid, gids, home):
+        """Start a single-user server with argv and env, as a user
+
+        Returns the pid of the server.
+        """
+        yield self.start()
+        stream = yield self._connect()
+        try:
+            request = dict(argv=argv, env=env, uid=uid, gid=gid, gids=gids, home=home)
+            yield stream.write(json.dumps(request).encode('utf8') + b'\n')
+            reply = yield stream.read_until(b'\n')
+        finally:
+            stream.close()
+        reply = json.loads(reply.decode('utf8'))
+        if 'error' in reply:
+            raise RuntimeError("Zygote failed to start server: %s" % reply['error'])
+        return reply['pid']
+
+    def stop(self):
+        """Stop the zygote
+
+        Servers it started keep running.
+        """
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc = None
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])